@@ -0,0 +1,17 @@
+"""
+ASGI config for backend project.
+
+It exposes the ASGI callable as a module-level variable named ``application``,
+e.g. for ``uvicorn backend.asgi:application``. Requests run in a bounded
+thread pool, see pugorugh/asgi.py.
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+
+from pugorugh.asgi import ASGIHandler  # noqa: E402
+
+application = ASGIHandler(get_wsgi_application())
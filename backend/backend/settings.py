@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pugorugh.metrics.RequestMetricsMiddleware',
+    'pugorugh.routers.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,9 +86,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    },
+    # a second SQLite file standing in for a read replica, filled with
+    # "manage.py sync_replicas"; see PUGORUGH_READ_REPLICAS
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db-replica.sqlite3'),
+    },
 }
 
+DATABASE_ROUTERS = ['pugorugh.routers.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -112,7 +122,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'pugorugh.authentication.CachedTokenAuthentication',
         # 'rest_framework.authentication.BasicAuthentication',
         # 'rest_framework.authentication.SessionAuthentication',
     )
@@ -138,7 +148,123 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# collectstatic target, served by pugorugh.views.static_asset
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+
+# Adds content-hashed copies and .gz/.br variants of the collected files
+STATICFILES_STORAGE = 'pugorugh.storage.CompressedManifestStaticFilesStorage'
+
 # Additional locations of static files
 STATICFILES_DIRS = (
     os.path.join(os.path.dirname(__file__), '../pugorugh/static/'),
 )
+
+
+# Pug or Ugh
+
+# Number of users whose undecided dog queues are kept in memory per process
+PUGORUGH_CANDIDATE_QUEUE_USERS = 1024
+
+# Parsed user preferences cached per process; TTL in seconds (None keeps
+# entries until evicted) and an optional CACHES alias to share them.
+# Entries are checked against the user's version counter on use
+PUGORUGH_USERPREF_CACHE_SIZE = 1024
+PUGORUGH_USERPREF_CACHE_TTL = 300
+PUGORUGH_USERPREF_CACHE_BACKEND = None
+
+# Token -> user resolutions cached per process, TTL in seconds. Logout
+# evicts only in the process serving it, other processes keep accepting
+# the token for up to the TTL; set a CACHES alias to keep the entries
+# there instead, where evictions reach every process
+PUGORUGH_TOKEN_CACHE_SIZE = 4096
+PUGORUGH_TOKEN_CACHE_TTL = 10
+PUGORUGH_TOKEN_CACHE_BACKEND = None
+
+# Maximum number of decisions accepted by /api/userdog/batch/
+PUGORUGH_SWIPE_BATCH_SIZE = 500
+
+# Dog photo derivatives (needs Pillow): process pool size for
+# build_image_derivatives, None for one per CPU, and whether import_dogs
+# builds them, once it finishes, for the photos it added or changed
+PUGORUGH_IMAGE_WORKERS = None
+PUGORUGH_IMAGE_DERIVATIVES_ON_IMPORT = False
+
+# Cache lifetime in seconds of static files without a content hash in
+# their name; fingerprinted ones are cached for a year
+PUGORUGH_STATIC_MAX_AGE = 300
+
+# ASGI serving (backend/asgi.py): threads running requests per process,
+# and threads overlapping work within a request, e.g. the swipe endpoint
+PUGORUGH_ASGI_THREADS = 16
+PUGORUGH_TASK_THREADS = 8
+
+# Most database queries one request may run, per URL name or
+# 'url_name:METHOD', counted with cold caches (token, preferences and
+# candidate queue lookups included); see pugorugh.metrics. Going over
+# logs a warning, or raises when PUGORUGH_QUERY_BUDGET_STRICT is set
+PUGORUGH_QUERY_BUDGETS = {
+    'login-user': 5,
+    'logout-user': 2,
+    'register-user': 6,
+    'dogview': 5,
+    'dogview_minus': 5,
+    'dogview-page': 5,
+    'dog-popular': 2,
+    'dog-count': 4,
+    'dog-search': 4,
+    'dog-export': 2,
+    'dog-swipe': 14,
+    'userdog-list': 2,
+    'userdogview': 11,
+    'userdog-batch': 12,
+    'userpref:GET': 3,
+    'userpref:PUT': 10,
+    'metrics': 1,
+}
+PUGORUGH_QUERY_BUDGET_STRICT = False
+
+# Order undecided dogs per user from their like history (needs NumPy and
+# a model built by "manage.py build_rankings"), instead of by id; queues
+# are re-ranked every PUGORUGH_RANKING_REFRESH likes/dislikes
+PUGORUGH_RANKING = False
+PUGORUGH_RANKING_MODEL = os.path.join(BASE_DIR, 'rankings.npz')
+PUGORUGH_RANKING_REFRESH = 10
+
+# Production SQLite tuning, see pugorugh/sqlite/base.py: WAL journal,
+# synchronous=NORMAL, memory-mapped reads, waiting up to 'timeout'
+# seconds for locks, BEGIN IMMEDIATE write transactions and persistent
+# connections. Set PUGORUGH_SQLITE_TUNED to use it for DATABASES
+PUGORUGH_SQLITE_TUNED = False
+PUGORUGH_SQLITE_TUNED_DATABASE = {
+    'ENGINE': 'pugorugh.sqlite',
+    'CONN_MAX_AGE': 600,
+    'OPTIONS': {
+        'timeout': 20,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,
+        'transaction_mode': 'IMMEDIATE',
+    },
+}
+if PUGORUGH_SQLITE_TUNED:
+    DATABASES['default'].update(PUGORUGH_SQLITE_TUNED_DATABASE)
+
+# Group single swipes from concurrent requests into one write
+# transaction, waiting up to PUGORUGH_COALESCE_WAIT seconds for others
+# to join; see swipes.WriteCoalescer
+PUGORUGH_COALESCE_SWIPES = False
+PUGORUGH_COALESCE_WAIT = 0.002
+PUGORUGH_COALESCE_BATCH = 256
+
+# Read replicas: DATABASES aliases serving dog catalog and preference
+# reads, see pugorugh.routers. Clients read from the primary for
+# PUGORUGH_REPLICA_PIN_SECONDS after they write, which should cover the
+# replication lag
+PUGORUGH_READ_REPLICAS = []
+PUGORUGH_REPLICA_PIN_SECONDS = 5
+
+# Keep dog ids and attribute codes in memory per process and filter
+# candidate queues there instead of in the database; reloaded after
+# catalog writes. Uses NumPy when installed, see pugorugh.catalog
+PUGORUGH_CATALOG_SNAPSHOT = False
@@ -13,6 +13,9 @@ echo Run migrate
 python manage.py migrate
 
 echo Importing data
-cd $SCRIPT_DIR ; python data_import.py
+python manage.py import_dogs --key image_filename
+
+echo Collecting static files
+python manage.py collectstatic --noinput
 
 echo Process complete, run \"python manage.py runserver\" from $ROOT_DIR
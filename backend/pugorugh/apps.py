@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class PugorughConfig(AppConfig):
     name = 'pugorugh'
+
+    def ready(self):
+        from . import signals
+        post_migrate.connect(signals.encode_dog_attributes, sender=self)
@@ -0,0 +1,159 @@
+"""ASGI serving of the project's WSGI application
+
+Django 2.2 has no ASGI handler and its ORM is synchronous. ASGIHandler
+adapts the WSGI application instead. The event loop accepts connections
+and reads request bodies, and each request runs in pool.request_pool, so
+a worker process keeps serving while requests wait on the database.
+Responses are sent in one message. Streaming ones, e.g. static files,
+are pulled from the pool a chunk at a time.
+
+backend/asgi.py exposes it to ASGI servers, e.g.
+uvicorn backend.asgi:application.
+"""
+import asyncio
+import io
+import sys
+
+from . import pool
+
+# header names that WSGI keeps out of the HTTP_ namespace
+unprefixed_headers = {'CONTENT_TYPE', 'CONTENT_LENGTH'}
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope
+    :param scope: ASGI connection scope
+    :param body: complete request body, bytes
+    :return: dict
+    """
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings are bytes decoded as latin-1
+        'SCRIPT_NAME': script_name.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in unprefixed_headers:
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            separator = '; ' if name == 'HTTP_COOKIE' else ','
+            value = environ[name] + separator + value
+        environ[name] = value
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+class ASGIHandler:
+    """ASGI 3 application running a WSGI application in a thread pool"""
+
+    def __init__(self, wsgi_application, bounded_pool=None):
+        self.wsgi_application = wsgi_application
+        self.pool = bounded_pool or pool.request_pool
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(
+                'Unsupported ASGI scope type {}'.format(scope['type']))
+        body = await self.read_body(receive)
+        if body is None:
+            # the client went away before sending the whole body
+            return
+        loop = asyncio.get_event_loop()
+        executor = self.pool.executor
+        status, headers, chunks, stream = await loop.run_in_executor(
+            executor, self.call_application, wsgi_environ(scope, body))
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': headers})
+        if stream is not None:
+            iterator = iter(stream)
+            try:
+                for chunk in chunks:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+                while True:
+                    chunk = await loop.run_in_executor(executor, next,
+                                                       iterator, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body',
+                                    'body': chunk, 'more_body': True})
+            finally:
+                await loop.run_in_executor(executor, stream.close)
+            chunks = []
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    @staticmethod
+    async def read_body(receive):
+        """Request body from http.request messages, None on disconnect"""
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def call_application(self, environ):
+        """Run the WSGI application, in a pool thread
+        :return: tuple of status, ASGI headers, body chunks so far, and
+            the response when it streams, else None
+        """
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+            return written.append
+
+        result = self.wsgi_application(environ, start_response)
+        if getattr(result, 'streaming', False):
+            return response['status'], response['headers'], written, result
+        try:
+            written.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], written, None
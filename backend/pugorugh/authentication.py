@@ -0,0 +1,41 @@
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+
+from .cache import LRUCache
+
+# (user, token) per token key, see CachedTokenAuthentication
+token_cache = LRUCache(
+    maxsize=getattr(settings, 'PUGORUGH_TOKEN_CACHE_SIZE', 4096),
+    ttl=getattr(settings, 'PUGORUGH_TOKEN_CACHE_TTL', 10),
+    backend=getattr(settings, 'PUGORUGH_TOKEN_CACHE_BACKEND', None),
+    prefix='pugorugh:token', local=False)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that remembers token -> user resolutions
+
+    Only successful lookups are cached. Entries are evicted when the
+    token is deleted (logout, rotation) or its user is saved, see
+    signals.py, and expire after PUGORUGH_TOKEN_CACHE_TTL seconds.
+
+    With PUGORUGH_TOKEN_CACHE_BACKEND set, entries are only kept in that
+    shared cache, so an eviction applies to every process at once.
+    Without it each process caches on its own and an eviction only
+    reaches the process that made it: elsewhere a deleted token or a
+    deactivated user keeps authenticating until the entry expires, for
+    up to PUGORUGH_TOKEN_CACHE_TTL seconds.
+    """
+
+    def authenticate_credentials(self, key):
+        credentials = token_cache.get(key)
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            token_cache.set(key, credentials)
+        return credentials
+
+
+def evict_token(key):
+    """Forget a cached token
+    :param key: Token key
+    """
+    token_cache.delete(key)
@@ -0,0 +1,474 @@
+"""Load generator for the register -> login -> preferences -> swipe loop
+
+seed() fills the database with a synthetic catalog and users with
+like/dislike histories, run() drives sessions through a transport (the
+Django test client, or HTTP against a local WSGI or ASGI server) and reports
+latency percentiles and throughput per URL name. See the benchmark
+management command, which does this in a throwaway test database.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+from http import HTTPStatus
+import json
+import math
+import random
+import threading
+import time
+from urllib.parse import unquote
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.servers.basehttp import ThreadedWSGIServer, \
+    WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.test import Client
+from django.urls import resolve
+from rest_framework.renderers import JSONRenderer
+
+from . import asgi
+from . import candidates
+from . import counters
+from . import importer
+from . import matchcounts
+from . import metrics
+from . import models
+from . import serializers
+
+PASSWORD = 'benchmark'
+breeds = ['Pug', 'Shiba Inu', 'Beagle', 'Corgi', 'Labrador', 'Poodle',
+          'Mutt', 'Greyhound']
+
+
+def random_prefs(rng):
+    """Non-empty random subsets of each preference, as CSV strings"""
+    def subset(choices):
+        picked = [choice for choice in choices if rng.random() < 0.6]
+        return ','.join(picked or [rng.choice(choices)])
+    return {'age': subset(models.userpref_ages),
+            'gender': subset(models.userpref_genders),
+            'size': subset(models.userpref_sizes)}
+
+
+def seed_dogs(count, rng, chunk_size=10000):
+    """Bulk insert count random dogs
+    :return: list of the new dog ids
+    """
+    start = models.Dog.objects.order_by('-id').values_list(
+        'id', flat=True).first() or 0
+    dogs = (models.Dog(name='dog{}'.format(start + i),
+                       image_filename='{}.jpg'.format(rng.randint(1, 25)),
+                       breed=rng.choice(breeds),
+                       age=rng.randrange(1, 180),
+                       gender=rng.choice(models.dog_genders),
+                       size=rng.choice(models.dog_sizes))
+            for i in range(count))
+    for chunk in importer.chunked(dogs, chunk_size):
+        models.Dog.objects.bulk_create(chunk)
+    return list(models.Dog.objects.filter(id__gt=start)
+                .order_by('id').values_list('id', flat=True))
+
+
+def seed_users(count, dog_ids, history, rng, like_ratio=0.3,
+               chunk_size=5000):
+    """Bulk insert count users sharing PASSWORD, each with preferences
+    and history random likes/dislikes
+    :return: list of the new usernames
+    """
+    User = get_user_model()
+    password = make_password(PASSWORD)
+    usernames = []
+    for chunk in importer.chunked(range(count), chunk_size):
+        names = ['bench{}'.format(i) for i in chunk]
+        User.objects.bulk_create(User(username=name, password=password)
+                                 for name in names)
+        user_ids = list(User.objects.filter(username__in=names)
+                        .values_list('id', flat=True))
+        models.UserPref.objects.bulk_create(
+            models.UserPref(user_id=user_id, **random_prefs(rng))
+            for user_id in user_ids)
+        models.UserDog.objects.bulk_create(
+            models.UserDog(user_id=user_id, dog_id=dog_id,
+                           status='l' if rng.random() < like_ratio else 'd')
+            for user_id in user_ids
+            for dog_id in rng.sample(dog_ids, min(history, len(dog_ids))))
+        usernames.extend(names)
+    return usernames
+
+
+def seed(dogs, users, history, seed=0):
+    """Seed a catalog and users, see seed_dogs and seed_users
+    :param dogs: number of dogs
+    :param users: number of users
+    :param history: likes/dislikes per user
+    :param seed: random seed, equal seeds give equal data
+    :return: list of the seeded usernames
+    """
+    rng = random.Random(seed)
+    dog_ids = seed_dogs(dogs, rng)
+    usernames = seed_users(users, dog_ids, history, rng)
+    # bulk writes skip the signals and counters that keep these fresh
+    counters.reconcile()
+    matchcounts.rebuild()
+    candidates.invalidate_all()
+    models.userpref_cache.clear()
+    return usernames
+
+
+class ClientTransport:
+    """In-process requests through django.test.Client"""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, path, data=None, token=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = Client()
+        extra = {}
+        if token is not None:
+            extra['HTTP_AUTHORIZATION'] = 'Token ' + token
+        body = '' if data is None else json.dumps(data)
+        response = client.generic(method, path, body,
+                                  content_type='application/json', **extra)
+        return response.status_code, response.content
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPTransport:
+    """Requests over HTTP to self.host and self.port, a new connection
+    per request
+    """
+    host = port = None
+
+    def request(self, method, path, data=None, token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token is not None:
+            headers['Authorization'] = 'Token ' + token
+        body = None if data is None else json.dumps(data)
+        connection = http.client.HTTPConnection(self.host, self.port,
+                                                timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+
+class WSGITransport(HTTPTransport):
+    """HTTP requests to this project served by a threaded WSGI server
+    on a free local port; call close() to stop it
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.server = ThreadedWSGIServer((host, 0), QuietWSGIRequestHandler)
+        self.server.set_app(get_wsgi_application())
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ASGITransport(HTTPTransport):
+    """HTTP requests to this project served by asgi.ASGIHandler behind
+    a minimal asyncio HTTP/1.1 server on a free local port, one event
+    loop thread as an ASGI server worker would have; call close() to
+    stop it
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.application = asgi.ASGIHandler(get_wsgi_application())
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.serve,
+                                       args=(host, started), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def serve(self, host, started):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, host, 0))
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        started.set()
+        self.loop.run_forever()
+
+    async def handle(self, reader, writer):
+        """Serve one request per connection, as HTTPTransport sends"""
+        try:
+            head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+            request_line, *header_lines = head.split('\r\n')
+            method, target, version = request_line.split(' ', 2)
+            headers = []
+            for line in filter(None, header_lines):
+                name, value = line.split(':', 1)
+                headers.append((name.strip().lower().encode('latin-1'),
+                                value.strip().encode('latin-1')))
+            length = int(dict(headers).get(b'content-length', 0))
+            body = await reader.readexactly(length) if length else b''
+            path, _, query = target.partition('?')
+            scope = {'type': 'http',
+                     'asgi': {'version': '3.0'},
+                     'http_version': version.split('/', 1)[1],
+                     'method': method,
+                     'scheme': 'http',
+                     'path': unquote(path),
+                     'raw_path': path.encode('latin-1'),
+                     'query_string': query.encode('latin-1'),
+                     'root_path': '',
+                     'headers': headers,
+                     'client': writer.get_extra_info('peername')[:2],
+                     'server': (self.host, self.port)}
+            messages = [{'type': 'http.request', 'body': body}]
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    lines = ['HTTP/1.1 {} {}'.format(
+                        status, HTTPStatus(status).phrase)]
+                    lines.extend('{}: {}'.format(name.decode('latin-1'),
+                                                 value.decode('latin-1'))
+                                 for name, value in message['headers'])
+                    lines.append('Connection: close')
+                    writer.write(('\r\n'.join(lines) + '\r\n\r\n')
+                                 .encode('latin-1'))
+                else:
+                    writer.write(message.get('body', b''))
+                await writer.drain()
+
+            await self.application(scope, receive, send)
+        finally:
+            writer.close()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def serializer_costs(repeat=5):
+    """Microbenchmark of serializing the whole catalog, with DogSerializer
+    over model instances and with DogRowSerializer over .values() rows
+    :param repeat: runs of each step, the fastest counts
+    :return: dict with microseconds per dog to fetch, serialize and
+        render, per path, and whether the JSON was identical
+    """
+    def best(function):
+        timings = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            result = function()
+            timings.append(time.perf_counter() - started)
+        return result, min(timings)
+
+    columns = serializers.DogRowSerializer.columns()
+    paths = {
+        'model': (lambda: list(models.Dog.objects.order_by('id')),
+                  serializers.DogSerializer),
+        'row': (lambda: list(models.Dog.objects.order_by('id')
+                             .values(*columns)),
+                serializers.DogRowSerializer),
+    }
+    count = models.Dog.objects.count()
+    results = {'dogs': count}
+    rendered = []
+    for name, (fetch, serializer_class) in paths.items():
+        rows, fetch_seconds = best(fetch)
+        data, serialize_seconds = best(
+            lambda: serializer_class(rows, many=True).data)
+        content, render_seconds = best(lambda: JSONRenderer().render(data))
+        rendered.append(content)
+        results[name] = {
+            step: round(seconds / max(count, 1) * 1e6, 3)
+            for step, seconds in (('fetch_us', fetch_seconds),
+                                  ('serialize_us', serialize_seconds),
+                                  ('render_us', render_seconds))}
+    results['identical'] = rendered[0] == rendered[1]
+    return results
+
+
+class Recorder:
+    """Latencies and error counts per URL name, thread-safe"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self, elapsed):
+        """Per-endpoint statistics in milliseconds
+        :param elapsed: wall time of the run, for throughput
+        :return: dict of URL name -> dict
+        """
+        result = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[endpoint] = {
+                'requests': len(values),
+                'errors': self.errors.get(endpoint, 0),
+                'throughput_rps': round(len(values) / elapsed, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+        return result
+
+
+class Session:
+    """One user going through the swipe workflow"""
+
+    def __init__(self, transport, recorder, rng, combined=False):
+        self.transport = transport
+        self.recorder = recorder
+        self.rng = rng
+        # swipe with the one round trip swipe endpoint
+        self.combined = combined
+        self.token = None
+
+    def call(self, method, path, data=None, expect=(200, 201, 204)):
+        started = time.perf_counter()
+        status, content = self.transport.request(method, path, data,
+                                                 self.token)
+        elapsed = time.perf_counter() - started
+        endpoint = resolve(path.split('?')[0]).url_name
+        self.recorder.add(endpoint, elapsed, status in expect)
+        if status in (200, 201) and content:
+            try:
+                return status, json.loads(content.decode())
+            except ValueError:
+                return status, None
+        return status, None
+
+    def register(self, username):
+        self.call('POST', '/api/user/',
+                  {'username': username, 'password': PASSWORD})
+
+    def login(self, username):
+        status, data = self.call('POST', '/api/user/login/',
+                                 {'username': username,
+                                  'password': PASSWORD})
+        self.token = data['token'] if data else None
+        return self.token is not None
+
+    def swipe(self, swipes, like_ratio=0.3):
+        self.call('PUT', '/api/user/preferences/', random_prefs(self.rng))
+        self.call('GET', '/api/user/preferences/')
+        if self.combined:
+            self.swipe_combined(swipes, like_ratio)
+        else:
+            pk = -1
+            for _ in range(swipes):
+                status, dog = self.call(
+                    'GET', '/api/dog/{}/undecided/next/'.format(pk),
+                    expect=(200, 404))
+                if status != 200:
+                    break
+                pk = dog['id']
+                self.call('PUT', '/api/dog/{}/{}/'.format(
+                    pk, self.decide(like_ratio)))
+        self.call('GET', '/api/dog/-1/liked/next/', expect=(200, 404))
+
+    def swipe_combined(self, swipes, like_ratio):
+        status, dog = self.call('GET', '/api/dog/-1/undecided/next/',
+                                expect=(200, 404))
+        if status != 200:
+            return
+        for _ in range(swipes):
+            if dog is None:
+                break
+            status, data = self.call('POST', '/api/dog/{}/{}/swipe/'.format(
+                dog['id'], self.decide(like_ratio)))
+            dog = data['next'] if data else None
+
+    def decide(self, like_ratio):
+        return 'liked' if self.rng.random() < like_ratio else 'disliked'
+
+
+def run(transport, usernames, new_users=0, sessions=0, swipes=20,
+        concurrency=1, seed=0, combined=False):
+    """Drive sessions through transport
+    :param transport: ClientTransport, WSGITransport or ASGITransport
+    :param usernames: seeded usernames to log in as
+    :param new_users: sessions that register a new user first
+    :param sessions: sessions logging in as a random seeded user
+    :param swipes: dogs swiped per session
+    :param concurrency: sessions run at the same time
+    :param seed: random seed
+    :param combined: swipe through the swipe endpoint, one request per
+        dog instead of two
+    :return: dict with elapsed seconds, totals and per-endpoint stats
+    """
+    rng = random.Random(seed)
+    plans = [('new', 'load{}-{}'.format(seed, i)) for i in range(new_users)]
+    # distinct users where possible, so sessions do not race each other
+    for start in range(0, sessions if usernames else 0, len(usernames) or 1):
+        count = min(len(usernames), sessions - start)
+        plans.extend(('seeded', username)
+                     for username in rng.sample(usernames, count))
+    rng.shuffle(plans)
+    recorder = Recorder()
+    metrics.registry.clear()
+
+    def session(plan):
+        kind, username = plan
+        session = Session(transport, recorder,
+                          random.Random('{}:{}'.format(seed, username)),
+                          combined=combined)
+        if kind == 'new':
+            session.register(username)
+        if session.login(username):
+            session.swipe(swipes)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(session, plans))
+    else:
+        for plan in plans:
+            session(plan)
+    elapsed = time.perf_counter() - started
+
+    endpoints = recorder.summary(elapsed)
+    # server-side query counts from the metrics middleware
+    for item in metrics.registry.snapshot()['db_queries']:
+        stats = endpoints.get(item['endpoint'])
+        if stats is not None and item['count']:
+            stats['db_queries_mean'] = round(item['sum'] / item['count'], 2)
+    total = sum(stats['requests'] for stats in endpoints.values())
+    return {'elapsed_s': round(elapsed, 3),
+            'sessions': len(plans),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+            'errors': sum(stats['errors'] for stats in endpoints.values()),
+            'endpoints': endpoints}
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import caches
+
+_missing = object()
+
+
+class LRUCache:
+    """Small thread-safe, process-local LRU mapping
+
+    Least recently used keys are evicted once maxsize is reached and,
+    when ttl is set, entries expire ttl seconds after being stored.
+    With a backend (a Django cache alias) values are also written
+    through to that cache, so other processes can pick them up and
+    evictions here fall back to it. Keys must then be str()-able.
+    Deleting a key cannot reach the copies other processes keep, unless
+    local is False: entries are then only kept in the backend.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, backend=None,
+                 prefix='pugorugh', local=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.prefix = prefix
+        self.local = local or backend is None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def _backend_key(self, key):
+        return '{}:{}'.format(self.prefix, key)
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return _missing
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return _missing
+            self._data.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, default=None, count=True):
+        """Return the cached value for key and mark it as recently used
+        :param key: hashable cache key
+        :param default: returned when key is not cached
+        :param count: whether the lookup counts towards hits/misses
+        :return: cached value or default
+        """
+        value = self._get_local(key) if self.local else _missing
+        if value is _missing and self.backend is not None:
+            value = caches[self.backend].get(self._backend_key(key),
+                                             _missing)
+            if value is not _missing and self.local:
+                self._set_local(key, value)
+        if count:
+            if value is _missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return default if value is _missing else value
+
+    def set(self, key, value):
+        """Store value under key, evicting the oldest entry if full
+        :param key: hashable cache key
+        :param value: any object, picklable when using a backend
+        """
+        if self.local:
+            self._set_local(key, value)
+        if self.backend is not None:
+            caches[self.backend].set(self._backend_key(key), value,
+                                     self.ttl)
+
+    def delete(self, key):
+        """Drop key from the cache if present
+        :param key: hashable cache key
+        """
+        with self._lock:
+            self._data.pop(key, None)
+        if self.backend is not None:
+            caches[self.backend].delete(self._backend_key(key))
+
+    def clear(self):
+        """Drop every local entry, backend entries are left to expire"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Counters for sizing the cache
+        :return: dict with hits, misses, size and maxsize
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
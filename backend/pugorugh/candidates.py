@@ -0,0 +1,249 @@
+"""Per-user queues of undecided dog ids
+
+A queue holds the sorted ids of every dog that matches the user's
+preferences and has not been liked or disliked yet, so finding the next
+undecided dog is a binary search instead of a filtered anti-join.
+
+Queues live in process memory. They are built lazily on first use,
+dropped when the user's preferences or the dog catalog change, and kept
+up to date as the user likes, dislikes or un-decides dogs (see signals.py).
+
+Those signals only reach the process that wrote. Each queue is also
+tagged with the catalog, preference and decision version counters it was
+built at, less the bumps of this process (see versions.local_bumps), and
+rebuilt once another process, e.g. another worker or import_dogs, moved
+one of them.
+
+With PUGORUGH_CATALOG_SNAPSHOT on, queues are filtered from the
+process's catalog.CatalogSnapshot instead of by the database.
+
+With PUGORUGH_RANKING on, users with likes get a RankedQueue ordered by
+ranking.rank() instead, rebuilt every PUGORUGH_RANKING_REFRESH decisions
+and whenever a new ranking model is loaded.
+"""
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+
+from .cache import LRUCache
+from . import catalog
+from . import models
+from . import ranking
+from . import versions
+
+
+class CandidateQueue:
+    """Sorted list of candidate dog ids for a single user"""
+
+    def __init__(self, dog_ids, generation=None, tag=None):
+        self.dog_ids = sorted(dog_ids)
+        self.generation = generation
+        self.tag = tag
+        self.decisions = 0
+
+    def __len__(self):
+        return len(self.dog_ids)
+
+    def __contains__(self, dog_id):
+        index = bisect_left(self.dog_ids, dog_id)
+        return index < len(self.dog_ids) and self.dog_ids[index] == dog_id
+
+    def next_after(self, pk):
+        """First candidate id strictly greater than pk
+        :param pk: dog id, -1 to start from the beginning
+        :return: dog id or None when the queue is exhausted
+        """
+        index = bisect_right(self.dog_ids, pk)
+        if index < len(self.dog_ids):
+            return self.dog_ids[index]
+        return None
+
+    def ids_after(self, pk, count):
+        """Up to count candidate ids strictly greater than pk
+        :param pk: dog id, -1 to start from the beginning
+        :param count: maximum number of ids
+        :return: list of dog ids
+        """
+        index = bisect_right(self.dog_ids, pk)
+        return self.dog_ids[index:index + count]
+
+    def add(self, dog_id):
+        """Insert dog_id keeping the queue sorted, ignoring duplicates"""
+        index = bisect_left(self.dog_ids, dog_id)
+        if index == len(self.dog_ids) or self.dog_ids[index] != dog_id:
+            self.dog_ids.insert(index, dog_id)
+
+    def discard(self, dog_id):
+        """Remove dog_id from the queue if present"""
+        index = bisect_left(self.dog_ids, dog_id)
+        if index < len(self.dog_ids) and self.dog_ids[index] == dog_id:
+            del self.dog_ids[index]
+
+
+class RankedQueue:
+    """Candidate dog ids for a single user, best ranked first
+
+    "After pk" means after pk in ranking order, so clients paging with
+    the last dog they saw walk the ranking. Decided dogs are skipped
+    rather than removed; dogs cannot be put back, the queue is dropped
+    instead.
+    """
+
+    def __init__(self, dog_ids, generation=None, tag=None):
+        self.dog_ids = list(dog_ids)
+        self.positions = {dog_id: index
+                          for index, dog_id in enumerate(self.dog_ids)}
+        self.decided = set()
+        self.generation = generation
+        self.tag = tag
+        self.decisions = 0
+
+    def __len__(self):
+        return len(self.dog_ids) - len(self.decided)
+
+    def __contains__(self, dog_id):
+        return dog_id in self.positions and dog_id not in self.decided
+
+    def ids_after(self, pk, count):
+        """Up to count candidate ids ranked after pk
+        :param pk: dog id, or any id not in the queue to start from the top
+        :param count: maximum number of ids
+        :return: list of dog ids
+        """
+        index = self.positions.get(pk, -1) + 1
+        result = []
+        while index < len(self.dog_ids) and len(result) < count:
+            if self.dog_ids[index] not in self.decided:
+                result.append(self.dog_ids[index])
+            index += 1
+        return result
+
+    def next_after(self, pk):
+        """First candidate id ranked after pk, None when exhausted"""
+        dog_ids = self.ids_after(pk, 1)
+        return dog_ids[0] if dog_ids else None
+
+    def discard(self, dog_id):
+        if dog_id in self.positions:
+            self.decided.add(dog_id)
+
+
+_queues = LRUCache(
+    maxsize=getattr(settings, 'PUGORUGH_CANDIDATE_QUEUE_USERS', 1024))
+
+
+def version_keys(user_id):
+    """Version counters a user's queue depends on"""
+    return [versions.CATALOG, versions.userpref_key(user_id),
+            versions.userdogs_key(user_id)]
+
+
+def version_tag(user_id, current=None):
+    """The user's version counters less the bumps of this process,
+    which it applied to its queues as it made them
+    :param user_id: User id
+    :param current: versions.get_versions() of version_keys(), e.g.
+        already fetched by the request, read when None
+    :return: tuple of ints
+    """
+    keys = version_keys(user_id)
+    # local bumps first: one landing in between makes the tag differ
+    # and the queue rebuild, rather than hide another process's write
+    local = versions.local_bumps(keys)
+    if current is None:
+        current = versions.get_versions(keys)
+    return tuple(current[key][0] - local[key] for key in keys)
+
+
+def build_queue(user, tag=None, version=None):
+    """Query the undecided dogs matching the user's preferences
+    :param user: User instance
+    :param tag: version_tag() read before the query
+    :param version: see UserPref.cached_dog_lookups
+    :return: CandidateQueue, or RankedQueue when ranking applies
+    """
+    if catalog.enabled():
+        decided_ids = (models.UserDog.objects
+                       .filter(user=user)
+                       .values_list('dog_id', flat=True))
+        dog_ids = catalog.get_snapshot().undecided_ids(
+            models.UserPref.cached_dog_lookups(user, version), decided_ids)
+    else:
+        dog_ids = list(models.Dog.objects
+                       .for_userpref(user, version)
+                       .undecided_by(user)
+                       .order_by('id')
+                       .values_list('id', flat=True))
+    generation = ranking.generation()
+    ranked = ranking.rank(user.id, dog_ids)
+    if ranked is not None:
+        return RankedQueue(ranked, generation, tag)
+    return CandidateQueue(dog_ids, generation, tag)
+
+
+def get_queue(user, current=None):
+    """Cached candidate queue for user, built on first use and rebuilt
+    when another process changed what it depends on
+    :param user: User instance
+    :param current: versions.get_versions() of at least version_keys(),
+        read when None
+    :return: CandidateQueue or RankedQueue
+    """
+    tag = version_tag(user.id, current)
+    queue = _queues.get(user.id)
+    if (queue is None or queue.generation != ranking.generation()
+            or queue.tag != tag):
+        version = None
+        if current is not None:
+            version = current[versions.userpref_key(user.id)][0]
+        queue = build_queue(user, tag, version)
+        _queues.set(user.id, queue)
+    return queue
+
+
+def dog_decided(user_id, dog_id):
+    """Drop a liked or disliked dog from the user's queue, if cached"""
+    queue = _queues.get(user_id)
+    if queue is None:
+        return
+    queue.discard(dog_id)
+    queue.decisions += 1
+    # re-rank now and then, as each decision changes the user's profile
+    if ranking.enabled() and queue.decisions >= getattr(
+            settings, 'PUGORUGH_RANKING_REFRESH', 10):
+        invalidate(user_id)
+
+
+def dog_undecided(user_id, dog_id):
+    """Put a dog back in the user's queue if it matches their preferences"""
+    queue = _queues.get(user_id)
+    if queue is None:
+        return
+    if isinstance(queue, RankedQueue):
+        invalidate(user_id)
+        return
+    if catalog.enabled():
+        matches = catalog.get_snapshot().matches(
+            models.UserPref.cached_dog_lookups(user_id), dog_id)
+    else:
+        matches = (models.Dog.objects
+                   .for_userpref(user_id)
+                   .filter(id=dog_id)
+                   .exists())
+    if matches:
+        queue.add(dog_id)
+
+
+def invalidate(user_id):
+    """Forget the user's queue, it is rebuilt on next use"""
+    _queues.delete(user_id)
+
+
+def invalidate_all():
+    """Forget every queue, e.g. after the dog catalog changed"""
+    _queues.clear()
+
+
+def stats():
+    """LRUCache.stats() of the queue cache"""
+    return _queues.stats()
@@ -0,0 +1,173 @@
+"""In-memory columnar snapshot of the dog catalog
+
+The catalog is read far more often than it is written, and building a
+user's candidate queue only needs each dog's id and attribute codes.
+With PUGORUGH_CATALOG_SNAPSHOT on, each process keeps those as typed
+arrays, one per column, sorted by id. Preference filtering is then a
+vectorized bitmask test over the columns, and candidates.build_queue
+only asks the database for the dogs the user decided on.
+
+The snapshot is tagged with the catalog version (see versions.py) it
+was loaded at, and reloaded from the primary once a catalog write has
+bumped the version.
+
+NumPy is optional. Without it the columns are array.array and the
+filters run as Python loops, which is slower but gives the same ids.
+"""
+from array import array
+from bisect import bisect_left
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from . import models
+from . import versions
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+columns = ('gender_code', 'size_code', 'age_bucket')
+# UserPref.dog_lookups() key -> column it filters
+lookup_columns = {column + '__in': column for column in columns}
+
+
+def numpy_available():
+    return np is not None
+
+
+def enabled():
+    return getattr(settings, 'PUGORUGH_CATALOG_SNAPSHOT', False)
+
+
+def lookup_masks(lookups):
+    """Turn UserPref.dog_lookups() into (column, bitmask) pairs; a dog
+    matches when each of its codes shares a bit with the column's mask
+    :param lookups: dict of lookup -> list of single-bit codes
+    :return: list of tuples
+    """
+    masks = []
+    for lookup, codes in lookups.items():
+        if lookup not in lookup_columns:
+            raise ValueError('{} is not a catalog lookup'.format(lookup))
+        masks.append((lookup_columns[lookup], sum(set(codes))))
+    return masks
+
+
+class CatalogSnapshot:
+    """Dog ids in ascending order and their attribute codes
+
+    dog_ids is int64 and the code columns uint8, as NumPy arrays when
+    NumPy is installed, else as array.array; index i of each column
+    describes dog_ids[i].
+    """
+
+    def __init__(self, dog_ids, gender_code, size_code, age_bucket,
+                 version=None):
+        self.dog_ids = dog_ids
+        self.columns = {'gender_code': gender_code,
+                        'size_code': size_code,
+                        'age_bucket': age_bucket}
+        self.version = version
+
+    def __len__(self):
+        return len(self.dog_ids)
+
+    @property
+    def nbytes(self):
+        """Memory taken by the columns"""
+        return sum(len(values) * values.itemsize for values in
+                   [self.dog_ids] + list(self.columns.values()))
+
+    @classmethod
+    def load(cls, version=None, using=DEFAULT_DB_ALIAS, chunk_size=10000):
+        """Read the columns of every dog
+        :param version: catalog version the rows belong to
+        :param using: database alias
+        :return: CatalogSnapshot
+        """
+        dog_ids = array('q')
+        codes = [array('B') for column in columns]
+        rows = (models.Dog.objects.using(using)
+                .order_by('id')
+                .values_list('id', *columns)
+                .iterator(chunk_size=chunk_size))
+        for row in rows:
+            dog_ids.append(row[0])
+            for values, code in zip(codes, row[1:]):
+                values.append(code)
+        if np is not None:
+            dog_ids = np.frombuffer(dog_ids, dtype=np.int64)
+            codes = [np.frombuffer(values, dtype=np.uint8)
+                     for values in codes]
+        return cls(dog_ids, *codes, version=version)
+
+    def matching_ids(self, lookups):
+        """Ids of the dogs matching preference lookups, ascending
+        :param lookups: UserPref.dog_lookups(), {} for every dog
+        :return: int64 NumPy array, or array.array without NumPy
+        """
+        masks = [(self.columns[column], mask)
+                 for column, mask in lookup_masks(lookups)]
+        if np is not None:
+            keep = np.ones(len(self.dog_ids), dtype=bool)
+            for values, mask in masks:
+                keep &= (values & mask) != 0
+            return self.dog_ids[keep]
+        return array('q', (
+            dog_id for index, dog_id in enumerate(self.dog_ids)
+            if all(values[index] & mask for values, mask in masks)))
+
+    def undecided_ids(self, lookups, decided_ids):
+        """matching_ids() without the dogs a user liked or disliked
+        :param lookups: UserPref.dog_lookups()
+        :param decided_ids: iterable of dog ids
+        :return: list of dog ids, ascending
+        """
+        matching = self.matching_ids(lookups)
+        if np is not None:
+            decided = np.fromiter(decided_ids, dtype=np.int64)
+            return matching[np.isin(matching, decided,
+                                    invert=True)].tolist()
+        decided = set(decided_ids)
+        return [dog_id for dog_id in matching if dog_id not in decided]
+
+    def matches(self, lookups, dog_id):
+        """Whether dog_id is in the snapshot and matches lookups"""
+        if np is not None:
+            index = int(np.searchsorted(self.dog_ids, dog_id))
+        else:
+            index = bisect_left(self.dog_ids, dog_id)
+        if index == len(self.dog_ids) or self.dog_ids[index] != dog_id:
+            return False
+        return all(self.columns[column][index] & mask
+                   for column, mask in lookup_masks(lookups))
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def get_snapshot():
+    """This process's snapshot, reloaded when the catalog version moved
+    :return: CatalogSnapshot
+    """
+    global _snapshot
+    # read before loading, so a write during the load forces a reload;
+    # (value, modified), which also tells apart a recreated counter
+    version = versions.get_versions([versions.CATALOG])[versions.CATALOG]
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _lock:
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = CatalogSnapshot.load(version)
+            snapshot = _snapshot
+    return snapshot
+
+
+def clear():
+    """Drop the snapshot, it is reloaded on next use"""
+    global _snapshot
+    _snapshot = None
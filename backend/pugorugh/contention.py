@@ -0,0 +1,140 @@
+"""Multi-process write contention benchmark for SQLite
+
+run() starts worker processes against one database file. Each runs a
+thread per user, and each thread reads a dog and then swipes on it, as
+fast as it can. The report covers throughput, latency percentiles and
+swipes that failed with "database is locked". See the contention
+management command, which compares database configurations this way.
+
+Workers are started with the spawn method and set Django up themselves,
+so this module only imports Django inside functions.
+"""
+import multiprocessing
+import os
+import queue
+import random
+import threading
+import time
+
+
+def workload(user_ids, dog_ids, swipes, seed=0, like_ratio=0.3):
+    """Swipe concurrently in this process, one thread per user
+    :param user_ids: users swiping, one thread each
+    :param dog_ids: dogs to pick from
+    :param swipes: swipes per user
+    :param seed: random seed
+    :return: dict with the latencies in seconds and the failures
+    """
+    from django.contrib.auth import get_user_model
+    from django.db import connection, OperationalError
+
+    from . import models
+    from . import swipes as swipes_module
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def swipe_loop(user_id):
+        rng = random.Random('{}:{}'.format(seed, user_id))
+        try:
+            user = get_user_model().objects.get(id=user_id)
+            for dog_id in rng.sample(dog_ids, min(swipes, len(dog_ids))):
+                status = 'l' if rng.random() < like_ratio else 'd'
+                started = time.perf_counter()
+                try:
+                    # what DogView reads before the client swipes
+                    models.Dog.objects.filter(id=dog_id).first()
+                    swipes_module.record_decision(user, dog_id, status)
+                except OperationalError as error:
+                    with lock:
+                        errors.append(str(error))
+                else:
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=swipe_loop, args=(user_id,))
+               for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {'latencies': latencies, 'errors': errors}
+
+
+def worker(database, coalesce, barrier, results, *args):
+    """Process entry point: set Django up on database, wait for the
+    other workers, run workload(*args) and put its result on results
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default'] = database
+    settings.PUGORUGH_COALESCE_SWIPES = coalesce
+    django.setup()
+    barrier.wait(timeout=120)
+    results.put(workload(*args))
+
+
+def run(database, user_ids, dog_ids, processes=4, swipes=100,
+        coalesce=False, seed=0):
+    """Swipe from several processes at once
+    :param database: DATABASES entry the workers use
+    :param user_ids: users to swipe as, split between the processes
+    :param dog_ids: dogs to pick from
+    :param processes: worker processes
+    :param swipes: swipes per user
+    :param coalesce: turn PUGORUGH_COALESCE_SWIPES on in the workers
+    :param seed: random seed
+    :return: dict with elapsed seconds, throughput, latency
+        percentiles and failures
+    """
+    from .benchmark import percentile
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes + 1)
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(
+        database, coalesce, barrier, results,
+        user_ids[index::processes], dog_ids, swipes, seed))
+        for index in range(processes)]
+    for process in workers:
+        process.start()
+    try:
+        barrier.wait(timeout=120)
+        started = time.perf_counter()
+        outputs = []
+        while len(outputs) < len(workers):
+            try:
+                outputs.append(results.get(timeout=1))
+            except queue.Empty:
+                if any(process.exitcode not in (None, 0)
+                       for process in workers):
+                    raise RuntimeError('A contention worker failed')
+        elapsed = time.perf_counter() - started
+    finally:
+        for process in workers:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    latencies = sorted(value for output in outputs
+                       for value in output['latencies'])
+    errors = [error for output in outputs for error in output['errors']]
+
+    def milliseconds(fraction):
+        value = percentile(latencies, fraction)
+        return None if value is None else round(value * 1000, 3)
+
+    return {'elapsed_s': round(elapsed, 3),
+            'swipes': len(latencies),
+            'errors': len(errors),
+            'error_messages': sorted(set(errors)),
+            'throughput_sps': round(len(latencies) / elapsed, 2),
+            'p50_ms': milliseconds(0.50),
+            'p95_ms': milliseconds(0.95),
+            'p99_ms': milliseconds(0.99),
+            'max_ms': milliseconds(1.0)}
@@ -0,0 +1,85 @@
+"""Per-dog like and dislike counts
+
+Dog.like_count and Dog.dislike_count mirror the number of UserDog rows
+per status, so popularity is read from an index instead of counted with
+GROUP BY. swipes.py adjusts them with F() expressions in the same
+transaction as the UserDog write. Writes that bypass it (bulk seeding,
+users deleted with their decisions) leave them off until reconcile(),
+run periodically by the reconcile_counts command.
+"""
+from django.db.models import Case, Count, F, IntegerField, OuterRef, \
+    Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from . import models
+
+
+def deltas(changes):
+    """Net counter change per dog
+    :param changes: iterable of (dog_id, old status, new status), with
+        None for no decision
+    :return: dict of dog_id -> (like delta, dislike delta)
+    """
+    result = {}
+    for dog_id, old, new in changes:
+        if old == new:
+            continue
+        likes, dislikes = result.get(dog_id, (0, 0))
+        likes += (new == 'l') - (old == 'l')
+        dislikes += (new == 'd') - (old == 'd')
+        result[dog_id] = (likes, dislikes)
+    return result
+
+
+def apply(changes):
+    """Adjust the counters for changes in a single UPDATE
+    :param changes: iterable of (dog_id, old status, new status)
+    """
+    groups = {}
+    for dog_id, delta in deltas(changes).items():
+        if delta != (0, 0):
+            groups.setdefault(delta, []).append(dog_id)
+    if not groups:
+        return
+
+    def delta_of(position):
+        return Case(*[When(id__in=dog_ids, then=Value(delta[position]))
+                      for delta, dog_ids in groups.items()],
+                    default=Value(0), output_field=IntegerField())
+
+    models.Dog.objects.filter(
+        id__in=[dog_id for dog_ids in groups.values() for dog_id in dog_ids]
+    ).update(like_count=F('like_count') + delta_of(0),
+             dislike_count=F('dislike_count') + delta_of(1))
+
+
+def counted(status):
+    """UserDog rows of a dog with status, for Dog querysets"""
+    rows = (models.UserDog.objects
+            .filter(dog=OuterRef('pk'), status=status)
+            .order_by()
+            .values('dog')
+            .annotate(count=Count('pk'))
+            .values('count'))
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+def drifted(queryset=None):
+    """Dogs whose counters differ from their UserDog rows
+    :param queryset: Dog queryset to check, all dogs by default
+    :return: Dog queryset
+    """
+    if queryset is None:
+        queryset = models.Dog.objects.all()
+    return queryset.exclude(like_count=counted('l'),
+                            dislike_count=counted('d'))
+
+
+def reconcile(queryset=None):
+    """Recount the counters of drifted dogs, in a single UPDATE so
+    concurrent swipes are not overwritten with stale counts
+    :param queryset: Dog queryset to check, all dogs by default
+    :return: number of dogs fixed
+    """
+    return drifted(queryset).update(like_count=counted('l'),
+                                    dislike_count=counted('d'))
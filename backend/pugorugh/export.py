@@ -0,0 +1,127 @@
+"""Streaming export of the dog catalog as NDJSON
+
+Each line is a dog as the API serializes it (DogRowSerializer) plus its
+updated_at. Rows are read with QuerySet.iterator() and compressed as
+they are produced, so memory stays flat however large the catalog is.
+
+Every catalog write is numbered from the models.dog_changes_key counter
+inside its transaction, so the numbers follow commit order (see
+Dog.change_seq). With a since number only the writes after it are
+exported: the dogs saved, and {"id": ..., "deleted": true} for the dogs
+deleted (see models.DeletedDog), merged in the order they happened, so
+a dog id deleted and then reused ends up present. Clients apply the
+lines in order as upserts and deletes by id, and pass the counter read
+when the export started as the next since; writes committed while an
+export runs may come again in the next one, which applying by id makes
+harmless.
+"""
+import heapq
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import models
+from . import serializers
+
+
+def last_change():
+    """The number of the last committed catalog write, the since of the
+    next export when read before this one
+    :return: int, 0 before the first write
+    """
+    return (models.Version.objects
+            .filter(key=models.dog_changes_key)
+            .values_list('value', flat=True)
+            .first()) or 0
+
+
+def dog_rows(since=None, chunk_size=2000):
+    """Catalog rows in id order, or in change order after since
+    :param since: change number, None for every dog
+    :param chunk_size: rows fetched from the database at a time
+    :return: iterator of .values() dicts
+    """
+    dogs = models.Dog.objects.order_by('id')
+    if since is not None:
+        dogs = (dogs.filter(change_seq__gt=since)
+                .order_by('change_seq', 'id'))
+    return dogs.values(*serializers.DogRowSerializer.columns(),
+                       'updated_at', 'change_seq').iterator(
+                           chunk_size=chunk_size)
+
+
+def deleted_rows(since, chunk_size=2000):
+    """The dogs deleted after since, in change order
+    :param since: change number
+    :param chunk_size: rows fetched from the database at a time
+    :return: iterator of .values() dicts with dog_id and change_seq
+    """
+    return (models.DeletedDog.objects
+            .filter(change_seq__gt=since)
+            .order_by('change_seq', 'id')
+            .values('dog_id', 'change_seq')
+            .iterator(chunk_size=chunk_size))
+
+
+def ndjson_lines(since=None, context=None):
+    """The export, one encoded line per dog
+    :param since: change number, None for a full export
+    :param context: serializer context, e.g. with the request
+    :return: iterator of bytes
+    """
+    serializer = serializers.DogRowSerializer(context=context or {})
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    rows = dog_rows(since)
+    if since is not None:
+        rows = heapq.merge(rows, deleted_rows(since),
+                           key=lambda row: row['change_seq'])
+    for row in rows:
+        if 'dog_id' in row:
+            data = {'id': row['dog_id'], 'deleted': True}
+        else:
+            data = serializer.to_representation(row)
+            data['updated_at'] = row['updated_at']
+        yield (encoder.encode(data) + '\n').encode()
+
+
+def gzip_stream(chunks, level=6, buffer_size=65536):
+    """Gzip-compress an iterator of bytes on the fly
+    :param chunks: iterator of bytes
+    :param level: zlib compression level
+    :param buffer_size: compressed bytes gathered before each yield
+    :return: iterator of bytes forming one gzip member
+    """
+    # wbits 31: a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            pending.append(compressed)
+            pending_size += len(compressed)
+            if pending_size >= buffer_size:
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+    pending.append(compressor.flush())
+    yield b''.join(pending)
+
+
+def batched(chunks, buffer_size=65536):
+    """Join small chunks into writes of about buffer_size bytes, the
+    uncompressed counterpart of gzip_stream
+    :param chunks: iterator of bytes
+    :return: iterator of bytes
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= buffer_size:
+            yield b''.join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b''.join(pending)
@@ -0,0 +1,199 @@
+"""Resized, re-encoded derivatives of the dog photos
+
+Originals in static/images/dogs are multi-megapixel JPEGs; the frontend
+only needs a card-sized image per swipe. Derivatives are written to
+static/images/dogs/derived, named after the SHA-256 of the original so
+an unchanged photo is never re-encoded, and listed in manifest.json,
+which DogSerializer reads to expose their URLs.
+
+Encoding needs Pillow, which is optional: without it nothing is built
+and the API keeps serving the originals.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.templatetags.static import static
+
+from . import models
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+SOURCE_DIR = os.path.join(STATIC_DIR, 'images', 'dogs')
+DERIVED_DIR = os.path.join(SOURCE_DIR, 'derived')
+MANIFEST = os.path.join(DERIVED_DIR, 'manifest.json')
+
+# name -> (bounding box, Pillow format, file extension, save options)
+VARIANTS = {
+    'card': ((800, 800), 'JPEG', 'jpg',
+             {'quality': 80, 'progressive': True, 'optimize': True}),
+    'card_webp': ((800, 800), 'WEBP', 'webp', {'quality': 75}),
+    'thumb': ((200, 200), 'JPEG', 'jpg',
+              {'quality': 75, 'progressive': True, 'optimize': True}),
+    'thumb_webp': ((200, 200), 'WEBP', 'webp', {'quality': 70}),
+}
+
+
+def pillow_available():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def file_hash(path):
+    """SHA-256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def derived_name(content_hash, variant):
+    extension = VARIANTS[variant][2]
+    return '{}-{}.{}'.format(content_hash[:16], variant, extension)
+
+
+def process_image(image_filename, force=False):
+    """Write every variant of one original, skipping existing ones;
+    runs in a worker process
+    :param image_filename: file name under SOURCE_DIR
+    :param force: re-encode even if the derivatives exist
+    :return: tuple of (image_filename, manifest entry, encoded count)
+    """
+    from PIL import Image
+
+    source = os.path.join(SOURCE_DIR, image_filename)
+    content_hash = file_hash(source)
+    entry = {'hash': content_hash}
+    missing = {}
+    for variant in VARIANTS:
+        name = derived_name(content_hash, variant)
+        entry[variant] = name
+        if force or not os.path.exists(os.path.join(DERIVED_DIR, name)):
+            missing[variant] = name
+    if missing:
+        with Image.open(source) as original:
+            original = original.convert('RGB')
+            for variant, name in missing.items():
+                box, image_format, _, options = VARIANTS[variant]
+                image = original.copy()
+                image.thumbnail(box, Image.LANCZOS)
+                # write then rename so readers never see partial files
+                path = os.path.join(DERIVED_DIR, name)
+                image.save(path + '.tmp', image_format, **options)
+                os.replace(path + '.tmp', path)
+    return image_filename, entry, len(missing)
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(manifest):
+    with open(MANIFEST + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(MANIFEST + '.tmp', MANIFEST)
+
+
+def build_derivatives(image_filenames, workers=None, force=False):
+    """Build derivatives for originals, in a process pool when workers
+    is more than one, and record them in the manifest
+    :param image_filenames: iterable of file names under SOURCE_DIR
+    :param workers: pool size, defaults to PUGORUGH_IMAGE_WORKERS
+    :param force: re-encode even if the derivatives exist
+    :return: tuple of (images processed, files encoded)
+    """
+    if workers is None:
+        workers = getattr(settings, 'PUGORUGH_IMAGE_WORKERS', None)
+    image_filenames = sorted(
+        name for name in set(image_filenames)
+        if name and os.path.basename(name) == name
+        and os.path.isfile(os.path.join(SOURCE_DIR, name)))
+    if not image_filenames:
+        return 0, 0
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+
+    if workers == 1 or len(image_filenames) == 1:
+        results = [process_image(name, force) for name in image_filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(process_image, image_filenames,
+                                    [force] * len(image_filenames),
+                                    chunksize=4))
+
+    manifest = load_manifest()
+    encoded = 0
+    for image_filename, entry, count in results:
+        manifest[image_filename] = entry
+        encoded += count
+    write_manifest(manifest)
+    return len(results), encoded
+
+
+def build_for_dogs(dog_ids, batch_size=500):
+    """Build the derivatives of the given dogs' photos, e.g. after an
+    import; photos already built are skipped by content hash
+    :param dog_ids: list of Dog ids
+    :param batch_size: ids per query
+    :return: tuple of (images processed, files encoded)
+    """
+    image_filenames = set()
+    for start in range(0, len(dog_ids), batch_size):
+        image_filenames.update(
+            models.Dog.objects
+            .filter(id__in=dog_ids[start:start + batch_size])
+            .values_list('image_filename', flat=True))
+    return build_derivatives(image_filenames)
+
+
+class ManifestCache:
+    """In-memory copy of the manifest, reloaded when the file changes
+    (checked at most once per interval seconds)
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._manifest = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.stat(MANIFEST).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != self._mtime:
+                    self._manifest = load_manifest() if mtime else {}
+                    self._mtime = mtime
+        return self._manifest
+
+
+manifest_cache = ManifestCache()
+
+
+def image_urls(image_filename):
+    """Static URLs of the derivatives of an original
+    :param image_filename: Dog.image_filename
+    :return: dict of variant -> URL, None if not built
+    """
+    entry = manifest_cache.get().get(image_filename)
+    if entry is None:
+        return None
+    return {variant: static('images/dogs/derived/' + entry[variant])
+            for variant in VARIANTS if variant in entry}
@@ -0,0 +1,247 @@
+"""Streaming, chunked import of dog catalog feeds
+
+Feeds are either a JSON array of dog objects, like static/dog_details.json,
+or JSON Lines with one dog object per line. Records are parsed
+incrementally, validated with DogSerializer a chunk at a time and written
+with bulk_create and batched UPDATEs, one transaction per chunk, so memory
+use stays bounded by the chunk size whatever the feed size.
+"""
+from itertools import chain, islice
+import json
+
+from django.db import connection, transaction
+from django.db.models import Max
+
+from . import matchcounts
+from . import models
+from . import serializers
+from .signals import catalog_changed, catalog_imported
+
+dog_fields = ['name', 'image_filename', 'breed', 'age', 'gender', 'size']
+
+
+def iter_json_array(fileobj, read_size=65536, buffer=''):
+    """Yield the items of a JSON array without loading the whole file
+    :param fileobj: text file positioned before the opening bracket
+    :param read_size: characters read at a time
+    :param buffer: text already read from fileobj
+    :return: generator of decoded items
+    """
+    decoder = json.JSONDecoder()
+    buffer = (buffer + fileobj.read(read_size)).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    position = 1
+    eof = False
+    while True:
+        # skip separators, refilling the buffer as needed
+        while True:
+            while (position < len(buffer)
+                   and buffer[position] in ' \t\r\n,'):
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer = fileobj.read(read_size)
+            position = 0
+            eof = not buffer
+        if position >= len(buffer):
+            raise ValueError('Unterminated JSON array')
+        if buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = fileobj.read(read_size)
+            eof = not more
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield item
+        position = end
+
+
+def iter_json_lines(fileobj, buffer=''):
+    """Yield one decoded object per non-blank line
+    :param fileobj: text file in JSON Lines format
+    :param buffer: text already read from the first line
+    :return: generator of decoded items
+    """
+    lines = chain([buffer + fileobj.readline()], fileobj)
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_records(fileobj):
+    """Yield dog records from a JSON array or JSON Lines file,
+    detected from the first non-blank character
+    :param fileobj: text file, need not be seekable
+    :return: iterator of decoded items
+    """
+    first = ' '
+    while first.isspace():
+        first = fileobj.read(1)
+    if first == '[':
+        return iter_json_array(fileobj, buffer=first)
+    if not first:
+        return iter(())
+    return iter_json_lines(fileobj, buffer=first)
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ImportStats:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.invalid = 0
+        self.errors = []
+        # photos of the dogs written whose image_filename is new or
+        # changed, the ones that may need derivatives
+        self.new_images = set()
+
+    @property
+    def total(self):
+        return self.created + self.updated + self.invalid
+
+
+def validate_chunk(records, stats, max_errors=20):
+    """Validate records with DogSerializer, keeping only valid ones
+    :param records: list of dicts
+    :param stats: ImportStats, invalid count and errors are updated
+    :param max_errors: number of error messages to keep
+    :return: list of validated data dicts
+    """
+    serializer = serializers.DogSerializer(data=records, many=True)
+    if serializer.is_valid():
+        return serializer.validated_data
+    valid = []
+    for record, errors in zip(records, serializer.errors):
+        if errors:
+            stats.invalid += 1
+            if len(stats.errors) < max_errors:
+                stats.errors.append((record, errors))
+        else:
+            # is_valid() leaves validated_data empty when any item fails
+            item = serializers.DogSerializer(data=record)
+            item.is_valid()
+            valid.append(item.validated_data)
+    return valid
+
+
+def update_rows(dogs):
+    """UPDATE existing dogs by id with one executemany; much cheaper
+    than QuerySet.bulk_update's CASE expressions for large chunks. Run
+    it in a transaction, which numbers the dogs' change_seq
+    :param dogs: list of Dog instances with id set
+    """
+    if not dogs:
+        return
+    fields = [models.Dog._meta.get_field(name) for name in
+              dog_fields + ['gender_code', 'size_code', 'age_bucket',
+                            'updated_at', 'change_seq']]
+    change_seq = models.Version.take(models.dog_changes_key)
+    sql = 'UPDATE {} SET {} WHERE {} = %s'.format(
+        connection.ops.quote_name(models.Dog._meta.db_table),
+        ', '.join('{} = %s'.format(connection.ops.quote_name(field.column))
+                  for field in fields),
+        connection.ops.quote_name(models.Dog._meta.pk.column))
+    rows = []
+    for dog in dogs:
+        dog.encode_attributes()
+        dog.change_seq = change_seq
+        # pre_save() is what stamps updated_at
+        rows.append([field.get_db_prep_save(field.pre_save(dog, False),
+                                            connection)
+                     for field in fields] + [dog.id])
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+
+
+def write_chunk(items, key=None, dry_run=False, new_images=None):
+    """Insert a chunk of validated dogs, or update them when a row with
+    the same natural key exists
+    :param items: list of validated data dicts
+    :param key: natural key field name, None to always insert
+    :param dry_run: count what would be written without writing
+    :param new_images: set the image_filename of created dogs, and of
+        updated ones whose photo changed, is added to
+    :return: tuple of (created, updated) counts
+    """
+    items = [{field: item[field] for field in dog_fields if field in item}
+             for item in items]
+    existing = {}
+    if key is not None:
+        # the last record wins when a key repeats within a chunk
+        items = list({item[key]: item for item in items}.values())
+        existing = dict(models.Dog.objects
+                        .filter(**{key + '__in': [i[key] for i in items]})
+                        .values_list(key, 'id'))
+    new_dogs = [models.Dog(**item) for item in items
+                if item.get(key) not in existing]
+    changed_dogs = [models.Dog(id=existing[item[key]], **item)
+                    for item in items if item.get(key) in existing]
+    if dry_run:
+        return len(new_dogs), len(changed_dogs)
+
+    with transaction.atomic():
+        last_id = models.Dog.objects.aggregate(last=Max('id'))['last'] or 0
+        # the codes being replaced, for the per-combination counts,
+        # and the photos
+        old_codes = {}
+        old_images = {}
+        for dog_id, image_filename, *codes in (
+                models.Dog.objects
+                .filter(id__in=[dog.id for dog in changed_dogs])
+                .values_list('id', 'image_filename', *models.code_fields)):
+            old_codes[dog_id] = tuple(codes)
+            old_images[dog_id] = image_filename
+        models.Dog.objects.bulk_create(new_dogs)
+        update_rows(changed_dogs)
+        dog_ids = [dog.id for dog in changed_dogs]
+        dog_ids.extend(models.Dog.objects
+                       .filter(id__gt=last_id)
+                       .values_list('id', flat=True))
+    # both write paths encode the codes on the instances
+    code_changes = matchcounts.deltas(chain(
+        ((None, dog.codes()) for dog in new_dogs),
+        ((old_codes.get(dog.id), dog.codes()) for dog in changed_dogs)))
+    catalog_changed.send(sender=models.Dog, dog_ids=dog_ids,
+                         code_changes=code_changes)
+    if new_images is not None:
+        new_images.update(dog.image_filename for dog in new_dogs)
+        new_images.update(dog.image_filename for dog in changed_dogs
+                          if dog.image_filename != old_images.get(dog.id))
+    return len(new_dogs), len(changed_dogs)
+
+
+def import_dogs(records, chunk_size=1000, key=None, dry_run=False):
+    """Validate and write dog records chunk by chunk
+    :param records: iterable of dicts
+    :param chunk_size: records validated and written together
+    :param key: natural key field name for upserts, None to insert only
+    :param dry_run: validate and count without writing
+    :return: ImportStats
+    """
+    stats = ImportStats()
+    for chunk in chunked(records, chunk_size):
+        items = validate_chunk(chunk, stats)
+        created, updated = write_chunk(items, key=key, dry_run=dry_run,
+                                       new_images=stats.new_images)
+        stats.created += created
+        stats.updated += updated
+    if not dry_run:
+        catalog_imported.send(sender=models.Dog,
+                              image_filenames=stats.new_images)
+    return stats
@@ -0,0 +1,173 @@
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from pugorugh import benchmark
+from pugorugh.models import Dog
+
+# --size presets: (dogs, users, likes/dislikes per user)
+SIZES = {
+    'small': (1000, 1000, 50),
+    'medium': (100000, 10000, 100),
+    'large': (1000000, 10000, 200),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database with synthetic dogs and users, '
+            'drive the register/login/preferences/swipe workflow against '
+            'it and write per-endpoint latency percentiles as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=SIZES, default='small',
+                            help='catalog preset, see SIZES')
+        parser.add_argument('--dogs', type=int, help='overrides --size')
+        parser.add_argument('--users', type=int, help='overrides --size')
+        parser.add_argument('--history', type=int,
+                            help='likes/dislikes per seeded user, '
+                                 'overrides --size')
+        parser.add_argument('--new-users', type=int, default=20,
+                            help='sessions registering a new user')
+        parser.add_argument('--sessions', type=int, default=100,
+                            help='sessions logging in as a seeded user')
+        parser.add_argument('--swipes', type=int, default=20,
+                            help='dogs swiped per session')
+        parser.add_argument('--transport', choices=('client', 'wsgi', 'asgi'),
+                            default='client',
+                            help='Django test client, or HTTP to a local '
+                                 'threaded WSGI server or ASGI handler')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='sessions at once, wsgi and asgi '
+                                 'transports only')
+        parser.add_argument('--combined', action='store_true',
+                            help='swipe with the swipe endpoint, which '
+                                 'also returns the next dog')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database',
+                            default=os.path.join(tempfile.gettempdir(),
+                                                 'pugorugh-benchmark.sqlite3'),
+                            help='SQLite file for the test database')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='keep the database, and reuse it if it is '
+                                 'already seeded')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='JSON results file, "-" for stdout')
+
+    def handle(self, *args, **options):
+        dogs, users, history = SIZES[options['size']]
+        dogs = dogs if options['dogs'] is None else options['dogs']
+        users = users if options['users'] is None else options['users']
+        if options['history'] is not None:
+            history = options['history']
+        if options['concurrency'] > 1 and options['transport'] == 'client':
+            raise CommandError('--concurrency needs --transport wsgi or asgi')
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark expects the SQLite backend')
+
+        setup_test_environment(debug=False)
+        settings.ALLOWED_HOSTS.append('127.0.0.1')
+        connection.settings_dict['TEST']['NAME'] = options['database']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=options['keepdb'],
+                                           serialize=False)
+        try:
+            results = self.benchmark(dogs, users, history, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0,
+                                                keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        output = json.dumps(results, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.report(results)
+
+    def benchmark(self, dogs, users, history, options):
+        started = time.monotonic()
+        usernames = list(get_user_model().objects
+                         .filter(username__startswith='bench')
+                         .values_list('username', flat=True))
+        if not (options['keepdb'] and Dog.objects.count() >= dogs
+                and len(usernames) >= users):
+            usernames = benchmark.seed(dogs, users, history,
+                                       seed=options['seed'])
+        seed_seconds = time.monotonic() - started
+        self.stderr.write('Seeded {} dogs and {} users in {:.1f}s'.format(
+            Dog.objects.count(), len(usernames), seed_seconds))
+
+        transports = {'client': benchmark.ClientTransport,
+                      'wsgi': benchmark.WSGITransport,
+                      'asgi': benchmark.ASGITransport}
+        transport = transports[options['transport']]()
+        try:
+            run = benchmark.run(transport, usernames,
+                                new_users=options['new_users'],
+                                sessions=options['sessions'],
+                                swipes=options['swipes'],
+                                concurrency=options['concurrency'],
+                                seed=options['seed'],
+                                combined=options['combined'])
+        finally:
+            if options['transport'] != 'client':
+                transport.close()
+
+        return {
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'config': {
+                'dogs': dogs,
+                'users': users,
+                'history': history,
+                'new_users': options['new_users'],
+                'sessions': options['sessions'],
+                'swipes': options['swipes'],
+                'transport': options['transport'],
+                'concurrency': options['concurrency'],
+                'combined': options['combined'],
+                'seed': options['seed'],
+            },
+            'seed_s': round(seed_seconds, 3),
+            'run': run,
+        }
+
+    def report(self, results):
+        run = results['run']
+        self.stdout.write('{} requests in {}s ({} req/s), {} errors'.format(
+            run['requests'], run['elapsed_s'], run['throughput_rps'],
+            run['errors']))
+        line = '{:<16}{:>9}{:>8}{:>10}{:>10}{:>10}{:>9}'
+        self.stdout.write(line.format('endpoint', 'requests', 'errors',
+                                      'p50 ms', 'p95 ms', 'p99 ms',
+                                      'queries'))
+        for endpoint, stats in run['endpoints'].items():
+            self.stdout.write(line.format(
+                endpoint, stats['requests'], stats['errors'],
+                stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                stats.get('db_queries_mean', '')))
@@ -0,0 +1,155 @@
+from datetime import datetime, timezone
+import json
+import os
+import random
+import tempfile
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from pugorugh import benchmark
+from pugorugh import candidates
+from pugorugh import catalog
+from pugorugh.management.commands.benchmark import git_commit
+from pugorugh.models import Dog, UserDog, UserPref
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def summary(seconds):
+    seconds = sorted(seconds)
+    return {'p50_ms': round(benchmark.percentile(seconds, 0.50) * 1000, 3),
+            'p95_ms': round(benchmark.percentile(seconds, 0.95) * 1000, 3)}
+
+
+class Command(BaseCommand):
+    help = ('Compare building candidate queues and finding the next '
+            'undecided dog with the ORM and with the in-memory catalog '
+            'snapshot, on throwaway test databases of growing size')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dogs', type=int, nargs='+',
+                            default=[100000, 1000000],
+                            help='catalog sizes to measure, ascending')
+        parser.add_argument('--users', type=int, default=20,
+                            help='users whose queues are built per size')
+        parser.add_argument('--history', type=int, default=100,
+                            help='likes/dislikes per user')
+        parser.add_argument('--lookups', type=int, default=200,
+                            help='next undecided dog lookups per size')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database',
+                            default=os.path.join(tempfile.gettempdir(),
+                                                 'pugorugh-catalog.sqlite3'),
+                            help='SQLite file for the test database')
+        parser.add_argument('--output', default='catalog-benchmark.json',
+                            help='JSON results file, "-" for stdout')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark expects the SQLite backend')
+        setup_test_environment(debug=False)
+        connection.settings_dict['TEST']['NAME'] = options['database']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=False, serialize=False)
+        try:
+            sizes = self.benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps({
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'numpy': catalog.numpy_available(),
+            'config': {name: options[name] for name in (
+                'users', 'history', 'lookups', 'seed')},
+            'sizes': sizes,
+        }, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.report(sizes)
+
+    def benchmark(self, options):
+        rng = random.Random(options['seed'])
+        sizes = []
+        user_ids = None
+        for dogs in sorted(options['dogs']):
+            benchmark.seed_dogs(dogs - Dog.objects.count(), rng)
+            if user_ids is None:
+                dog_ids = list(Dog.objects.values_list('id', flat=True))
+                usernames = benchmark.seed_users(
+                    options['users'], dog_ids, options['history'], rng)
+                user_ids = list(get_user_model().objects
+                                .filter(username__in=usernames)
+                                .values_list('id', flat=True))
+            self.stderr.write('Measuring {} dogs'.format(dogs))
+            sizes.append(self.measure(dogs, user_ids, rng, options))
+        return sizes
+
+    def measure(self, dogs, user_ids, rng, options):
+        snapshot, load_seconds = timed(catalog.CatalogSnapshot.load)
+        times = {'orm_build': [], 'snapshot_build': [],
+                 'orm_next': [], 'snapshot_next': []}
+        queues = {}
+        for user_id in user_ids:
+            orm_ids, seconds = timed(lambda: list(
+                Dog.objects.for_userpref(user_id)
+                .exclude(userdog__user=user_id)
+                .order_by('id').values_list('id', flat=True)))
+            times['orm_build'].append(seconds)
+            snapshot_ids, seconds = timed(lambda: snapshot.undecided_ids(
+                UserPref.cached_dog_lookups(user_id),
+                UserDog.objects.filter(user=user_id)
+                .values_list('dog_id', flat=True)))
+            times['snapshot_build'].append(seconds)
+            if snapshot_ids != orm_ids:
+                raise CommandError('The snapshot and the ORM disagree for '
+                                   'user {}'.format(user_id))
+            queues[user_id] = candidates.CandidateQueue(snapshot_ids)
+
+        for i in range(options['lookups']):
+            user_id = rng.choice(user_ids)
+            pk = rng.randrange(dogs)
+            orm_id, seconds = timed(lambda: (
+                Dog.objects.for_userpref(user_id)
+                .exclude(userdog__user=user_id)
+                .filter(id__gt=pk).order_by('id')
+                .values_list('id', flat=True).first()))
+            times['orm_next'].append(seconds)
+            snapshot_id, seconds = timed(queues[user_id].next_after, pk)
+            times['snapshot_next'].append(seconds)
+            if snapshot_id != orm_id:
+                raise CommandError('The snapshot and the ORM disagree for '
+                                   'user {} after {}'.format(user_id, pk))
+
+        return {'dogs': dogs,
+                'load_s': round(load_seconds, 3),
+                'snapshot_bytes': snapshot.nbytes,
+                **{name: summary(values) for name, values in times.items()}}
+
+    def report(self, sizes):
+        line = '{:<10}{:>9}{:>9}{:>13}{:>13}{:>12}{:>12}'
+        self.stdout.write(line.format('dogs', 'load s', 'MiB',
+                                      'ORM build', 'snap build',
+                                      'ORM next', 'snap next'))
+        for size in sizes:
+            self.stdout.write(line.format(
+                size['dogs'], size['load_s'],
+                round(size['snapshot_bytes'] / 2 ** 20, 1),
+                size['orm_build']['p50_ms'],
+                size['snapshot_build']['p50_ms'],
+                size['orm_next']['p50_ms'], size['snapshot_next']['p50_ms']))
+        self.stdout.write('p50 milliseconds per user')
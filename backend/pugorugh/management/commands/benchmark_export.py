@@ -0,0 +1,147 @@
+from datetime import datetime, timezone
+import gc
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+from rest_framework.test import APIClient
+
+from pugorugh import benchmark
+from pugorugh.management.commands.benchmark import git_commit
+from pugorugh.models import Dog
+
+
+def rss_bytes():
+    """Resident set size of this process, from /proc on Linux, else the
+    peak so far from getrusage
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = ('Stream the catalog export on a throwaway test database of '
+            'the given size and measure rows per second, response size '
+            'and resident memory, for a full and a ?since= export')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dogs', type=int, default=1000000)
+        parser.add_argument('--changed', type=float, default=0.01,
+                            help='share of dogs saved again before the '
+                                 '?since= export')
+        parser.add_argument('--encoding', default='gzip',
+                            choices=['gzip', 'identity'])
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database',
+                            default=os.path.join(tempfile.gettempdir(),
+                                                 'pugorugh-export.sqlite3'),
+                            help='SQLite file for the test database')
+        parser.add_argument('--output', default='export-benchmark.json',
+                            help='JSON results file, "-" for stdout')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark expects the SQLite backend')
+        setup_test_environment(debug=False)
+        connection.settings_dict['TEST']['NAME'] = options['database']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=False, serialize=False)
+        try:
+            results = self.benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps({
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {name: options[name] for name in (
+                'dogs', 'changed', 'encoding', 'seed')},
+            'results': results,
+        }, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.report(results)
+
+    def benchmark(self, options):
+        rng = random.Random(options['seed'])
+        self.stderr.write('Seeding {} dogs'.format(options['dogs']))
+        benchmark.seed_dogs(options['dogs'], rng)
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create_user(
+            'exporter', password='exporter'))
+
+        results = {}
+        full, since = self.measure(client, {}, options)
+        results['full'] = full
+
+        # save a share of the dogs again, one at a time like the API does
+        changed = rng.sample(range(Dog.objects.count()),
+                             int(options['dogs'] * options['changed']))
+        dog_ids = list(Dog.objects.order_by('id')
+                       .values_list('id', flat=True))
+        for index in changed:
+            Dog.objects.get(id=dog_ids[index]).save()
+        del dog_ids
+        results['since'], _ = self.measure(client, {'since': since},
+                                           options)
+        return results
+
+    def measure(self, client, params, options):
+        gc.collect()
+        rss_before = rss_peak = rss_bytes()
+        started = time.perf_counter()
+        response = client.get('/api/dog/export/', params,
+                              HTTP_ACCEPT_ENCODING=options['encoding'])
+        if response.status_code != 200:
+            raise CommandError('The export failed with {}'.format(
+                response.status_code))
+        body_bytes = chunks = 0
+        for chunk in response.streaming_content:
+            body_bytes += len(chunk)
+            chunks += 1
+            rss_peak = max(rss_peak, rss_bytes())
+        seconds = time.perf_counter() - started
+        response.close()
+
+        # count the rows apart, outside the timing
+        if params:
+            rows = Dog.objects.filter(
+                change_seq__gt=params['since']).count()
+        else:
+            rows = Dog.objects.count()
+        return {'rows': rows,
+                'seconds': round(seconds, 3),
+                'rows_per_s': round(rows / seconds) if seconds else None,
+                'bytes': body_bytes,
+                'chunks': chunks,
+                'rss_before_mib': round(rss_before / 2 ** 20, 1),
+                'rss_peak_mib': round(rss_peak / 2 ** 20, 1),
+                }, response['X-Next-Since']
+
+    def report(self, results):
+        line = '{:<8}{:>10}{:>9}{:>11}{:>10}{:>12}{:>10}'
+        self.stdout.write(line.format('export', 'rows', 'seconds',
+                                      'rows/s', 'MiB', 'RSS before',
+                                      'RSS peak'))
+        for name, result in results.items():
+            self.stdout.write(line.format(
+                name, result['rows'], result['seconds'],
+                result['rows_per_s'], round(result['bytes'] / 2 ** 20, 1),
+                result['rss_before_mib'], result['rss_peak_mib']))
@@ -0,0 +1,140 @@
+from datetime import datetime, timezone
+import json
+import os
+import random
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import F
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from pugorugh import benchmark
+from pugorugh import search
+from pugorugh import serializers
+from pugorugh.management.commands.benchmark import git_commit
+from pugorugh.management.commands.benchmark_catalog import summary, timed
+from pugorugh.models import Dog, UserPref
+
+
+def random_query(rng, dogs):
+    """What a user types into the search box: a breed or a dog name,
+    cut after a few letters like an autocomplete request
+    """
+    if rng.random() < 0.5:
+        words = rng.choice(benchmark.breeds).split()
+    else:
+        words = ['dog{}'.format(rng.randrange(dogs))]
+    last = words[-1]
+    words[-1] = last[:rng.randint(min(2, len(last)), len(last))]
+    return ' '.join(words)
+
+
+class Command(BaseCommand):
+    help = ('Compare the FTS5 dog search with LIKE filters on throwaway '
+            'test databases of growing size, first and later pages of '
+            'autocomplete queries combined with random preferences')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dogs', type=int, nargs='+',
+                            default=[100000, 1000000],
+                            help='catalog sizes to measure, ascending')
+        parser.add_argument('--queries', type=int, default=200,
+                            help='searches per size')
+        parser.add_argument('--limit', type=int, default=10,
+                            help='results per page')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--database',
+                            default=os.path.join(tempfile.gettempdir(),
+                                                 'pugorugh-search.sqlite3'),
+                            help='SQLite file for the test database')
+        parser.add_argument('--output', default='search-benchmark.json',
+                            help='JSON results file, "-" for stdout')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite' or not search.supported():
+            raise CommandError('The benchmark expects SQLite with FTS5')
+        setup_test_environment(debug=False)
+        connection.settings_dict['TEST']['NAME'] = options['database']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=False, serialize=False)
+        try:
+            sizes = self.benchmark(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps({
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {name: options[name] for name in (
+                'queries', 'limit', 'seed')},
+            'sizes': sizes,
+        }, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.report(sizes)
+
+    def benchmark(self, options):
+        rng = random.Random(options['seed'])
+        sizes = []
+        for dogs in sorted(options['dogs']):
+            # bulk inserts skip the signals, so the index is rebuilt
+            benchmark.seed_dogs(dogs - Dog.objects.count(), rng)
+            self.stderr.write('Measuring {} dogs'.format(dogs))
+            sizes.append(self.measure(dogs, rng, options))
+        return sizes
+
+    def measure(self, dogs, rng, options):
+        indexed, index_seconds = timed(search.rebuild)
+        columns = serializers.DogRowSerializer.columns()
+        limit = options['limit'] + 1
+        times = {'fts_first': [], 'like_first': [],
+                 'fts_next': [], 'like_next': []}
+        for i in range(options['queries']):
+            text = random_query(rng, dogs)
+            words = search.terms(text)
+            queryset = Dog.objects.filter(
+                **UserPref(**benchmark.random_prefs(rng)).dog_lookups())
+            after = rng.randrange(dogs)
+            # the queries DogSearchView runs
+            for page, seek in (('first', {}),
+                               ('next', {'search_id__gt': after})):
+                fts_rows, seconds = timed(lambda: list(
+                    search.filter_dogs(queryset, text).filter(**seek)
+                    .order_by('search_id').values(*columns)[:limit]))
+                times['fts_' + page].append(seconds)
+                _, seconds = timed(lambda: list(
+                    search.like_filter(queryset, words)
+                    .annotate(search_id=F('id')).filter(**seek)
+                    .order_by('search_id').values(*columns)[:limit]))
+                times['like_' + page].append(seconds)
+                # LIKE also matches inside words, so it may find more,
+                # but every dog the index found must match it
+                fts_ids = [row['id'] for row in fts_rows]
+                if search.like_filter(Dog.objects.filter(id__in=fts_ids),
+                                      words).count() != len(fts_ids):
+                    raise CommandError('The index found dogs not matching '
+                                       '{!r}'.format(text))
+
+        return {'dogs': dogs,
+                'indexed': indexed,
+                'index_s': round(index_seconds, 3),
+                **{name: summary(values) for name, values in times.items()}}
+
+    def report(self, sizes):
+        line = '{:<10}{:>10}{:>12}{:>12}{:>12}{:>12}'
+        self.stdout.write(line.format('dogs', 'index s', 'FTS first',
+                                      'LIKE first', 'FTS next',
+                                      'LIKE next'))
+        for size in sizes:
+            self.stdout.write(line.format(
+                size['dogs'], size['index_s'],
+                size['fts_first']['p50_ms'], size['like_first']['p50_ms'],
+                size['fts_next']['p50_ms'], size['like_next']['p50_ms']))
+        self.stdout.write('p50 milliseconds per page')
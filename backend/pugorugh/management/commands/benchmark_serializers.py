@@ -0,0 +1,52 @@
+import json
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from pugorugh import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Measure the per-dog cost of fetching, serializing and '
+            'rendering dogs with DogSerializer and with DogRowSerializer, '
+            'on a throwaway in-memory test database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dogs', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='runs of each step, the fastest counts')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true',
+                            help='print the results as JSON')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark expects the SQLite backend')
+        setup_test_environment(debug=False)
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        try:
+            benchmark.seed_dogs(options['dogs'],
+                                random.Random(options['seed']))
+            results = benchmark.serializer_costs(options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        line = '{:<8}{:>12}{:>14}{:>11}{:>11}'
+        self.stdout.write(line.format('path', 'fetch us', 'serialize us',
+                                      'render us', 'total us'))
+        for name in ('model', 'row'):
+            costs = results[name]
+            self.stdout.write(line.format(
+                name, costs['fetch_us'], costs['serialize_us'],
+                costs['render_us'], round(sum(costs.values()), 3)))
+        self.stdout.write('{} dogs, identical JSON: {}'.format(
+            results['dogs'], results['identical']))
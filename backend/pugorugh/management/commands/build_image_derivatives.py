@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import images
+from pugorugh.models import Dog
+
+
+class Command(BaseCommand):
+    help = ('Build resized JPEG and WebP derivatives of every dog photo, '
+            'skipping photos whose content has not changed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help='worker processes, default one per CPU')
+        parser.add_argument('--force', action='store_true',
+                            help='re-encode existing derivatives')
+
+    def handle(self, *args, **options):
+        if not images.pillow_available():
+            raise CommandError('Pillow is required: pip install Pillow')
+        started = time.monotonic()
+        image_filenames = (Dog.objects
+                           .values_list('image_filename', flat=True)
+                           .distinct()
+                           .iterator())
+        processed, encoded = images.build_derivatives(
+            image_filenames,
+            workers=options['workers'],
+            force=options['force'])
+        self.stdout.write('{} photos checked, {} files encoded in {:.2f}s'
+                          .format(processed, encoded,
+                                  time.monotonic() - started))
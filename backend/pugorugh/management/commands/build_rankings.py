@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import ranking
+from pugorugh import versions
+
+
+class Command(BaseCommand):
+    help = ('Compute the co-like similarity of dogs from the like history '
+            'and save the ranking model used when PUGORUGH_RANKING is on')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--neighbours', type=int, default=20,
+                            help='similar dogs kept per dog')
+        parser.add_argument('--max-likes', type=int, default=50,
+                            help='most recent likes used per user')
+        parser.add_argument('--min-support', type=int, default=1,
+                            help='users who must have liked both dogs')
+        parser.add_argument('--output', default=None,
+                            help='model file, default PUGORUGH_RANKING_MODEL')
+
+    def handle(self, *args, **options):
+        if not ranking.numpy_available():
+            raise CommandError('NumPy is required: pip install numpy')
+        started = time.monotonic()
+        model = ranking.build_model(neighbours=options['neighbours'],
+                                    max_likes=options['max_likes'],
+                                    min_support=options['min_support'])
+        path = options['output'] or ranking.model_path()
+        model.save(path)
+        versions.bump(versions.RANKING)
+        self.stdout.write(
+            '{} dogs, {} neighbour links, {:.1f} MB in memory, '
+            'saved to {} in {:.2f}s'.format(
+                len(model.dog_ids), len(model.indices),
+                model.nbytes / 1e6, path, time.monotonic() - started))
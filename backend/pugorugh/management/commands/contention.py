@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+import json
+import os
+import random
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+    teardown_test_environment
+
+from pugorugh import benchmark
+from pugorugh import contention
+from pugorugh.management.commands.benchmark import git_commit
+
+# --configs: (DATABASES entry without NAME, coalesce swipes)
+CONFIGS = {
+    'default': ({'ENGINE': 'django.db.backends.sqlite3'}, False),
+    'tuned': (settings.PUGORUGH_SQLITE_TUNED_DATABASE, False),
+    'tuned-coalesced': (settings.PUGORUGH_SQLITE_TUNED_DATABASE, True),
+}
+
+
+class Command(BaseCommand):
+    help = ('Swipe from several processes at once against copies of one '
+            'seeded SQLite file, once per database configuration, and '
+            'compare throughput, latency and "database is locked" errors')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--configs', nargs='+', choices=CONFIGS,
+                            default=list(CONFIGS),
+                            help='database configurations to compare')
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--threads', type=int, default=4,
+                            help='users swiping at once per process')
+        parser.add_argument('--swipes', type=int, default=100,
+                            help='swipes per user')
+        parser.add_argument('--dogs', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--directory', default=None,
+                            help='where to put the database files, a '
+                                 'temporary directory by default')
+        parser.add_argument('--output', default='contention.json',
+                            help='JSON results file, "-" for stdout')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark expects the SQLite backend')
+        directory = options['directory'] or tempfile.mkdtemp()
+        os.makedirs(directory, exist_ok=True)
+        seeded = os.path.join(directory, 'contention-seed.sqlite3')
+
+        setup_test_environment(debug=False)
+        connection.settings_dict['TEST']['NAME'] = seeded
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           keepdb=False, serialize=False)
+        try:
+            rng = random.Random(options['seed'])
+            dog_ids = benchmark.seed_dogs(options['dogs'], rng)
+            users = options['processes'] * options['threads']
+            usernames = benchmark.seed_users(users, dog_ids, 0, rng)
+            user_ids = list(benchmark.get_user_model().objects
+                            .filter(username__in=usernames)
+                            .values_list('id', flat=True))
+            connection.close()
+
+            results = {}
+            for name in options['configs']:
+                database, coalesce = CONFIGS[name]
+                path = os.path.join(directory,
+                                    'contention-{}.sqlite3'.format(name))
+                shutil.copyfile(seeded, path)
+                self.stderr.write('Running {}'.format(name))
+                results[name] = contention.run(
+                    dict(database, NAME=path), user_ids, dog_ids,
+                    processes=options['processes'],
+                    swipes=options['swipes'], coalesce=coalesce,
+                    seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if options['directory'] is None:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        output = json.dumps({
+            'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'config': {name: options[name] for name in (
+                'processes', 'threads', 'swipes', 'dogs', 'seed')},
+            'results': results,
+        }, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        self.report(results)
+
+    def report(self, results):
+        line = '{:<18}{:>9}{:>8}{:>11}{:>10}{:>10}{:>10}'
+        self.stdout.write(line.format('config', 'swipes', 'errors',
+                                      'swipes/s', 'p50 ms', 'p95 ms',
+                                      'p99 ms'))
+        for name, result in results.items():
+            self.stdout.write(line.format(
+                name, result['swipes'], result['errors'],
+                result['throughput_sps'], result['p50_ms'] or '',
+                result['p95_ms'] or '', result['p99_ms'] or ''))
@@ -0,0 +1,60 @@
+from os import path
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import importer
+
+DEFAULT_FILE = path.join(
+    path.dirname(path.dirname(path.dirname(path.abspath(__file__)))),
+    'static', 'dog_details.json')
+
+
+class Command(BaseCommand):
+    help = ('Import dogs from a JSON array or JSON Lines file, '
+            'streaming it in validated, bulk-written chunks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default=DEFAULT_FILE,
+                            help='JSON or JSON Lines file, "-" for stdin')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='records validated and written together')
+        parser.add_argument('--key', choices=importer.dog_fields,
+                            help='natural key, update dogs that match it '
+                                 'instead of inserting duplicates')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='validate and count without writing')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+        started = time.monotonic()
+        if options['path'] == '-':
+            stats = self.run(sys.stdin, options)
+        else:
+            try:
+                with open(options['path'], 'r', encoding='utf-8') as file:
+                    stats = self.run(file, options)
+            except OSError as error:
+                raise CommandError(error)
+        elapsed = time.monotonic() - started
+
+        for record, errors in stats.errors:
+            self.stderr.write('Invalid record {}: {}'.format(record, errors))
+        self.stdout.write(
+            '{}{} dogs in {:.2f}s ({:.0f} rows/sec): '
+            '{} created, {} updated, {} invalid'.format(
+                'Dry run, ' if options['dry_run'] else '',
+                stats.total, elapsed, stats.total / max(elapsed, 1e-9),
+                stats.created, stats.updated, stats.invalid))
+
+    def run(self, file, options):
+        try:
+            return importer.import_dogs(importer.iter_records(file),
+                                        chunk_size=options['chunk_size'],
+                                        key=options['key'],
+                                        dry_run=options['dry_run'])
+        except ValueError as error:
+            raise CommandError('Could not parse {}: {}'.format(
+                options['path'], error))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from pugorugh import counters
+from pugorugh import matchcounts
+
+
+class Command(BaseCommand):
+    help = ('Recount the like/dislike counters of dogs whose counters '
+            'drifted from their UserDog rows, e.g. after bulk writes, and '
+            'the number of dogs matching each preference combination')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report how many dogs drifted')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = counters.drifted().count()
+            self.stdout.write('{} dogs with drifted counters'.format(count))
+        else:
+            count = counters.reconcile()
+            self.stdout.write('Fixed the counters of {} dogs'.format(count))
+            count = matchcounts.rebuild()
+            self.stdout.write('Counted the dogs of {} combinations of '
+                              'gender, size and age'.format(count))
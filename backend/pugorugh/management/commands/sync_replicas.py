@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from pugorugh import routers
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database over the read replicas, '
+            'standing in for replication when trying them out locally')
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*',
+                            help='replica aliases, PUGORUGH_READ_REPLICAS '
+                                 'by default')
+
+    def handle(self, *args, **options):
+        try:
+            aliases = routers.sync_replicas(options['aliases'] or None)
+        except ValueError as error:
+            raise CommandError(error)
+        if not aliases:
+            raise CommandError('No replicas, set PUGORUGH_READ_REPLICAS '
+                               'or name them')
+        self.stdout.write('Copied the database to {}'.format(
+            ', '.join(aliases)))
@@ -0,0 +1,141 @@
+"""Number of dogs matching a set of preferences
+
+DogCount holds the number of dogs per (gender_code, size_code,
+age_bucket) combination, at most a few dozen rows. count() sums the
+rows matching UserPref.dog_lookups(), so it costs the same for ten dogs
+as for a million.
+
+Single dog saves and deletes adjust the two rows involved, in the same
+transaction as the write (see signals.py). Bulk writes announced with
+catalog_changed pass the changes of their rows, see deltas(), which are
+applied the same way; senders that do not, and migrations, rebuild the
+table. Other writes that bypass the signals, e.g. QuerySet.update() on
+the code columns, leave it off until rebuild(), also run by the
+reconcile_counts command.
+"""
+from collections import Counter
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, F, Sum
+
+from . import models
+
+MISSING = object()
+
+
+def count(lookups):
+    """Dogs matching preference lookups
+    :param lookups: UserPref.dog_lookups(), {} for every dog
+    :return: int
+    """
+    total = models.DogCount.objects.filter(**lookups).aggregate(
+        total=Sum('dogs'))['total']
+    return total or 0
+
+
+def apply(deltas):
+    """Adjust the count of each combination
+    :param deltas: dict of Dog.codes() -> change in dogs
+    """
+    for codes, delta in deltas.items():
+        if not delta:
+            continue
+        rows = models.DogCount.objects.filter(
+            **dict(zip(models.code_fields, codes)))
+        if not rows.update(dogs=F('dogs') + delta):
+            models.DogCount.objects.bulk_create(
+                [models.DogCount(**dict(zip(models.code_fields, codes)))],
+                ignore_conflicts=True)
+            rows.update(dogs=F('dogs') + delta)
+
+
+def deltas(changes):
+    """Net change per combination of a bulk write
+    :param changes: iterable of (old codes, new codes) per dog written,
+        old codes None for a created dog
+    :return: dict of Dog.codes() -> change in dogs, for apply()
+    """
+    result = Counter()
+    for old, new in changes:
+        if old == new:
+            continue
+        if old is not None:
+            result[old] -= 1
+        result[new] += 1
+    return dict(result)
+
+
+def before_save(dog):
+    """Remember the stored codes of a dog that was not loaded from the
+    database, e.g. Dog(id=1, ...).save()
+    """
+    if dog.pk is not None and getattr(dog, 'stored_codes',
+                                      MISSING) is MISSING:
+        dog.stored_codes = (models.Dog.objects
+                            .filter(pk=dog.pk)
+                            .values_list(*models.code_fields)
+                            .first())
+
+
+def after_save(dog, created):
+    codes = dog.codes()
+    previous = None if created else getattr(dog, 'stored_codes', None)
+    if previous != codes:
+        deltas = {codes: 1}
+        if previous is not None:
+            deltas[previous] = -1
+        apply(deltas)
+    dog.stored_codes = codes
+
+
+def after_delete(dog):
+    codes = getattr(dog, 'stored_codes', None) or dog.codes()
+    apply({codes: -1})
+    dog.stored_codes = None
+
+
+def counted(using=DEFAULT_DB_ALIAS):
+    """Dogs per combination, counted from the Dog table
+    :param using: database alias
+    :return: dict of Dog.codes() -> number of dogs
+    """
+    return {tuple(codes): total
+            for *codes, total in models.Dog.objects.using(using)
+            .order_by()
+            .values_list(*models.code_fields)
+            .annotate(total=Count('id'))}
+
+
+def rebuild(using=DEFAULT_DB_ALIAS):
+    """Recount every combination from the Dog table
+    :param using: database alias
+    :return: number of combinations with dogs
+    """
+    with transaction.atomic(using=using):
+        # counted in the transaction that replaces the rows, with them
+        # locked, so writes applying a delta meanwhile wait for it
+        # rather than have it overwritten by an older count
+        list(models.DogCount.objects.using(using).select_for_update()
+             .values_list('id', flat=True))
+        rows = [models.DogCount(dogs=total,
+                                **dict(zip(models.code_fields, codes)))
+                for codes, total in counted(using).items()]
+        models.DogCount.objects.using(using).delete()
+        models.DogCount.objects.using(using).bulk_create(rows)
+    return len(rows)
+
+
+def sync(using=DEFAULT_DB_ALIAS):
+    """rebuild() only when the table disagrees with the Dog table
+    :param using: database alias
+    :return: whether the table was rebuilt
+    """
+    totals = counted(using)
+    stored = {tuple(codes): dogs
+              for *codes, dogs in models.DogCount.objects.using(using)
+              .exclude(dogs=0)
+              .values_list(*models.code_fields, 'dogs')}
+    if stored == totals:
+        return False
+    rebuild(using)
+    return True
@@ -0,0 +1,294 @@
+"""Per-endpoint request metrics
+
+RequestMetricsMiddleware measures every request: wall time, number of
+database queries and time spent in them, time spent serializing and the
+response size. Measurements are aggregated per resolved URL name and
+HTTP method into fixed-bucket histograms, kept in process memory and
+exposed by views.MetricsView in the Prometheus text format.
+
+PUGORUGH_QUERY_BUDGETS caps the queries a URL name may run per request;
+going over is logged, or raises QueryBudgetExceeded when
+PUGORUGH_QUERY_BUDGET_STRICT is set, as in the test suite's budget tests.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager, ExitStack
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.renderers import BaseRenderer
+
+logger = logging.getLogger(__name__)
+
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0)
+query_buckets = (1, 2, 3, 4, 5, 8, 13, 21, 34, 55, 100)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# name -> (help text, buckets)
+histograms = {
+    'request_duration_seconds': ('Wall time of the request',
+                                 duration_buckets),
+    'db_queries': ('Database queries run by the request', query_buckets),
+    'db_duration_seconds': ('Time spent in database queries',
+                            duration_buckets),
+    'serializer_duration_seconds': ('Time spent serializing responses',
+                                    duration_buckets),
+    'response_size_bytes': ('Size of the response body', size_buckets),
+}
+
+UNRESOLVED = '<unresolved>'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as in the Prometheus data model"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Pairs of (upper bound, observations at or below it), ending
+        with ('+Inf', count)
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry:
+    """Histograms per (metric name, URL name, method)"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, method, values):
+        """Record one request
+        :param endpoint: URL name
+        :param method: HTTP method
+        :param values: dict of metric name -> value, None to skip one
+        """
+        with self._lock:
+            for name, value in values.items():
+                if value is None:
+                    continue
+                key = (name, endpoint, method)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = Histogram(histograms[name][1])
+                    self._histograms[key] = histogram
+                histogram.observe(value)
+
+    def snapshot(self):
+        """Copy of every histogram
+        :return: dict of metric name -> list of dicts with endpoint,
+            method, count, sum and cumulative buckets
+        """
+        result = {name: [] for name in histograms}
+        with self._lock:
+            for (name, endpoint, method), histogram in sorted(
+                    self._histograms.items()):
+                result[name].append({'endpoint': endpoint,
+                                     'method': method,
+                                     'count': histogram.count,
+                                     'sum': histogram.sum,
+                                     'buckets': histogram.cumulative()})
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+registry = Registry()
+
+
+class RequestState:
+    """What the current request has spent so far, including in the
+    pool.task_pool threads it submits work to
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self._lock = threading.Lock()
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.db_time += elapsed
+                self.queries += 1
+
+
+_local = threading.local()
+
+
+def current_state():
+    """RequestState of the request being handled by this thread, None
+    outside of RequestMetricsMiddleware
+    """
+    return getattr(_local, 'state', None)
+
+
+@contextmanager
+def measured(state):
+    """Count the queries this thread runs inside the block into state,
+    e.g. in a pool thread working for a request
+    :param state: RequestState
+    """
+    previous = current_state()
+    _local.state = state
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(state.execute_wrapper))
+            yield state
+    finally:
+        _local.state = previous
+
+
+class TimedSerializerMixin:
+    """Adds the time spent in to_representation to the request's
+    serializer time; nested serializers are only counted once
+    """
+
+    def to_representation(self, instance):
+        state = current_state()
+        if state is None:
+            return super().to_representation(instance)
+        state.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            state.serializer_depth -= 1
+            if not state.serializer_depth:
+                state.serializer_time += time.perf_counter() - started
+
+
+def response_size(response):
+    if response.streaming:
+        size = response.get('Content-Length')
+        return int(size) if size else None
+    return len(response.content)
+
+
+def check_query_budget(endpoint, method, queries):
+    """Log or raise when a request ran more queries than its budget,
+    looked up as 'url_name:METHOD' first, then 'url_name'
+    :param endpoint: URL name
+    :param method: HTTP method
+    :param queries: queries run by the request
+    """
+    budgets = getattr(settings, 'PUGORUGH_QUERY_BUDGETS', {})
+    budget = budgets.get('{}:{}'.format(endpoint, method),
+                         budgets.get(endpoint))
+    if budget is None or queries <= budget:
+        return
+    message = '{} {} ran {} queries, over its budget of {}'.format(
+        method, endpoint, queries, budget)
+    if getattr(settings, 'PUGORUGH_QUERY_BUDGET_STRICT', False):
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RequestState()
+        started = time.perf_counter()
+        with measured(state):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        endpoint = (match.url_name if match and match.url_name
+                    else UNRESOLVED)
+        registry.observe(endpoint, request.method, {
+            'request_duration_seconds': duration,
+            'db_queries': state.queries,
+            'db_duration_seconds': state.db_time,
+            'serializer_duration_seconds': state.serializer_time,
+            'response_size_bytes': response_size(response),
+        })
+        check_query_budget(endpoint, request.method, state.queries)
+        return response
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_prometheus(snapshot, caches=None, prefix='pugorugh_'):
+    """Render a Registry snapshot in the Prometheus text format
+    :param snapshot: Registry.snapshot() output
+    :param caches: optional dict of cache name -> LRUCache.stats()
+    :param prefix: metric name prefix
+    :return: str
+    """
+    lines = []
+    for name, series in snapshot.items():
+        metric = prefix + name
+        lines.append('# HELP {} {}'.format(metric, histograms[name][0]))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for item in series:
+            labels = 'endpoint="{}",method="{}"'.format(
+                escape_label(item['endpoint']), escape_label(item['method']))
+            for bound, count in item['buckets']:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, labels, bound, count))
+            lines.append('{}_sum{{{}}} {}'.format(metric, labels,
+                                                 item['sum']))
+            lines.append('{}_count{{{}}} {}'.format(metric, labels,
+                                                   item['count']))
+    for stat, kind in (('hits', 'counter'), ('misses', 'counter'),
+                       ('size', 'gauge'), ('maxsize', 'gauge')):
+        if not caches:
+            break
+        metric = '{}cache_{}'.format(prefix, stat)
+        if kind == 'counter':
+            metric += '_total'
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for cache, stats in sorted(caches.items()):
+            lines.append('{}{{cache="{}"}} {}'.format(
+                metric, escape_label(cache), stats[stat]))
+    return '\n'.join(lines) + '\n'
+
+
+class PrometheusRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if 'histograms' not in data:
+            # error responses, e.g. permission denied
+            return '{}\n'.format(data.get('detail', ''))
+        return format_prometheus(data['histograms'], data.get('caches'))
@@ -1,6 +1,10 @@
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.utils import timezone
+
+from .cache import LRUCache
 
 dog_genders = ['m', 'f', 'u']
 dog_sizes = ['s', 'm', 'l', 'xl', 'u']
@@ -8,6 +12,57 @@ userdog_statuses = ['l', 'd']
 userpref_genders = ['m', 'f']
 userpref_sizes = ['s', 'm', 'l', 'xl']
 userpref_ages = ['b', 'y', 'a', 's']
+# age in months, inclusive
+userpref_age_ranges = {'b': (0, 6), 'y': (7, 23), 'a': (24, 70),
+                       's': (71, 360)}
+# Version counter numbering catalog writes, see Dog.change_seq
+dog_changes_key = 'dog-changes'
+
+
+def encode_choices(values, choices):
+    """Encode comma-separated choices as a bitmask, bit i for choices[i]
+    :param values: string like 'm,f', may be empty
+    :param choices: list of allowed values
+    :return: int bitmask
+    """
+    mask = 0
+    for value in filter(None, values.split(',')):
+        try:
+            mask |= 1 << choices.index(value)
+        except ValueError:
+            raise ValueError('{} is not in {}'.format(value, choices))
+    return mask
+
+
+def decode_choices(mask, choices):
+    """Inverse of encode_choices
+    :param mask: int bitmask
+    :param choices: list of allowed values
+    :return: comma-separated string, in choices order
+    """
+    return ','.join(choice for i, choice in enumerate(choices)
+                    if mask & (1 << i))
+
+
+def mask_bits(mask):
+    """Split a bitmask into its single-bit values
+    :param mask: int bitmask
+    :return: list of ints, e.g. 5 -> [1, 4]
+    """
+    return [1 << i for i in range(mask.bit_length()) if mask & (1 << i)]
+
+
+def age_bucket(age):
+    """Single-bit code of the userpref age group an age falls into
+    :param age: age in months or None
+    :return: bit for the matching userpref_ages value, 0 if none
+    """
+    if age is not None:
+        for i, code in enumerate(userpref_ages):
+            low, high = userpref_age_ranges[code]
+            if low <= age <= high:
+                return 1 << i
+    return 0
 
 
 def validate_dog_gender(value):
@@ -81,6 +136,124 @@ def validate_userpref_age(value):
                 'Must be {}, comma separated'.format(userpref_ages))
 
 
+class ChoiceMaskField(models.CharField):
+    """Comma-separated choices stored as an integer bitmask
+
+    Reads and writes the same 'm,f' strings as a CharField, so validators
+    and serializers are unaffected, while the column holds a small int.
+    """
+
+    def __init__(self, *args, choice_list=(), **kwargs):
+        self.choice_list = list(choice_list)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['choice_list'] = self.choice_list
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        return 'PositiveSmallIntegerField'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or isinstance(value, str):
+            # str are rows written before the column was a bitmask
+            return value
+        return decode_choices(value, self.choice_list)
+
+    def to_python(self, value):
+        if isinstance(value, int):
+            return decode_choices(value, self.choice_list)
+        return super().to_python(value)
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        return encode_choices(value, self.choice_list)
+
+
+# Dog columns matched against UserPref, see UserPref.dog_lookups
+code_fields = ('gender_code', 'size_code', 'age_bucket')
+
+
+class DogQuerySet(models.QuerySet):
+
+    def for_userpref(self, user, version=None):
+        """Filter dogs by the user's preferences, if the user has any
+        :param user: User instance or id
+        :param version: see UserPref.cached_dog_lookups
+        :return: filtered queryset
+        """
+        return self.filter(**UserPref.cached_dog_lookups(user, version))
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        if not objs:
+            return super().bulk_create(objs, *args, **kwargs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            change_seq = Version.take(dog_changes_key, self.db)
+            for obj in objs:
+                obj.encode_attributes()
+                obj.change_seq = change_seq
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        fields = list(fields) + ['gender_code', 'size_code', 'age_bucket',
+                                 'change_seq']
+        with transaction.atomic(using=self.db, savepoint=False):
+            change_seq = Version.take(dog_changes_key, self.db)
+            for obj in objs:
+                obj.encode_attributes()
+                obj.change_seq = change_seq
+            return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def stale_codes(self):
+        """Dogs whose code columns disagree with their gender, size or
+        age, e.g. rows written before the columns existed
+        :return: filtered queryset
+        """
+        Q = models.Q
+        stale = ((~Q(gender__in=dog_genders) & ~Q(gender_code=0)) |
+                 (~Q(size__in=dog_sizes) & ~Q(size_code=0)))
+        for i, gender in enumerate(dog_genders):
+            stale |= Q(gender=gender) & ~Q(gender_code=1 << i)
+        for i, size in enumerate(dog_sizes):
+            stale |= Q(size=size) & ~Q(size_code=1 << i)
+        any_group = Q()
+        for i, age in enumerate(userpref_ages):
+            low, high = userpref_age_ranges[age]
+            group = Q(age__gte=low, age__lte=high)
+            stale |= group & ~Q(age_bucket=1 << i)
+            any_group |= group
+        stale |= ~any_group & ~Q(age_bucket=0)
+        return self.filter(stale)
+
+    def encode_attributes(self):
+        """Recompute the code columns of every dog in the queryset
+        with set-based updates, e.g. after the columns were added
+        """
+        for i, gender in enumerate(dog_genders):
+            self.filter(gender=gender).update(gender_code=1 << i)
+        self.exclude(gender__in=dog_genders).update(gender_code=0)
+        for i, size in enumerate(dog_sizes):
+            self.filter(size=size).update(size_code=1 << i)
+        self.exclude(size__in=dog_sizes).update(size_code=0)
+        self.update(age_bucket=0)
+        for i, age in enumerate(userpref_ages):
+            low, high = userpref_age_ranges[age]
+            self.filter(age__gte=low, age__lte=high).update(
+                age_bucket=1 << i)
+
+    def undecided_by(self, user):
+        """Exclude dogs the user has already liked or disliked
+        :param user: User instance
+        :return: filtered queryset
+        """
+        return self.exclude(userdog__user=user)
+
+
 class Dog(models.Model):
     name = models.CharField(max_length=100)
     image_filename = models.CharField(max_length=100)
@@ -93,10 +266,76 @@ class Dog(models.Model):
     size = models.CharField(max_length=5,
                             blank=True,
                             validators=[validate_dog_size])
+    # single-bit codes of gender, size and age group, matched against
+    # the UserPref bitmasks; kept in sync by encode_attributes
+    gender_code = models.PositiveSmallIntegerField(default=0,
+                                                   editable=False)
+    size_code = models.PositiveSmallIntegerField(default=0,
+                                                 editable=False)
+    age_bucket = models.PositiveSmallIntegerField(default=0,
+                                                  editable=False)
+    # number of UserDog rows per status, kept up to date by swipes.py
+    # and repaired by the reconcile_counts command; not unsigned, so a
+    # drifted counter cannot make a swipe fail
+    like_count = models.IntegerField(default=0, editable=False)
+    dislike_count = models.IntegerField(default=0, editable=False)
+    # last save of the catalog fields; the counters above are updated
+    # without touching it
+    updated_at = models.DateTimeField(auto_now=True)
+    # number of the last write of the catalog fields, taken from the
+    # dog_changes_key counter in the write's transaction, so numbers
+    # follow commit order; exports of the changes since a number filter
+    # on it, see export.py
+    change_seq = models.PositiveIntegerField(default=0, editable=False,
+                                             db_index=True)
+
+    objects = DogQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # serves the userpref filter in DogQuerySet.for_userpref
+            models.Index(fields=['gender_code', 'size_code', 'age_bucket',
+                                 'id'],
+                         name='dog_codes_id_idx'),
+            # serves the most liked dogs, see PopularDogView
+            models.Index(fields=['-like_count', 'id'],
+                         name='dog_like_count_id_idx'),
+        ]
 
     def __str__(self):
         return '{} {} {}'.format(self.name, self.breed, self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        dog = super().from_db(db, field_names, values)
+        if all(field in field_names for field in code_fields):
+            # the codes as stored, so matchcounts can tell what changed
+            dog.stored_codes = dog.codes()
+        return dog
+
+    def codes(self):
+        """(gender_code, size_code, age_bucket), see DogCount"""
+        return tuple(getattr(self, field) for field in code_fields)
+
+    def encode_attributes(self):
+        """Derive the code columns from gender, size and age"""
+        self.gender_code = encode_choices(
+            self.gender if self.gender in dog_genders else '', dog_genders)
+        self.size_code = encode_choices(
+            self.size if self.size in dog_sizes else '', dog_sizes)
+        self.age_bucket = age_bucket(self.age)
+
+    def save(self, *args, **kwargs):
+        self.encode_attributes()
+        using = kwargs.get('using') or router.db_for_write(Dog,
+                                                           instance=self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = list(kwargs['update_fields']) + [
+                'change_seq']
+        with transaction.atomic(using=using, savepoint=False):
+            self.change_seq = Version.take(dog_changes_key, using)
+            super().save(*args, **kwargs)
+
 
 class UserDog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -105,18 +344,157 @@ class UserDog(models.Model):
                             on_delete=models.CASCADE)
     status = models.CharField(max_length=1,
                               validators=[validate_userdog_status])
-    unique_together = (user, dog)
+
+    class Meta:
+        unique_together = ('user', 'dog')
+        indexes = [
+            # serves the liked/disliked listings in DogView
+            models.Index(fields=['user', 'status', 'dog'],
+                         name='userdog_user_status_dog_idx'),
+        ]
+
+
+class DogCount(models.Model):
+    """Number of dogs with each combination of code columns
+
+    Preferences match whole combinations, so the dogs matching any
+    UserPref are counted by summing a few of these rows, with the same
+    lookups, instead of counting dogs. Kept up to date by matchcounts.py.
+    """
+    gender_code = models.PositiveSmallIntegerField()
+    size_code = models.PositiveSmallIntegerField()
+    age_bucket = models.PositiveSmallIntegerField()
+    # signed, so a drifted count cannot make a dog write fail
+    dogs = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = code_fields
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.gender_code, self.size_code,
+                                     self.age_bucket, self.dogs)
+
+
+class DeletedDog(models.Model):
+    """A dog that was deleted, so exports of the changes since a number
+    can tell clients to drop it; written by signals.py
+    """
+    dog_id = models.IntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+    # see Dog.change_seq
+    change_seq = models.PositiveIntegerField(db_index=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.dog_id, self.deleted_at)
+
+
+# (version, parsed UserPref.dog_lookups()) per user id, see
+# UserPref.cached_dog_lookups
+userpref_cache = LRUCache(
+    maxsize=getattr(settings, 'PUGORUGH_USERPREF_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'PUGORUGH_USERPREF_CACHE_TTL', None),
+    backend=getattr(settings, 'PUGORUGH_USERPREF_CACHE_BACKEND', None),
+    prefix='pugorugh:userpref')
 
 
 class UserPref(models.Model):
     user = models.OneToOneField(User,
                                 on_delete=models.CASCADE)
-    age = models.CharField(max_length=10,
-                           validators=[validate_userpref_age],
+    age = ChoiceMaskField(max_length=10,
+                          choice_list=userpref_ages,
+                          validators=[validate_userpref_age],
+                          blank=True)
+    gender = ChoiceMaskField(max_length=10,
+                             choice_list=dog_genders,
+                             validators=[validate_userpref_gender],
+                             blank=True)
+    size = ChoiceMaskField(max_length=10,
+                           choice_list=dog_sizes,
+                           validators=[validate_userpref_size],
                            blank=True)
-    gender = models.CharField(max_length=10,
-                              validators=[validate_userpref_gender],
-                              blank=True)
-    size = models.CharField(max_length=10,
-                            validators=[validate_userpref_size],
-                            blank=True)
+
+    def dog_lookups(self):
+        """Dog queryset lookups matching these preferences,
+        no age preference means any age
+        :return: dict for Dog.objects.filter
+        """
+        lookups = {
+            'gender_code__in': mask_bits(
+                encode_choices(self.gender, dog_genders)),
+            'size_code__in': mask_bits(encode_choices(self.size, dog_sizes)),
+        }
+        if self.age:
+            lookups['age_bucket__in'] = mask_bits(
+                encode_choices(self.age, userpref_ages))
+        return lookups
+
+    @classmethod
+    def cached_dog_lookups(cls, user, version=None):
+        """dog_lookups() of the user's preferences, served from
+        userpref_cache; an empty dict when the user has none
+
+        Entries carry the user's versions.userpref_key counter and are
+        reloaded once it moved on, so saves made by other processes
+        show up on the next call. QuerySet.update() does not bump the
+        counter and is not supported on UserPref.
+        :param user: User instance or id
+        :param version: current value of the counter, e.g. from the
+            request's versions; read from the database when None
+        :return: dict for Dog.objects.filter
+        """
+        # versions imports this module
+        from . import versions
+        user_id = getattr(user, 'pk', user)
+        if version is None:
+            key = versions.userpref_key(user_id)
+            version = versions.get_versions([key])[key][0]
+        cached = userpref_cache.get(user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        try:
+            # from the primary, as the counter is: a lagging replica
+            # would cache old preferences under the new version
+            lookups = (cls.objects.using(DEFAULT_DB_ALIAS)
+                       .get(user=user_id).dog_lookups())
+        except ObjectDoesNotExist:
+            lookups = {}
+        userpref_cache.set(user_id, (version, lookups))
+        return lookups
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        """Forget the cached preferences of a user
+        :param user_id: User id
+        """
+        userpref_cache.delete(user_id)
+
+
+class Version(models.Model):
+    """Change counter for a slice of data, e.g. the dog catalog or one
+    user's preferences; bumped on writes, see versions.py
+    """
+    key = models.CharField(max_length=100, unique=True)
+    value = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.key, self.value)
+
+    @classmethod
+    def take(cls, key, using=DEFAULT_DB_ALIAS):
+        """Increment the counter for key and return its new value
+
+        Call it inside the transaction of the write being numbered: the
+        row stays locked until that transaction ends, so the values are
+        handed out in commit order.
+        :param key: version key, e.g. dog_changes_key
+        :param using: database alias
+        :return: int
+        """
+        counters = cls.objects.using(using).filter(key=key)
+        if not counters.update(value=models.F('value') + 1,
+                               modified=timezone.now()):
+            cls.objects.using(using).get_or_create(key=key)
+            counters.update(value=models.F('value') + 1,
+                            modified=timezone.now())
+        return counters.values_list('value', flat=True).get()
@@ -0,0 +1,87 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+def encode_cursor(value):
+    """Opaque cursor for the last key seen
+    :param value: int key
+    :return: url-safe string
+    """
+    return urlsafe_b64encode(str(value).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor
+    :param cursor: string from encode_cursor
+    :return: int key, raise NotFound if the cursor is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise NotFound('Invalid cursor')
+
+
+class KeysetPagination(BasePagination):
+    """Seek pagination on an increasing integer key
+
+    Each page is a single "key > last seen key ORDER BY key LIMIT n"
+    query, however deep the client is, unlike offset pagination. The
+    response carries an opaque cursor for the next page.
+    """
+    key = 'id'
+    page_size = 10
+    max_page_size = 100
+    page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_after(self, request, default=None):
+        """Key to resume after, from the cursor query param
+        :param request: Request
+        :param default: key used when there is no cursor
+        :return: int key or default
+        """
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor is None:
+            return default
+        return decode_cursor(cursor)
+
+    def paginate_queryset(self, queryset, request, view=None, after=None):
+        self.page_size_used = self.get_page_size(request)
+        after = self.get_after(request, after)
+        if after is not None:
+            queryset = queryset.filter(**{self.key + '__gt': after})
+        rows = list(queryset.order_by(self.key)[:self.page_size_used + 1])
+        return self.paginate_rows(rows)
+
+    def paginate_rows(self, rows):
+        """Trim a fetched page of page size + 1 rows and remember whether
+        there is a next one
+        :param rows: model instances or .values() dicts, ordered by key
+        :return: rows of this page
+        """
+        self.has_next = len(rows) > self.page_size_used
+        rows = rows[:self.page_size_used]
+        self.last_key = None
+        if rows:
+            last = rows[-1]
+            self.last_key = (last[self.key] if isinstance(last, dict)
+                             else getattr(last, self.key))
+        return rows
+
+    def get_paginated_response(self, data):
+        next_cursor = None
+        if self.has_next:
+            next_cursor = encode_cursor(self.last_key)
+        return Response({'results': data, 'next': next_cursor})
@@ -0,0 +1,68 @@
+"""Bounded thread pools for blocking database work
+
+The ORM is synchronous, so concurrency comes from threads, and the pools
+bound how many run at once. request_pool runs whole requests for
+asgi.ASGIHandler. task_pool overlaps independent pieces of work within
+one request, see views.DogSwipeView. Tasks must not submit to task_pool
+themselves, or a full pool could wait on itself.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import metrics
+
+
+class BoundedPool:
+    """ThreadPoolExecutor created on first use, sized by a setting"""
+
+    def __init__(self, setting, default, name):
+        self.setting = setting
+        self.default = default
+        self.name = name
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, self.setting,
+                                        self.default),
+                    thread_name_prefix=self.name)
+            return self._executor
+
+    def submit(self, function, *args, **kwargs):
+        """Run function in the pool, in a copy of the caller's context
+        (see routers) and with its queries counted towards the caller's
+        request metrics, then release the thread's database connections
+        the way the end of a request would
+        :return: Future
+        """
+        return self.executor.submit(copy_context().run, call_and_close,
+                                    function, args, kwargs,
+                                    metrics.current_state())
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+def call_and_close(function, args, kwargs, state=None):
+    try:
+        if state is None:
+            return function(*args, **kwargs)
+        with metrics.measured(state):
+            return function(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+request_pool = BoundedPool('PUGORUGH_ASGI_THREADS', 16, 'pugorugh-request')
+task_pool = BoundedPool('PUGORUGH_TASK_THREADS', 8, 'pugorugh-task')
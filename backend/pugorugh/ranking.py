@@ -0,0 +1,309 @@
+"""Per-user ordering of undecided dogs
+
+build_model(), run offline by the build_rankings command, derives an
+item-item similarity from co-likes: two dogs are similar when the same
+users liked both (cosine over the user x dog like matrix). Only the top
+neighbours of each dog are kept, in compressed sparse row arrays, next
+to the dogs' attribute codes, and saved as one .npz file.
+
+When a user's candidate queue is built, rank() scores the candidates by
+their similarity to the dogs the user liked (and, less strongly, to the
+ones they disliked) plus the user's like rate for their breed, size,
+age bucket and gender. Users without a like yet, and processes without
+NumPy or a model file, keep the plain id order.
+
+NumPy is an optional dependency, only needed when PUGORUGH_RANKING is on.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from . import models
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# How the signals are blended into one score
+SIMILARITY_WEIGHT = 1.0
+AFFINITY_WEIGHT = 1.0
+DISLIKE_WEIGHT = 0.5
+# Pseudo-count pulling attribute like rates towards the user's overall rate
+SMOOTHING = 2.0
+
+attribute_columns = ('size_code', 'age_bucket', 'gender_code', 'breed_code')
+
+
+def numpy_available():
+    return np is not None
+
+
+def enabled():
+    return np is not None and getattr(settings, 'PUGORUGH_RANKING', False)
+
+
+class RankingModel:
+    """Dog attribute codes and top-k co-like neighbours
+
+    dog_ids is sorted; row i of every other column, and of the sparse
+    neighbour matrix (indptr, indices, weights), describes dog_ids[i].
+    indices are rows too, not dog ids.
+    """
+    fields = ('dog_ids',) + attribute_columns + ('indptr', 'indices',
+                                                 'weights')
+
+    def __init__(self, dog_ids, size_code, age_bucket, gender_code,
+                 breed_code, indptr, indices, weights):
+        self.dog_ids = dog_ids
+        self.size_code = size_code
+        self.age_bucket = age_bucket
+        self.gender_code = gender_code
+        self.breed_code = breed_code
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in cls.fields})
+
+    def save(self, path):
+        """Write the arrays to path, replacing it atomically"""
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, **{name: getattr(self, name)
+                               for name in self.fields})
+        os.replace(temp_path, path)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.fields)
+
+    def index_of(self, dog_ids):
+        """Model row of each dog id, -1 for dogs built after the model
+        :param dog_ids: sequence of ints
+        :return: int64 array
+        """
+        dog_ids = np.asarray(dog_ids, dtype=np.int64)
+        if not len(self.dog_ids):
+            return np.full(len(dog_ids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.dog_ids, dog_ids),
+                          len(self.dog_ids) - 1)
+        return np.where(self.dog_ids[rows] == dog_ids, rows, -1)
+
+    def similarity(self, rows, row_weights):
+        """Weighted sum of the neighbour rows of rows
+        :param rows: array of model rows
+        :param row_weights: array, weight of each row
+        :return: float array over all model rows
+        """
+        scores = np.zeros(len(self.dog_ids), dtype=np.float64)
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        if not lengths.sum():
+            return scores
+        # positions of every neighbour of every row, in one array
+        offsets = (np.arange(lengths.sum())
+                   + np.repeat(starts - np.cumsum(lengths) + lengths,
+                               lengths))
+        np.add.at(scores, self.indices[offsets],
+                  self.weights[offsets] * np.repeat(row_weights, lengths))
+        return scores
+
+    def score(self, liked_ids, disliked_ids, candidate_ids):
+        """Score candidates for a user, higher is better
+        :param liked_ids: ids of the dogs the user liked
+        :param disliked_ids: ids of the dogs the user disliked
+        :param candidate_ids: ids to score
+        :return: float array aligned with candidate_ids
+        """
+        liked = self.index_of(liked_ids)
+        liked = liked[liked >= 0]
+        disliked = self.index_of(disliked_ids)
+        disliked = disliked[disliked >= 0]
+        candidates = self.index_of(candidate_ids)
+        known = candidates >= 0
+        rows = candidates[known]
+        scores = np.zeros(len(candidates), dtype=np.float64)
+        if not (len(liked) + len(disliked)):
+            return scores
+
+        similarity = self.similarity(
+            np.concatenate([liked, disliked]),
+            np.concatenate([np.ones(len(liked)),
+                            np.full(len(disliked), -DISLIKE_WEIGHT)]))
+        scores[known] += (SIMILARITY_WEIGHT * similarity[rows]
+                          / (len(liked) + len(disliked)))
+
+        base = ((len(liked) + SMOOTHING / 2)
+                / (len(liked) + len(disliked) + SMOOTHING))
+        for column in attribute_columns:
+            values = getattr(self, column)
+            size = int(values.max()) + 1
+            likes = np.bincount(values[liked], minlength=size)
+            dislikes = np.bincount(values[disliked], minlength=size)
+            rate = ((likes + SMOOTHING * base)
+                    / (likes + dislikes + SMOOTHING) - base)
+            scores[known] += AFFINITY_WEIGHT * rate[values[rows]]
+        return scores
+
+
+def load_dogs():
+    """Attribute columns of every dog, in id order, breeds as codes"""
+    breeds = {}
+    dog_ids, sizes, ages, genders, breed_codes = [], [], [], [], []
+    queryset = models.Dog.objects.order_by('id').values_list(
+        'id', 'size_code', 'age_bucket', 'gender_code', 'breed')
+    for dog_id, size, age, gender, breed in queryset.iterator():
+        dog_ids.append(dog_id)
+        sizes.append(size)
+        ages.append(age)
+        genders.append(gender)
+        breed_codes.append(breeds.setdefault(breed, len(breeds)))
+    return (np.array(dog_ids, dtype=np.int64),
+            np.array(sizes, dtype=np.uint8),
+            np.array(ages, dtype=np.uint8),
+            np.array(genders, dtype=np.uint8),
+            np.array(breed_codes, dtype=np.int32))
+
+
+def segment_ranks(keys):
+    """Position of each element within its run of equal sorted keys"""
+    if not len(keys):
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    lengths = np.diff(np.r_[starts, len(keys)])
+    return np.arange(len(keys)) - np.repeat(starts, lengths)
+
+
+def build_model(neighbours=20, max_likes=50, min_support=1):
+    """Compute the co-like similarity of every dog from UserDog
+    :param neighbours: neighbours kept per dog
+    :param max_likes: most recent likes per user taken into account,
+        bounds the pairs per user to max_likes ** 2 / 2
+    :param min_support: users who must have liked both dogs of a pair
+    :return: RankingModel
+    """
+    dog_ids, size_code, age_bucket, gender_code, breed_code = load_dogs()
+    count = len(dog_ids)
+    likes = np.fromiter(
+        (value for row in models.UserDog.objects
+         .filter(status='l')
+         .order_by('user_id', '-id')
+         .values_list('user_id', 'dog_id').iterator()
+         for value in row),
+        dtype=np.int64).reshape(-1, 2)
+    users = likes[:, 0]
+    items = np.searchsorted(dog_ids, likes[:, 1]) if count else likes[:, 1]
+    keep = segment_ranks(users) < max_likes
+    users, items = users[keep], items[keep]
+    likers = np.bincount(items, minlength=count)
+
+    # each pair of dogs liked by the same user, as lower * count + higher
+    pairs = []
+    for offset in range(1, max_likes):
+        same = users[offset:] == users[:-offset]
+        if not same.any():
+            break
+        first, second = items[:-offset][same], items[offset:][same]
+        pairs.append(np.minimum(first, second) * count
+                     + np.maximum(first, second))
+    if pairs:
+        keys, support = np.unique(np.concatenate(pairs), return_counts=True)
+    else:
+        keys = support = np.zeros(0, dtype=np.int64)
+    supported = support >= min_support
+    keys, support = keys[supported], support[supported]
+    lower, higher = keys // max(count, 1), keys % max(count, 1)
+    similarity = support / np.sqrt(likers[lower] * likers[higher])
+
+    # both directions, then the best neighbours of each row
+    rows = np.concatenate([lower, higher])
+    columns = np.concatenate([higher, lower])
+    weights = np.concatenate([similarity, similarity])
+    order = np.lexsort((columns, -weights, rows))
+    rows, columns, weights = rows[order], columns[order], weights[order]
+    keep = segment_ranks(rows) < neighbours
+    rows, columns, weights = rows[keep], columns[keep], weights[keep]
+    indptr = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=count), out=indptr[1:])
+    return RankingModel(dog_ids, size_code, age_bucket, gender_code,
+                        breed_code, indptr, columns.astype(np.int32),
+                        weights.astype(np.float32))
+
+
+def model_path():
+    return getattr(settings, 'PUGORUGH_RANKING_MODEL',
+                   os.path.join(settings.BASE_DIR, 'rankings.npz'))
+
+
+class ModelCache:
+    """The saved model, reloaded when the file changes (checked at most
+    once per interval seconds)
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.model = None
+        self.generation = None
+        self._path = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Current RankingModel, None when there is no model file"""
+        now = time.monotonic()
+        path = model_path()
+        if now - self._checked >= self.interval or path != self._path:
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    mtime = None
+                generation = (path, mtime) if mtime else None
+                if generation != self.generation or path != self._path:
+                    self.model = RankingModel.load(path) if mtime else None
+                    self.generation = generation
+                    self._path = path
+        return self.model
+
+
+model_cache = ModelCache()
+
+
+def generation():
+    """Identifies the model candidate queues were ranked with, None when
+    ranking is off or there is no model
+    """
+    if not enabled():
+        return None
+    model_cache.get()
+    return model_cache.generation
+
+
+def rank(user_id, candidate_ids):
+    """Order candidates for a user, best first
+    :param user_id: User id
+    :param candidate_ids: list of dog ids
+    :return: list of dog ids, None to keep the id order
+    """
+    if not enabled() or not candidate_ids:
+        return None
+    model = model_cache.get()
+    if model is None:
+        return None
+    history = list(models.UserDog.objects
+                   .filter(user_id=user_id)
+                   .values_list('dog_id', 'status'))
+    liked = [dog_id for dog_id, status in history if status == 'l']
+    if not liked:
+        return None
+    disliked = [dog_id for dog_id, status in history if status == 'd']
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    scores = model.score(liked, disliked, candidate_ids)
+    # ties keep the id order
+    return candidate_ids[np.lexsort((candidate_ids, -scores))].tolist()
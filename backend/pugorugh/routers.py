@@ -0,0 +1,136 @@
+"""Read replica routing
+
+ReplicaRouter sends reads of the dog catalog and of user preferences to
+the DATABASES aliases in PUGORUGH_READ_REPLICAS, and everything else,
+writes included, to the primary ('default'). With no replicas listed
+it leaves routing to Django.
+
+Replicas lag behind the primary, so a user who just swiped could be
+shown the dog again. Reads are therefore pinned to the primary:
+
+- for the rest of a request once it writes, or for the whole request
+  when its method is not a safe one
+- inside a transaction on the primary
+- for PUGORUGH_REPLICA_PIN_SECONDS after a write, through a cookie set
+  by ReplicaPinningMiddleware, so the client's next requests read their
+  own writes
+
+The pin is kept in a context variable; pool.BoundedPool copies it into
+the tasks a request submits.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+# models whose reads may be served by a replica, as model._meta.label_lower
+replica_models = ('pugorugh.deleteddog', 'pugorugh.dog', 'pugorugh.dogcount',
+                  'pugorugh.userpref')
+
+PIN_COOKIE = 'pugorugh_pinned'
+safe_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+
+class RoutingState:
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('pugorugh_routing_state', default=None)
+
+
+def replicas():
+    """DATABASES aliases serving catalog and preference reads"""
+    return getattr(settings, 'PUGORUGH_READ_REPLICAS', [])
+
+
+def is_pinned():
+    """Whether reads must come from the primary in this context"""
+    state = _state.get()
+    if state is not None and (state.pinned or state.wrote):
+        return True
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+@contextmanager
+def routing(pinned=False):
+    """Track writes and pinning for the code run inside, e.g. a request
+    :param pinned: read from the primary from the start
+    :return: the RoutingState
+    """
+    state = RoutingState(pinned)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases:
+            return None
+        if model._meta.label_lower in replica_models and not is_pinned():
+            return random.choice(aliases)
+        # rows read from a replica still relate to the primary's
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if not replicas():
+            return None
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = replicas()
+        if not aliases:
+            return None
+        allowed = {DEFAULT_DB_ALIAS, *aliases}
+        if obj1._state.db in allowed and obj2._state.db in allowed:
+            return True
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """Pin the reads of a request to the primary after the client wrote"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned = (request.method not in safe_methods
+                  or PIN_COOKIE in request.COOKIES)
+        with routing(pinned) as state:
+            response = self.get_response(request)
+            wrote = state.wrote or request.method not in safe_methods
+        if wrote and replicas():
+            response.set_cookie(
+                PIN_COOKIE, '1', httponly=True,
+                max_age=getattr(settings, 'PUGORUGH_REPLICA_PIN_SECONDS', 5))
+        return response
+
+
+def sync_replicas(aliases=None):
+    """Copy the primary SQLite database over its replicas, standing in for
+    replication in development and tests
+    :param aliases: replica aliases, PUGORUGH_READ_REPLICAS by default
+    :return: list of the aliases copied to
+    """
+    source = connections[DEFAULT_DB_ALIAS]
+    aliases = list(replicas() if aliases is None else aliases)
+    for alias in aliases + [DEFAULT_DB_ALIAS]:
+        if connections[alias].vendor != 'sqlite':
+            raise ValueError('{} is not a SQLite database'.format(alias))
+    source.ensure_connection()
+    for alias in aliases:
+        target = connections[alias]
+        target.ensure_connection()
+        source.connection.backup(target.connection)
+    return aliases
@@ -0,0 +1,189 @@
+"""Full text search over dog names and breeds
+
+Dog.name and Dog.breed have no index a LIKE '%...%' could use, so on
+SQLite the two columns are copied into an FTS5 table, pugorugh_dog_search,
+whose rowid is the dog id. Every word of a query is matched as a prefix
+of a word in either column ("lab ret" finds "Labrador Retriever"), which
+FTS5 answers from its prefix indexes for autocomplete.
+
+The table is not a model: post_migrate creates and fills it (see
+sync()), single dog saves and deletes update its row, and
+catalog_changed, sent by the importer after bulk writes, reindexes the
+dogs written (see signals.py).
+rebuild() refills it after writes that bypass those, e.g. bulk_create()
+without catalog_changed.
+
+Other databases, and SQLite builds without FTS5, fall back to LIKE
+filters on the two columns.
+"""
+from functools import lru_cache
+import re
+import sqlite3
+
+from django.db import connections, DEFAULT_DB_ALIAS, transaction
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+
+from . import models
+
+TABLE = 'pugorugh_dog_search'
+# words of a query used, the rest are ignored
+max_terms = 8
+
+
+@lru_cache(maxsize=None)
+def fts5_compiled():
+    """Whether the sqlite3 library has the FTS5 extension"""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE probe USING fts5(text)')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def supported(using=DEFAULT_DB_ALIAS):
+    """Whether the database alias has the search index"""
+    return connections[using].vendor == 'sqlite' and fts5_compiled()
+
+
+def terms(text):
+    """Lowercased words of a search query
+    :param text: query as typed, e.g. "Lab ret"
+    :return: list of at most max_terms words
+    """
+    return re.findall(r'\w+', text.lower())[:max_terms]
+
+
+def match_expression(words):
+    """FTS5 query matching every word as a prefix, in either column
+    :param words: terms()
+    :return: string
+    """
+    # quoted, so words like AND or NEAR are not operators
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def filter_dogs(queryset, text):
+    """Narrow a Dog queryset to the dogs matching a search query
+    :param queryset: Dog QuerySet, e.g. with the user's preferences
+    :param text: search query
+    :return: QuerySet annotated with search_id, the dog id; filter and
+    order on it instead of id to read the index in id order. Empty when
+    the query has no words
+    """
+    words = terms(text)
+    if not words:
+        return queryset.none()
+    if not supported(queryset.db):
+        return like_filter(queryset, words).annotate(search_id=F('id'))
+    # joined rather than "id IN (subquery)", so SQLite reads the
+    # matches lazily in rowid order and stops at the end of the page,
+    # instead of collecting every match of a short prefix first
+    return queryset.extra(
+        tables=[TABLE],
+        where=['{}.rowid = {}.id'.format(TABLE, models.Dog._meta.db_table),
+               '{} MATCH %s'.format(TABLE)],
+        params=[match_expression(words)],
+    ).annotate(search_id=RawSQL('{}.rowid'.format(TABLE), ()))
+
+
+def like_filter(queryset, words):
+    """filter_dogs() without the index, a LIKE scan of both columns
+    :param queryset: Dog QuerySet
+    :param words: terms()
+    :return: QuerySet
+    """
+    for word in words:
+        queryset = queryset.filter(Q(name__icontains=word) |
+                                   Q(breed__icontains=word))
+    return queryset
+
+
+def create(using=DEFAULT_DB_ALIAS):
+    """Create the index table if it is missing"""
+    if not supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        # prefix='2 3' indexes the first letters of each word, so short
+        # autocomplete prefixes do not scan the whole term list
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5("
+            "name, breed, tokenize='unicode61 remove_diacritics 2', "
+            "prefix='2 3')".format(TABLE))
+
+
+def index_dogs(dog_ids, using=DEFAULT_DB_ALIAS, chunk_size=500):
+    """Copy the name and breed of dogs into the index, and drop the
+    dogs that no longer exist from it
+    :param dog_ids: iterable of dog ids
+    :param using: database alias
+    """
+    if not supported(using):
+        return
+    dog_ids = list(dog_ids)
+    table = models.Dog._meta.db_table
+    with connections[using].cursor() as cursor:
+        for start in range(0, len(dog_ids), chunk_size):
+            chunk = dog_ids[start:start + chunk_size]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute('DELETE FROM {} WHERE rowid IN ({})'.format(
+                TABLE, placeholders), chunk)
+            cursor.execute(
+                'INSERT INTO {} (rowid, name, breed) SELECT id, name, breed '
+                'FROM {} WHERE id IN ({})'.format(TABLE, table,
+                                                  placeholders), chunk)
+
+
+def remove_dogs(dog_ids, using=DEFAULT_DB_ALIAS):
+    """Drop dogs from the index
+    :param dog_ids: iterable of dog ids
+    :param using: database alias
+    """
+    dog_ids = list(dog_ids)
+    if not dog_ids or not supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE rowid IN ({})'.format(
+            TABLE, ', '.join(['%s'] * len(dog_ids))), dog_ids)
+
+
+def sync(using=DEFAULT_DB_ALIAS):
+    """Create the index if it is missing, and rebuild() it only when it
+    does not hold one row per dog, e.g. right after being created
+    :param using: database alias
+    :return: whether the index was rebuilt
+    """
+    if not supported(using):
+        return False
+    create(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM {}'.format(TABLE))
+        indexed = cursor.fetchone()[0]
+    if indexed == models.Dog.objects.using(using).count():
+        return False
+    rebuild(using)
+    return True
+
+
+def rebuild(using=DEFAULT_DB_ALIAS):
+    """Create the index if needed and refill it from the Dog table
+    :param using: database alias
+    :return: number of dogs indexed, None without FTS5
+    """
+    if not supported(using):
+        return None
+    create(using)
+    with transaction.atomic(using=using), \
+            connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(TABLE))
+        cursor.execute(
+            'INSERT INTO {} (rowid, name, breed) SELECT id, name, breed '
+            'FROM {}'.format(TABLE, models.Dog._meta.db_table))
+        indexed = cursor.rowcount
+    with connections[using].cursor() as cursor:
+        cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(
+            TABLE))
+    return indexed
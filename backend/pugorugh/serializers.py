@@ -1,11 +1,17 @@
+from functools import lru_cache
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.db.utils import IntegrityError
 from rest_framework import serializers
 
+from . import images
 from . import models
+from .metrics import TimedSerializerMixin
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
 
     def create(self, validated_data):
@@ -20,7 +26,7 @@ class UserSerializer(serializers.ModelSerializer):
         model = get_user_model()
         fields = '__all__'
 
-class UserDogSerializer(serializers.ModelSerializer):
+class UserDogSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = models.UserDog
         fields = ('status',)
@@ -36,16 +42,25 @@ class UserDogSerializer(serializers.ModelSerializer):
         return userdog
 
 
-class DogSerializer(serializers.ModelSerializer):
+class SwipeSerializer(TimedSerializerMixin, serializers.Serializer):
+    """One like/dislike decision in a batch, see UserDogBatchView"""
+    dog_id = serializers.IntegerField()
+    status = serializers.ChoiceField(
+        choices=['liked', 'disliked', 'undecided'])
+
+
+class DogSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     status = UserDogSerializer(required=False,
                                many=True,
                                read_only=False)
+    image_urls = serializers.SerializerMethodField()
 
     class Meta:
         fields = (
             'id',
             'name',
             'image_filename',
+            'image_urls',
             'breed',
             'age',
             'gender',
@@ -54,8 +69,120 @@ class DogSerializer(serializers.ModelSerializer):
         )
         model = models.Dog
 
+    def get_image_urls(self, dog):
+        return images.image_urls(dog.image_filename)
+
+
+class PopularDogSerializer(DogSerializer):
+    class Meta(DogSerializer.Meta):
+        fields = DogSerializer.Meta.fields + ('like_count', 'dislike_count')
+
+
+class RowSerializer(serializers.BaseSerializer):
+    """Read-only twin of a ModelSerializer for dicts from .values()
+
+    The ModelSerializer instantiates its fields for every object and
+    runs each one's to_representation on a model instance. A row
+    serializer reads just the columns() it needs from .values() rows,
+    through a list of (name, column, mapper) built once per class from
+    the ModelSerializer's fields, and gives the same output.
+
+    Method fields call the row serializer's own get_<name>(row), which
+    reads the columns listed in method_columns. skipped_fields are ones
+    the ModelSerializer never outputs. prefix reads the columns of a
+    related model, e.g. 'dog__' for UserDog rows.
+    """
+    model_serializer = None
+    method_columns = {}
+    skipped_fields = ()
+    prefix = ''
+    # fields whose to_representation returns the column value unchanged
+    identity_fields = (serializers.CharField, serializers.IntegerField)
+
+    @classmethod
+    def columns(cls):
+        """Columns to pass to .values()"""
+        columns = []
+        for name, column, mapper in compile_row_mappers(cls):
+            if column is None:
+                needed = [cls.prefix + method_column for method_column
+                          in cls.method_columns.get(name, ())]
+            else:
+                needed = [column]
+            columns.extend(column for column in needed
+                           if column not in columns)
+        return columns
+
+    def to_representation(self, row):
+        data = {}
+        for name, column, mapper in compile_row_mappers(type(self)):
+            if column is None:
+                data[name] = mapper(self, row)
+                continue
+            value = row[column]
+            if mapper is not None and value is not None:
+                value = mapper(value)
+            data[name] = value
+        return data
+
+    def column(self, row, name):
+        """Value of a model column in row, with the prefix applied"""
+        return row[self.prefix + name]
+
+
+@lru_cache(maxsize=None)
+def compile_row_mappers(row_serializer):
+    """(name, column, mapper) per field of row_serializer's model
+    serializer, in output order. column is None for method fields,
+    whose mapper is the row serializer's method
+    :param row_serializer: RowSerializer subclass
+    :return: tuple of tuples
+    """
+    model_serializer = row_serializer.model_serializer()
+    concrete = {field.attname for field in
+                model_serializer.Meta.model._meta.concrete_fields}
+    mappers = []
+    for name, field in model_serializer.fields.items():
+        if field.write_only or name in row_serializer.skipped_fields:
+            continue
+        if isinstance(field, serializers.SerializerMethodField):
+            mappers.append((name, None,
+                            getattr(row_serializer, field.method_name)))
+        elif field.source in concrete:
+            mapper = field.to_representation
+            if type(field) in row_serializer.identity_fields:
+                mapper = None
+            mappers.append((name, row_serializer.prefix + field.source,
+                            mapper))
+        else:
+            raise ImproperlyConfigured(
+                '{} cannot serialize {}.{} from rows'.format(
+                    row_serializer.__name__,
+                    type(model_serializer).__name__, name))
+    return tuple(mappers)
+
+
+class DogRowSerializer(TimedSerializerMixin, RowSerializer):
+    """DogSerializer output for Dog .values(*DogRowSerializer.columns())"""
+    model_serializer = DogSerializer
+    method_columns = {'image_urls': ('image_filename',)}
+    # dogs have no status attribute, so DogSerializer skips the field
+    skipped_fields = ('status',)
+
+    def get_image_urls(self, row):
+        return images.image_urls(self.column(row, 'image_filename'))
+
+
+class UserDogRowSerializer(DogRowSerializer):
+    """DogSerializer output for the dogs of UserDog rows"""
+    prefix = 'dog__'
+
+
+class PopularDogRowSerializer(DogRowSerializer):
+    model_serializer = PopularDogSerializer
+
 
-class UserPrefSerializer(serializers.ModelSerializer):
+class UserPrefSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         exclude = ('user',)
         model = models.UserPref
@@ -63,11 +190,13 @@ class UserPrefSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         try:
-            userpref = models.UserPref.objects.create(**validated_data)
+            with transaction.atomic():
+                userpref = models.UserPref.objects.create(**validated_data)
         except IntegrityError:
             userpref = models.UserPref.objects.get(user=validated_data['user'])
             userpref.age = validated_data['age']
             userpref.gender = validated_data['gender']
             userpref.size = validated_data['size']
             userpref.save()
+        models.UserPref.invalidate_cache(userpref.user_id)
         return userpref
@@ -0,0 +1,119 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver, Signal
+from rest_framework.authtoken.models import Token
+
+from . import authentication
+from . import candidates
+from . import images
+from . import matchcounts
+from . import models
+from . import search
+from . import versions
+
+# Sent after bulk writes to the Dog table, which bypass post_save,
+# e.g. by the importer; dog_ids lists the rows created or updated and
+# code_changes, when given, is their matchcounts.deltas()
+catalog_changed = Signal(providing_args=['dog_ids', 'code_changes'])
+# Sent once when importer.import_dogs finishes; image_filenames are the
+# photos of the dogs created, or updated with another photo
+catalog_imported = Signal(providing_args=['image_filenames'])
+
+
+@receiver([post_save, post_delete, catalog_changed], sender=models.Dog)
+def dog_changed(sender, **kwargs):
+    candidates.invalidate_all()
+    versions.bump(versions.CATALOG)
+
+
+@receiver(pre_save, sender=models.Dog)
+def dog_saving(sender, instance, **kwargs):
+    matchcounts.before_save(instance)
+
+
+@receiver(post_save, sender=models.Dog)
+def dog_saved(sender, instance, created, using, **kwargs):
+    matchcounts.after_save(instance, created)
+    search.index_dogs([instance.pk], using)
+
+
+@receiver(post_delete, sender=models.Dog)
+def dog_deleted(sender, instance, using, **kwargs):
+    matchcounts.after_delete(instance)
+    search.remove_dogs([instance.pk], using)
+    # a tombstone for exports of the changes since a number, in the
+    # transaction of the delete
+    models.DeletedDog.objects.using(using).create(
+        dog_id=instance.pk,
+        change_seq=models.Version.take(models.dog_changes_key, using))
+
+
+@receiver(catalog_changed, sender=models.Dog)
+def recount_dogs(sender, code_changes=None, **kwargs):
+    if code_changes is None:
+        matchcounts.rebuild()
+    else:
+        matchcounts.apply(code_changes)
+
+
+@receiver(catalog_changed, sender=models.Dog)
+def reindex_dogs(sender, dog_ids, **kwargs):
+    search.index_dogs(dog_ids)
+
+
+@receiver(catalog_imported, sender=models.Dog)
+def build_image_derivatives(sender, image_filenames, **kwargs):
+    # once per import rather than per chunk, so a single process pool
+    if (image_filenames
+            and getattr(settings, 'PUGORUGH_IMAGE_DERIVATIVES_ON_IMPORT',
+                        False)
+            and images.pillow_available()):
+        images.build_derivatives(image_filenames)
+
+
+@receiver([post_save, post_delete], sender=models.UserPref)
+def userpref_changed(sender, instance, **kwargs):
+    models.UserPref.invalidate_cache(instance.user_id)
+    candidates.invalidate(instance.user_id)
+    versions.bump(versions.userpref_key(instance.user_id))
+
+
+@receiver(post_save, sender=models.UserDog)
+def userdog_saved(sender, instance, **kwargs):
+    candidates.dog_decided(instance.user_id, instance.dog_id)
+    versions.bump(versions.userdogs_key(instance.user_id))
+
+
+@receiver(post_delete, sender=models.UserDog)
+def userdog_deleted(sender, instance, **kwargs):
+    candidates.dog_undecided(instance.user_id, instance.dog_id)
+    versions.bump(versions.userdogs_key(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=Token)
+def token_changed(sender, instance, **kwargs):
+    authentication.evict_token(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_saved(sender, instance, created, **kwargs):
+    # e.g. deactivated users must not stay authenticated from the cache
+    if not created:
+        for key in Token.objects.filter(user=instance).values_list(
+                'key', flat=True):
+            authentication.evict_token(key)
+
+
+def encode_dog_attributes(sender, using, **kwargs):
+    """Fill the Dog code columns for rows that predate them, count the
+    dogs per combination of codes and build the search index
+
+    This runs after every migrate, test databases included, so each
+    step checks first and only writes when something is out of date.
+    """
+    dogs = models.Dog.objects.using(using)
+    if dogs.stale_codes().exists():
+        dogs.encode_attributes()
+    matchcounts.sync(using)
+    search.sync(using)
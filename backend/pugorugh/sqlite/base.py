@@ -0,0 +1,54 @@
+"""SQLite backend tuned for concurrent web workers
+
+Use it as ENGINE 'pugorugh.sqlite'. On top of Django's sqlite3 backend,
+it reads these OPTIONS:
+
+journal_mode, e.g. 'WAL': readers no longer block the writer, and the
+    writer no longer blocks readers
+synchronous, e.g. 'NORMAL': with WAL, commits skip the fsync, which
+    happens at checkpoints instead; a power loss can drop the last
+    commits but cannot corrupt the database
+mmap_size: bytes of the file read through a memory map
+cache_size: page cache per connection, negative values are KiB
+transaction_mode, e.g. 'IMMEDIATE': take the write lock when a
+    transaction starts. With the default deferred BEGIN, a transaction
+    that reads and then writes (update_or_create, swipes.record_swipe)
+    fails at once with "database is locked" when another writer got in
+    between. An immediate transaction waits for the lock instead.
+
+timeout, the seconds to wait for a lock, is passed to sqlite3.connect as
+usual. Persistent connections come from CONN_MAX_AGE.
+"""
+from django.db.backends.sqlite3 import base
+
+pragmas = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size')
+transaction_modes = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        for name in pragmas + ('transaction_mode',):
+            kwargs.pop(name, None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        options = self.settings_dict['OPTIONS']
+        for name in pragmas:
+            value = options.get(name)
+            if value is not None:
+                # pragma values cannot be bound as parameters
+                conn.execute('PRAGMA {} = {}'.format(name, str(value)))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict['OPTIONS'].get('transaction_mode')
+        if mode is None:
+            super()._start_transaction_under_autocommit()
+        elif mode.upper() not in transaction_modes:
+            raise ValueError('transaction_mode must be one of {}'.format(
+                ', '.join(transaction_modes)))
+        else:
+            self.cursor().execute('BEGIN ' + mode.upper())
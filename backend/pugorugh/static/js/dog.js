@@ -53,6 +53,10 @@ var Dog = React.createClass({
   handlePreferencesClick: function (event) {
     this.props.setView("preferences");
   },
+  imageUrl: function () {
+    var urls = this.state.details.image_urls;
+    return urls ? urls.card : "static/images/dogs/" + this.state.details.image_filename;
+  },
   genderLookup: { m: 'Male', f: 'Female' },
   sizeLookup: { s: 'Small', m: 'Medium', l: 'Large', xl: 'Extra Large' },
   dogControls: function () {
@@ -153,7 +157,7 @@ var Dog = React.createClass({
     return React.createElement(
       "div",
       null,
-      React.createElement("img", { src: "static/images/dogs/" + this.state.details.image_filename }),
+      React.createElement("img", { src: this.imageUrl() }),
       React.createElement(
         "p",
         { className: "dog-card" },
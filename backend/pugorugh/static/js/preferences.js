@@ -7,7 +7,7 @@ var Preferences = React.createClass({
     size: new Set(['s', 'm', 'l', 'xl'])
   },
   getInitialState: function () {
-    return { data: this.data };
+    return { data: this.data, count: null };
   },
   componentDidMount: function () {
     this.serverRequest = $.ajax({
@@ -22,20 +22,42 @@ var Preferences = React.createClass({
         size: new Set(data.size ? data.size.split(",") : ['s', 'm', 'l', 'xl'])
       };
       this.setState({ data: this.data });
+      this.countMatches();
     }.bind(this));
   },
   componentWillUnmount: function () {
     this.serverRequest.abort();
+    if (this.countRequest) {
+      this.countRequest.abort();
+    }
   },
   handleCheckboxGroupDataChanged: function (property, data) {
     this.data[property] = data;
+    this.countMatches();
   },
-  save: function () {
-    var json = JSON.stringify({
+  preferences: function () {
+    return {
       age: Array.from(this.data.age).join(','),
       gender: Array.from(this.data.gender).join(','),
       size: Array.from(this.data.size).join(',')
-    });
+    };
+  },
+  countMatches: function () {
+    if (this.countRequest) {
+      this.countRequest.abort();
+    }
+    this.countRequest = $.ajax({
+      url: "api/dog/count/",
+      method: "GET",
+      dataType: "json",
+      headers: TokenAuth.getAuthHeader(),
+      data: this.preferences()
+    }).done(function (data) {
+      this.setState({ count: data.count });
+    }.bind(this));
+  },
+  save: function () {
+    var json = JSON.stringify(this.preferences());
 
     $.ajax({
       url: "api/user/preferences/",
@@ -77,6 +99,13 @@ var Preferences = React.createClass({
         atLeastOne: true
       }),
       React.createElement('hr', null),
+      this.state.count === null ? null : React.createElement(
+        'p',
+        null,
+        this.state.count,
+        ' ',
+        this.state.count === 1 ? "dog matches" : "dogs match"
+      ),
       React.createElement(
         'button',
         { className: 'button', onClick: this.save },
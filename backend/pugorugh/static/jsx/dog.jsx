@@ -53,6 +53,10 @@ var Dog = React.createClass({
   handlePreferencesClick: function(event) {
     this.props.setView("preferences");
   },
+  imageUrl: function() {
+    var urls = this.state.details.image_urls;
+    return urls ? urls.card : "static/images/dogs/" + this.state.details.image_filename;
+  },
   genderLookup: {m: 'Male', f: 'Female'},
   sizeLookup: {s: 'Small', m: 'Medium', l: 'Large', xl: 'Extra Large'},
   dogControls: function() {
@@ -118,7 +122,7 @@ var Dog = React.createClass({
 
     return (
       <div>
-        <img src={"static/images/dogs/" + this.state.details.image_filename} />
+        <img src={this.imageUrl()} />
         <p className="dog-card">
           {this.state.details.name}&bull;
           {this.state.details.breed}&bull;
@@ -0,0 +1,90 @@
+"""Fingerprinted, precompressed static files
+
+collectstatic copies every asset to STATIC_ROOT under both its own name
+and a content-hashed one (js/app.js -> js/app.3f2a9c01b7d4.js), listed
+in staticfiles.json, and writes .gz and, when the brotli package is
+installed, .br siblings of text assets. views.static_asset serves them
+with the best encoding the client accepts; hashed names never change
+content, so they are cached for a year.
+"""
+import gzip
+import hashlib
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# (Accept-Encoding coding, file suffix), in order of preference
+encodings = [('br', '.br'), ('gzip', '.gz')]
+compressible_extensions = {'.css', '.html', '.ico', '.js', '.json', '.map',
+                           '.svg', '.txt'}
+
+
+def compress(content, coding):
+    if coding == 'br':
+        return brotli.compress(content, quality=11)
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def available_encodings():
+    return [(coding, suffix) for coding, suffix in encodings
+            if coding != 'br' or brotli is not None]
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """ManifestStaticFilesStorage that also precompresses text assets
+
+    Names missing from the manifest, e.g. before collectstatic has run,
+    resolve to the unhashed file instead of raising.
+    """
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = set(paths)
+        names.update(self.hashed_files.values())
+        # a hashed copy has the same content as its original
+        done = {}
+        for name in sorted(names):
+            if os.path.splitext(name)[1] in compressible_extensions:
+                self.write_compressed(name, done)
+
+    def write_compressed(self, name, done=None):
+        """Write each encoding of name next to it, unless compressing
+        does not pay off
+        :param name: file name relative to STATIC_ROOT
+        :param done: dict reusing compressed output for equal contents
+        """
+        path = self.path(name)
+        with open(path, 'rb') as file:
+            content = file.read()
+        if done is None:
+            done = {}
+        digest = hashlib.sha256(content).digest()
+        for coding, suffix in available_encodings():
+            key = (coding, digest)
+            if key not in done:
+                done[key] = compress(content, coding)
+            compressed = done[key]
+            if len(compressed) < len(content) * 0.95:
+                with open(path + suffix + '.tmp', 'wb') as file:
+                    file.write(compressed)
+                os.replace(path + suffix + '.tmp', path + suffix)
+            elif os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def is_hashed(self, name):
+        """Whether name is a fingerprinted file from the manifest"""
+        return name in self.hashed_files.values()
@@ -0,0 +1,285 @@
+"""Recording of like/dislike decisions, one or many at once
+
+Every path keeps the Dog like/dislike counters in step, see counters.py.
+"""
+import threading
+
+from django.conf import settings
+from django.db import connection, IntegrityError, transaction
+from django.db.models import FilteredRelation, Q
+
+from . import candidates
+from . import counters
+from . import models
+from . import versions
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not_found'
+# a later decision on the same dog in the same batch or group won
+SUPERSEDED = 'superseded'
+
+
+def record_swipe(user, dog_id, status):
+    """Apply one decision and its counter change in one transaction
+    :param user: User instance
+    :param dog_id: Dog id
+    :param status: 'l', 'd' or None for undecided
+    :return: one of the result constants above, except NOT_FOUND
+    """
+    with transaction.atomic():
+        userdog = (models.UserDog.objects
+                   .select_for_update()
+                   .filter(user=user, dog_id=dog_id)
+                   .first())
+        previous = userdog.status if userdog is not None else None
+        if previous == status:
+            return UNCHANGED
+        if status is None:
+            userdog.delete()
+            result = DELETED
+        elif userdog is None:
+            models.UserDog.objects.create(user=user, dog_id=dog_id,
+                                          status=status)
+            result = CREATED
+        else:
+            userdog.status = status
+            userdog.save(update_fields=['status'])
+            result = UPDATED
+        counters.apply([(dog_id, previous, status)])
+    return result
+
+
+def record_decision(user, dog_id, status):
+    """record_swipe, or a WriteCoalescer group commit when
+    PUGORUGH_COALESCE_SWIPES is on; the group is written on another
+    request's connection, so not from inside a transaction
+    :return: one of the result constants above
+    """
+    if (getattr(settings, 'PUGORUGH_COALESCE_SWIPES', False)
+            and not connection.in_atomic_block):
+        return coalescer.submit(user.id, dog_id, status)
+    return record_swipe(user, dog_id, status)
+
+
+def current_statuses(user_id, dog_ids):
+    """The existing dogs among dog_ids and the user's status of each,
+    in one query
+    :param user_id: User id
+    :param dog_ids: iterable of Dog ids
+    :return: dict of dog_id -> 'l', 'd' or None for undecided
+    """
+    return dict(models.Dog.objects
+                .filter(id__in=dog_ids)
+                .annotate(mine=FilteredRelation(
+                    'userdog', condition=Q(userdog__user=user_id)))
+                .values_list('id', 'mine__status'))
+
+
+def write_decisions(user_id, wanted):
+    """Bulk write decisions of one user, in the caller's transaction
+    :param user_id: User id
+    :param wanted: dict of dog_id -> status, 'l', 'd' or None
+    :return: tuple of dict of dog_id -> result constant, and the
+        (dog_id, old status, new status) changes made; raise
+        IntegrityError when another request inserted one of the rows
+        since current_statuses() read them, see retried()
+    """
+    results = {}
+    current = current_statuses(user_id, wanted)
+
+    to_create = []
+    to_delete = []
+    to_update = {status: [] for status in models.userdog_statuses}
+    for dog_id, status in wanted.items():
+        if dog_id not in current:
+            results[dog_id] = NOT_FOUND
+        elif current[dog_id] == status:
+            results[dog_id] = UNCHANGED
+        elif status is None:
+            to_delete.append(dog_id)
+            results[dog_id] = DELETED
+        elif current[dog_id] is not None:
+            to_update[status].append(dog_id)
+            results[dog_id] = UPDATED
+        else:
+            to_create.append(models.UserDog(user_id=user_id,
+                                            dog_id=dog_id,
+                                            status=status))
+            results[dog_id] = CREATED
+
+    if to_delete:
+        models.UserDog.objects.filter(user=user_id,
+                                      dog_id__in=to_delete).delete()
+    for status, dog_ids in to_update.items():
+        if dog_ids:
+            models.UserDog.objects.filter(
+                user=user_id, dog_id__in=dog_ids).update(status=status)
+    # without ignore_conflicts, so every row reported CREATED, and
+    # counted, was inserted by this call
+    models.UserDog.objects.bulk_create(to_create)
+    changes = [(dog_id, current[dog_id], status)
+               for dog_id, status in wanted.items()
+               if results[dog_id] in (CREATED, UPDATED, DELETED)]
+    return results, changes
+
+
+def retried(write, attempts=3):
+    """Run write, a function opening its own transaction, again when it
+    fails on a row inserted concurrently; the new attempt reads and
+    plans from what is there now
+    :param write: function without arguments
+    :param attempts: tries before the IntegrityError is re-raised
+    :return: what write returns
+    """
+    for attempt in range(attempts):
+        try:
+            return write()
+        except IntegrityError:
+            if attempt == attempts - 1:
+                raise
+
+
+def record_swipes(user, decisions):
+    """Apply decisions for user in one transaction with bulk writes
+
+    Replaying the same decisions is a no-op, and when a dog appears more
+    than once the last decision wins; callers report the others as
+    SUPERSEDED.
+    :param user: User instance
+    :param decisions: list of (dog_id, status) with status 'l', 'd' or
+        None for undecided
+    :return: dict of dog_id -> one of the result constants above
+    """
+    # The queue is rebuilt on next use rather than patched row by row.
+    # Dropped before the write, so the post_delete of each undecided
+    # row finds no queue to query for, and again after the bump, as its
+    # version tag does not show this process's own writes
+    candidates.invalidate(user.id)
+
+    def write():
+        with versions.deferred(), transaction.atomic():
+            results, changes = write_decisions(user.id, dict(decisions))
+            counters.apply(changes)
+            if changes:
+                versions.bump(versions.userdogs_key(user.id))
+        return results
+
+    results = retried(write)
+    candidates.invalidate(user.id)
+    return results
+
+
+class PendingDecision:
+    def __init__(self, user_id, dog_id, status):
+        self.user_id = user_id
+        self.dog_id = dog_id
+        self.status = status
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class WriteCoalescer:
+    """Group commit for single decisions from concurrent requests
+
+    The first request to submit becomes the leader. It waits up to
+    PUGORUGH_COALESCE_WAIT seconds, or until PUGORUGH_COALESCE_BATCH
+    decisions are queued, then writes the whole group in one
+    transaction on its connection while the others wait. SQLite has a
+    single writer, so a group costs one lock hand-off and one commit
+    instead of one per swipe.
+    """
+
+    def __init__(self, wait=None, max_batch=None):
+        self.wait = wait
+        self.max_batch = max_batch
+        self.flushes = 0
+        self._pending = []
+        self._leader = False
+        self._full = threading.Event()
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, dog_id, status):
+        """Record a decision with the next group, blocking until written
+        :return: one of the result constants above
+        """
+        wait = self.wait
+        if wait is None:
+            wait = getattr(settings, 'PUGORUGH_COALESCE_WAIT', 0.002)
+        max_batch = self.max_batch or getattr(
+            settings, 'PUGORUGH_COALESCE_BATCH', 256)
+        item = PendingDecision(user_id, dog_id, status)
+        with self._lock:
+            self._pending.append(item)
+            leader = not self._leader
+            self._leader = True
+            if len(self._pending) >= max_batch:
+                self._full.set()
+        if leader:
+            self._full.wait(wait)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._leader = False
+                self._full.clear()
+                self.flushes += 1
+            self.flush(batch)
+        else:
+            item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def flush(self, batch):
+        """Write a group, then hand each decision its result or error"""
+        try:
+            wanted = {}
+            for item in batch:
+                wanted.setdefault(item.user_id, {})[item.dog_id] = \
+                    item.status
+            # like record_swipes, rather than patch these users' queues
+            # for each undecided row deleted
+            undeciding = {item.user_id for item in batch
+                          if item.status is None}
+            for user_id in undeciding:
+                candidates.invalidate(user_id)
+
+            def write():
+                results = {}
+                with versions.deferred(), transaction.atomic():
+                    changes = []
+                    for user_id, decisions in wanted.items():
+                        user_results, user_changes = write_decisions(
+                            user_id, decisions)
+                        results[user_id] = user_results
+                        changes.extend(user_changes)
+                        if user_changes:
+                            versions.bump(versions.userdogs_key(user_id))
+                    counters.apply(changes)
+                return results
+
+            results = retried(write)
+            for user_id in undeciding:
+                candidates.invalidate(user_id)
+            # bulk_create skips the post_save that keeps queues in step
+            for user_id, user_results in results.items():
+                for dog_id, result in user_results.items():
+                    if result == CREATED:
+                        candidates.dog_decided(user_id, dog_id)
+            last = {(item.user_id, item.dog_id): item for item in batch}
+            for item in batch:
+                if last[item.user_id, item.dog_id] is not item:
+                    item.result = SUPERSEDED
+                else:
+                    item.result = results[item.user_id][item.dog_id]
+        except Exception as error:
+            for item in batch:
+                item.error = error
+        finally:
+            for item in batch:
+                item.done.set()
+
+
+coalescer = WriteCoalescer()
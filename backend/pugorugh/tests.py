@@ -1,14 +1,64 @@
+import asyncio
+import gzip
+import io
+import json
+import os
 import random
+import shutil
+import sqlite3
 import string
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock, skipUnless
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.urlresolvers import reverse
+from django.contrib.staticfiles import finders
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, ConnectionHandler, IntegrityError, \
+    transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIRequestFactory, force_authenticate, \
-    APITestCase
+    APITestCase, APITransactionTestCase
 
+from . import asgi
+from . import authentication
+from . import benchmark
+from . import candidates
+from . import catalog
+from . import contention
+from . import counters
+from . import export
+from . import images
+from . import importer
+from . import matchcounts
+from . import metrics
+from . import pool
+from . import ranking
+from . import routers
+from . import search
+from . import serializers
+from . import signals
+from . import storage
+from . import swipes
+from . import versions
+from .cache import LRUCache
+from . import models
 from .models import Dog, UserDog, UserPref
-from .views import DogView, UserPreferenceView, UserDogView
+from .serializers import DogSerializer, UserPrefSerializer
+from .views import DogSwipeView, DogView, UserPreferenceView, UserDogView
 
 # Create your tests here.
 
@@ -27,9 +77,15 @@ def make_random_name(name_length):
     )
 
 
-class PugOrTestCase(APITestCase):
+class PugOrBaseTestCase(APITestCase):
 
     def setUp(self):
+        # caches outlive the per-test transaction, start from scratch
+        authentication.token_cache.clear()
+        candidates.invalidate_all()
+        catalog.clear()
+        models.userpref_cache.clear()
+
         # create test user
         self.user = User.objects.create_superuser(
             username='wanchan',
@@ -78,6 +134,9 @@ class PugOrTestCase(APITestCase):
                     'undecided': self.get_dogs(user=self.user)}
         return dog_dict
 
+
+class PugOrTestCase(PugOrBaseTestCase):
+
     def testDbContents(self):
         self.assertEqual(Dog.objects.count(), 3)
         self.assertEqual(User.objects.count(), 1)
@@ -133,8 +192,9 @@ class PugOrTestCase(APITestCase):
         genders.pop(genders.index(testing_gender))
         genders = ','.join(genders)
 
-        userpref['gender'] = genders
-        UserPref.objects.update(**userpref)
+        userpref = UserPref.objects.get(user=self.user)
+        userpref.gender = genders
+        userpref.save()
 
         resp = view(request, pk=-1, liked_status=liked_status)
         self.assertEqual(resp.status_code, 404)
@@ -204,3 +264,2140 @@ class PugOrTestCase(APITestCase):
         get_resp = get_view(get_request, pk=-1, liked_status=old_liked_status)
         self.assertEqual(get_resp.status_code, 200)
         self.assertEqual(get_resp.data['name'], test_dog['name'])
+
+
+class CandidateQueueTestCase(PugOrBaseTestCase):
+
+    def get_next(self, pk):
+        request = self.factory.get(
+            reverse('dogview_minus', kwargs={'pk': -1,
+                                             'liked_status': 'undecided'}),
+            HTTP_AUTHORIZATION='Token {}'.format(self.token))
+        force_authenticate(request, user=self.user)
+        return DogView.as_view()(request, pk=pk, liked_status='undecided')
+
+    def testQueueOrdering(self):
+        queue = candidates.CandidateQueue([5, 1, 3])
+        self.assertEqual(queue.next_after(-1), 1)
+        self.assertEqual(queue.next_after(1), 3)
+        self.assertIsNone(queue.next_after(5))
+        queue.discard(3)
+        queue.add(4)
+        queue.add(4)
+        self.assertEqual(queue.dog_ids, [1, 4, 5])
+
+    def testQueueFollowsUserDogChanges(self):
+        undecided = Dog.objects.exclude(userdog__user=self.user).get()
+        resp = self.get_next(-1)
+        self.assertEqual(resp.data['id'], undecided.id)
+
+        # Liking the last undecided dog empties the queue
+        UserDog.objects.create(user=self.user, dog=undecided, status='l')
+        self.assertEqual(len(candidates.get_queue(self.user)), 0)
+        self.assertEqual(self.get_next(-1).status_code, 404)
+
+        # Undeciding puts it back
+        UserDog.objects.filter(user=self.user, dog=undecided).delete()
+        resp = self.get_next(-1)
+        self.assertEqual(resp.data['id'], undecided.id)
+
+    def testQueueRebuiltOnUserPrefChange(self):
+        undecided = Dog.objects.exclude(userdog__user=self.user).get()
+        self.assertEqual(self.get_next(-1).status_code, 200)
+        genders = [g for g in dog_genders if g != undecided.gender]
+        UserPref.objects.create(user=self.user,
+                                gender=','.join(genders),
+                                size='s,m,l,xl',
+                                age='')
+        self.assertEqual(self.get_next(-1).status_code, 404)
+
+
+class DogViewScalingTestCase(PugOrBaseTestCase):
+    """Cost of a "next dog" request must not grow with the catalog"""
+
+    catalog_sizes = (100, 100000)
+
+    def grow_catalog(self, size):
+        new_dogs = []
+        for i in range(Dog.objects.count(), size):
+            new_dogs.append(Dog(name='dog{}'.format(i),
+                                image_filename='{}.jpg'.format(i),
+                                breed='whuffie',
+                                age=random.randrange(100),
+                                gender=random.choice(dog_genders),
+                                size=random.choice(dog_sizes)))
+        Dog.objects.bulk_create(new_dogs)
+
+    def measure(self, url):
+        # Warm up once so caches and the candidate queue are built
+        self.client.get(url)
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(url)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(resp.status_code, 200)
+        return len(queries), peak
+
+    def testNextDogCostIsConstant(self):
+        self.client.force_authenticate(user=self.user)
+        dog = self.get_dog_dict()['liked'].first()
+        urls = [reverse('dogview', kwargs={'pk': dog.id - 1,
+                                           'liked_status': 'liked'}),
+                reverse('dogview_minus', kwargs={'pk': -1,
+                                                 'liked_status': 'undecided'})]
+        results = {url: [] for url in urls}
+        for size in self.catalog_sizes:
+            self.grow_catalog(size)
+            for url in urls:
+                results[url].append(self.measure(url))
+
+        for url, ((small_queries, small_peak),
+                  (large_queries, large_peak)) in results.items():
+            self.assertEqual(small_queries, large_queries, url)
+            self.assertLess(large_peak, small_peak * 2, url)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite')
+class DogViewQueryPlanTestCase(PugOrBaseTestCase):
+    """DogView queries must be served by indexes, not table scans"""
+
+    def setUp(self):
+        super().setUp()
+        UserPref.objects.create(user=self.user,
+                                gender='m,f',
+                                size='s,m,l',
+                                age='b,a')
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, queryset):
+        plan = self.get_plan(queryset)
+        scans = [step for step in plan
+                 if step.startswith('SCAN') and 'INDEX' not in step]
+        self.assertEqual(scans, [], plan)
+
+    def testCandidateQueuePlan(self):
+        self.assertNoFullScan(
+            Dog.objects.for_userpref(self.user)
+            .undecided_by(self.user)
+            .order_by('id')
+            .values_list('id', flat=True))
+
+    def testLikedDogPlan(self):
+        for liked_status in userdog_statuses:
+            self.assertNoFullScan(
+                Dog.objects.for_userpref(self.user)
+                .filter(userdog__status=liked_status,
+                        userdog__user=self.user,
+                        id__gt=1)
+                .order_by('id')[:1])
+
+    def testUserDogListingPlan(self):
+        plan = self.get_plan(
+            UserDog.objects.filter(user=self.user, status='l',
+                                   dog__size='s', dog_id__gt=1)
+            .select_related('dog').order_by('dog_id')[:11])
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+        self.assertTrue(plan[0].startswith('SEARCH pugorugh_userdog'), plan)
+
+    def testUserDogUpsertPlan(self):
+        self.assertNoFullScan(
+            UserDog.objects.filter(user=self.user, dog_id=1))
+
+
+class BitmaskEncodingTestCase(PugOrBaseTestCase):
+
+    def testEncodeDecodeChoices(self):
+        mask = models.encode_choices('m,u', models.dog_genders)
+        self.assertEqual(mask, 0b101)
+        self.assertEqual(models.mask_bits(mask), [1, 4])
+        self.assertEqual(models.decode_choices(mask, models.dog_genders),
+                         'm,u')
+        self.assertEqual(models.encode_choices('', models.dog_genders), 0)
+        with self.assertRaises(ValueError):
+            models.encode_choices('x', models.dog_genders)
+
+    def testAgeBucketMatchesAgeRanges(self):
+        for code, (low, high) in models.userpref_age_ranges.items():
+            bit = 1 << models.userpref_ages.index(code)
+            self.assertEqual(models.age_bucket(low), bit)
+            self.assertEqual(models.age_bucket(high), bit)
+        self.assertEqual(models.age_bucket(None), 0)
+        self.assertEqual(models.age_bucket(361), 0)
+
+    def testDogCodesSetOnBulkCreate(self):
+        for dog in Dog.objects.all():
+            self.assertEqual(
+                dog.gender_code,
+                1 << models.dog_genders.index(dog.gender))
+            self.assertEqual(dog.size_code,
+                             1 << models.dog_sizes.index(dog.size))
+            self.assertEqual(dog.age_bucket, models.age_bucket(dog.age))
+
+    def testUserPrefStoredAsBitmask(self):
+        userpref = UserPref.objects.create(user=self.user,
+                                           gender='f,m',
+                                           size='xl',
+                                           age='b,s')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT gender, size, age FROM pugorugh_userpref '
+                           'WHERE id = %s', [userpref.id])
+            self.assertEqual(cursor.fetchone(), (0b11, 0b1000, 0b1001))
+
+        userpref.refresh_from_db()
+        self.assertEqual(UserPrefSerializer(userpref).data,
+                         {'id': userpref.id,
+                          'gender': 'm,f',
+                          'size': 'xl',
+                          'age': 'b,s'})
+
+    def testUserPrefMatchesAgeRanges(self):
+        Dog.objects.all().delete()
+        Dog.objects.bulk_create(
+            Dog(name=str(age), image_filename='', age=age, gender='m',
+                size='s')
+            for age in (0, 6, 7, 23, 24, 70, 71, 360, 361))
+        UserPref.objects.create(user=self.user, gender='m', size='s',
+                                age='y,s')
+        ages = Dog.objects.for_userpref(self.user).values_list('age',
+                                                               flat=True)
+        self.assertEqual(sorted(ages), [7, 23, 71, 360])
+
+
+class UserPrefCacheTestCase(PugOrBaseTestCase):
+
+    def testLRUCacheEvictionAndExpiry(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1,
+                                         'size': 2, 'maxsize': 2})
+
+        expired = LRUCache(ttl=0)
+        expired.set('a', 1)
+        self.assertIsNone(expired.get('a'))
+
+    def testLRUCacheBackend(self):
+        shared = LRUCache(backend='default', prefix='pugorugh:test')
+        shared.set('a', {'size_code__in': [1]})
+        other_process = LRUCache(backend='default', prefix='pugorugh:test')
+        self.assertEqual(other_process.get('a'), {'size_code__in': [1]})
+        shared.delete('a')
+        self.assertIsNone(LRUCache(backend='default',
+                                   prefix='pugorugh:test').get('a'))
+
+    def testLRUCacheBackendOnly(self):
+        shared = LRUCache(backend='default', prefix='pugorugh:test',
+                          local=False)
+        other_process = LRUCache(backend='default', prefix='pugorugh:test',
+                                 local=False)
+        shared.set('a', 1)
+        self.assertEqual(other_process.get('a'), 1)
+        self.assertEqual(len(other_process), 0)
+        shared.delete('a')
+        self.assertIsNone(other_process.get('a'))
+
+    def testLookupsCachedUntilPreferencesChange(self):
+        UserPref.objects.create(user=self.user, gender='m', size='s', age='')
+        lookups = UserPref.cached_dog_lookups(self.user)
+        key = versions.userpref_key(self.user.pk)
+        version = versions.get_versions([key])[key][0]
+        with self.assertNumQueries(0):
+            self.assertEqual(UserPref.cached_dog_lookups(self.user, version),
+                             lookups)
+
+        request = self.factory.put(
+            reverse('userpref'),
+            {'gender': 'f', 'size': 's', 'age': 'b'},
+            HTTP_AUTHORIZATION='Token {}'.format(self.token))
+        force_authenticate(request, user=self.user)
+        UserPreferenceView.as_view()(request)
+
+        self.assertEqual(UserPref.cached_dog_lookups(self.user),
+                         {'gender_code__in': [2],
+                          'size_code__in': [1],
+                          'age_bucket__in': [1]})
+
+
+    def testLookupsReloadAfterOtherProcessesSave(self):
+        UserPref.objects.create(user=self.user, gender='m', size='s', age='')
+        UserPref.cached_dog_lookups(self.user)
+        # another worker saves: the row and the counter change, but no
+        # signal reaches this process's cache
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE pugorugh_userpref SET gender = 'f' "
+                           "WHERE user_id = %s", [self.user.pk])
+            cursor.execute("UPDATE pugorugh_version SET value = value + 1 "
+                           "WHERE key = %s",
+                           [versions.userpref_key(self.user.pk)])
+        self.assertEqual(UserPref.cached_dog_lookups(self.user),
+                         {'gender_code__in': [2], 'size_code__in': [1]})
+
+
+class CachedTokenAuthenticationTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token {}'.format(self.token.key))
+        self.url = reverse('dogview_minus',
+                           kwargs={'pk': -1, 'liked_status': 'undecided'})
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        return len(queries)
+
+    def testCachedTokenSavesQueries(self):
+        # Warm the preference cache and candidate queue
+        self.client.get(self.url)
+        authentication.token_cache.clear()
+        cold = self.count_queries()
+        warm = self.count_queries()
+        self.assertLessEqual(warm, cold - 1)
+
+    def testLogoutEvictsToken(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertIn(self.token.key, authentication.token_cache)
+        resp = self.client.post(reverse('logout-user'))
+        self.assertEqual(resp.status_code, 204)
+        self.assertNotIn(self.token.key, authentication.token_cache)
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def testInactiveUserEvicted(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+
+class ImportDogsTestCase(PugOrBaseTestCase):
+
+    def make_records(self, count, breed='whuffie'):
+        return [{'name': 'dog{}'.format(i),
+                 'image_filename': 'import{}.jpg'.format(i),
+                 'breed': breed,
+                 'age': i,
+                 'gender': 'f',
+                 'size': 'm'} for i in range(count)]
+
+    def testIterRecordsFormats(self):
+        records = self.make_records(50)
+        as_array = io.StringIO('  \n' + json.dumps(records, indent=2))
+        self.assertEqual(list(importer.iter_json_array(as_array,
+                                                       read_size=7)),
+                         records)
+        as_array.seek(0)
+        self.assertEqual(list(importer.iter_records(as_array)), records)
+        as_lines = io.StringIO(
+            '\n'.join(json.dumps(record) for record in records) + '\n\n')
+        self.assertEqual(list(importer.iter_records(as_lines)), records)
+        self.assertEqual(list(importer.iter_records(io.StringIO(''))), [])
+        with self.assertRaises(ValueError):
+            list(importer.iter_records(io.StringIO('[{"name": 1}')))
+
+    def testImportAndUpsert(self):
+        records = self.make_records(25)
+        records.append({'name': 'nogender', 'gender': 'q'})
+        stats = importer.import_dogs(records, chunk_size=10)
+        self.assertEqual((stats.created, stats.updated, stats.invalid),
+                         (25, 0, 1))
+        imported = Dog.objects.filter(breed='whuffie', name__startswith='dog')
+        self.assertEqual(imported.count(), 25)
+        self.assertEqual(set(imported.values_list('gender_code', flat=True)),
+                         {2})
+
+        stats = importer.import_dogs(self.make_records(30, breed='pug'),
+                                     chunk_size=10, key='image_filename')
+        self.assertEqual((stats.created, stats.updated), (5, 25))
+        self.assertEqual(Dog.objects.filter(breed='pug').count(), 30)
+
+    def testImportInvalidatesCandidateQueues(self):
+        queue = candidates.get_queue(self.user)
+        before = len(queue)
+        importer.import_dogs(self.make_records(3))
+        self.assertEqual(len(candidates.get_queue(self.user)), before + 3)
+
+    def testCommandDryRun(self):
+        out = io.StringIO()
+        call_command('import_dogs', '--dry-run', stdout=out)
+        self.assertIn('Dry run', out.getvalue())
+        self.assertIn('rows/sec', out.getvalue())
+        self.assertEqual(Dog.objects.count(), 3)
+
+
+class UserDogBatchTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.user)
+        self.liked, self.disliked, self.undecided = Dog.objects.order_by('id')
+
+    def post_batch(self, decisions):
+        return self.client.post(reverse('userdog-batch'), decisions,
+                                format='json')
+
+    def testBatchAppliesDecisions(self):
+        decisions = [
+            {'dog_id': self.liked.id, 'status': 'disliked'},
+            {'dog_id': self.disliked.id, 'status': 'undecided'},
+            {'dog_id': self.undecided.id, 'status': 'liked'},
+            {'dog_id': 999999, 'status': 'liked'},
+            {'dog_id': self.liked.id, 'status': 'meh'},
+        ]
+        resp = self.post_batch(decisions)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['result'] for item in resp.data],
+                         ['updated', 'deleted', 'created', 'not_found',
+                          'invalid'])
+        self.assertEqual(
+            dict(UserDog.objects.filter(user=self.user)
+                 .values_list('dog_id', 'status')),
+            {self.liked.id: 'd', self.undecided.id: 'l'})
+
+        # Replaying is idempotent
+        resp = self.post_batch(decisions[:4])
+        self.assertEqual([item['result'] for item in resp.data],
+                         ['unchanged', 'unchanged', 'unchanged',
+                          'not_found'])
+        self.assertEqual(UserDog.objects.filter(user=self.user).count(), 2)
+
+    def testRepeatedDogReportsSuperseded(self):
+        resp = self.post_batch([
+            {'dog_id': self.undecided.id, 'status': 'liked'},
+            {'dog_id': self.liked.id, 'status': 'disliked'},
+            {'dog_id': self.undecided.id, 'status': 'disliked'},
+        ])
+        self.assertEqual([item['result'] for item in resp.data],
+                         ['superseded', 'updated', 'created'])
+        self.assertEqual(UserDog.objects.get(user=self.user,
+                                             dog=self.undecided).status, 'd')
+
+    def testRaceLostToAnotherRequestIsNotCounted(self):
+        # another request likes the dog after this batch read the
+        # statuses but before it inserts
+        swipes.record_swipe(self.user, self.undecided.id, 'l')
+        stale = {self.undecided.id: None}
+        with mock.patch.object(swipes, 'current_statuses',
+                               side_effect=[stale, swipes.current_statuses(
+                                   self.user.id, stale)]):
+            resp = self.post_batch([{'dog_id': self.undecided.id,
+                                     'status': 'liked'}])
+        self.assertEqual(resp.data[0]['result'], 'unchanged')
+        self.assertEqual(Dog.objects.get(id=self.undecided.id).like_count,
+                         1)
+        self.assertFalse(counters.drifted(
+            Dog.objects.filter(id=self.undecided.id)).exists())
+
+    def testBatchUsesConstantQueries(self):
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='', gender='m', size='s')
+            for i in range(50))
+        decisions = [{'dog_id': dog_id, 'status': 'liked'}
+                     for dog_id in Dog.objects.values_list('id', flat=True)]
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.post_batch(decisions)
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(len(queries), 10)
+        self.assertEqual(
+            UserDog.objects.filter(user=self.user, status='l').count(), 53)
+
+    def testUndecidingUsesConstantQueries(self):
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='', gender='m', size='s')
+            for i in range(40))
+        dog_ids = list(Dog.objects.values_list('id', flat=True))
+        self.post_batch([{'dog_id': dog_id, 'status': 'liked'}
+                         for dog_id in dog_ids])
+
+        counts = []
+        for size in (2, 40):
+            self.post_batch([{'dog_id': dog_id, 'status': 'liked'}
+                             for dog_id in dog_ids])
+            # a warm queue, whose receivers must not run per row
+            candidates.get_queue(self.user)
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.post_batch([{'dog_id': dog_id,
+                                         'status': 'undecided'}
+                                        for dog_id in dog_ids[:size]])
+            self.assertEqual({item['result'] for item in resp.data},
+                             {'deleted'})
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def testBatchUpdatesCandidateQueue(self):
+        self.assertEqual(candidates.get_queue(self.user).dog_ids,
+                         [self.undecided.id])
+        self.post_batch([{'dog_id': self.undecided.id, 'status': 'liked'},
+                         {'dog_id': self.liked.id, 'status': 'undecided'}])
+        self.assertEqual(candidates.get_queue(self.user).dog_ids,
+                         [self.liked.id])
+
+    def testBatchRejectsNonList(self):
+        resp = self.post_batch({'dog_id': 1, 'status': 'liked'})
+        self.assertEqual(resp.status_code, 400)
+
+
+class DogPageViewTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.user)
+        Dog.objects.bulk_create(
+            Dog(name='page{}'.format(i), image_filename='', age=i,
+                gender='m', size='s')
+            for i in range(25))
+
+    def fetch_all(self, liked_status, limit):
+        # with cached preferences every page is a single query, plus the
+        # version check of the cached preferences and candidate queue
+        UserPref.cached_dog_lookups(self.user)
+        url = reverse('dogview-page', kwargs={'pk': -1,
+                                              'liked_status': liked_status})
+        names = []
+        params = {'limit': limit}
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                resp = self.client.get(url, params)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(queries), 2)
+            names.extend(dog['name'] for dog in resp.data['results'])
+            if resp.data['next'] is None:
+                return names
+            params['cursor'] = resp.data['next']
+
+    def testUndecidedPages(self):
+        candidates.get_queue(self.user)
+        expected = list(self.get_dog_dict()['undecided']
+                        .order_by('id').values_list('name', flat=True))
+        self.assertEqual(len(expected), 26)
+        self.assertEqual(self.fetch_all('undecided', 10), expected)
+
+    def testLikedPages(self):
+        UserDog.objects.bulk_create(
+            UserDog(user=self.user, dog=dog, status='l')
+            for dog in Dog.objects.filter(name__startswith='page'))
+        expected = list(self.get_dog_dict()['liked']
+                        .order_by('id').values_list('name', flat=True))
+        self.assertEqual(self.fetch_all('liked', 7), expected)
+
+    def testStartsAfterPk(self):
+        first = Dog.objects.filter(name__startswith='page').order_by('id')[0]
+        url = reverse('dogview-page', kwargs={'pk': first.id,
+                                              'liked_status': 'undecided'})
+        resp = self.client.get(url, {'limit': 3})
+        self.assertEqual([dog['name'] for dog in resp.data['results']],
+                         ['page1', 'page2', 'page3'])
+
+    def testInvalidCursor(self):
+        url = reverse('dogview-page', kwargs={'pk': -1,
+                                              'liked_status': 'liked'})
+        resp = self.client.get(url, {'cursor': '!!'})
+        self.assertEqual(resp.status_code, 404)
+
+
+class UserDogListViewTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.user)
+        UserDog.objects.all().delete()
+        Dog.objects.bulk_create(
+            Dog(name='list{}'.format(i), image_filename='', age=i,
+                breed=['pug', 'boxer'][i % 2], gender='m',
+                size=['s', 'l'][i % 3 == 0])
+            for i in range(30))
+        UserDog.objects.bulk_create(
+            UserDog(user=self.user, dog=dog, status=['l', 'd'][i % 4 == 0])
+            for i, dog in enumerate(
+                Dog.objects.filter(name__startswith='list').order_by('id')))
+
+    def fetch_all(self, liked_status, **params):
+        UserPref.cached_dog_lookups(self.user)
+        url = reverse('userdog-list', kwargs={'liked_status': liked_status})
+        ids = []
+        while True:
+            with self.assertNumQueries(1):
+                resp = self.client.get(url, params)
+            self.assertEqual(resp.status_code, 200)
+            ids.extend(dog['id'] for dog in resp.data['results'])
+            if resp.data['next'] is None:
+                return ids
+            params['cursor'] = resp.data['next']
+
+    def testListsByStatus(self):
+        for liked_status, code in (('liked', 'l'), ('disliked', 'd')):
+            expected = list(UserDog.objects
+                            .filter(user=self.user, status=code)
+                            .order_by('dog_id')
+                            .values_list('dog_id', flat=True))
+            self.assertEqual(self.fetch_all(liked_status, limit=4), expected)
+        expected = list(Dog.objects.exclude(name__startswith='list')
+                        .order_by('id').values_list('id', flat=True))
+        self.assertEqual(self.fetch_all('undecided', limit=1), expected)
+
+    def testListFilters(self):
+        expected = list(Dog.objects
+                        .filter(userdog__user=self.user, userdog__status='l',
+                                breed='pug', size='l')
+                        .order_by('id').values_list('id', flat=True))
+        self.assertTrue(expected)
+        self.assertEqual(self.fetch_all('liked', breed='pug', size='l'),
+                         expected)
+
+    def testPageSizeIsCapped(self):
+        url = reverse('userdog-list', kwargs={'liked_status': 'liked'})
+        resp = self.client.get(url, {'limit': 1000})
+        self.assertEqual(len(resp.data['results']), 22)
+        resp = self.client.get(url, {'limit': 5})
+        self.assertEqual(len(resp.data['results']), 5)
+
+
+class ConditionalRequestTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token {}'.format(self.token.key))
+        UserPref.objects.create(user=self.user, gender='m,f,u',
+                                size='s,m,l,xl', age='b,y,a,s')
+        self.dog_url = reverse('dogview_minus',
+                               kwargs={'pk': -1, 'liked_status': 'liked'})
+
+    def testNotModifiedRunsOneQuery(self):
+        resp = self.client.get(self.dog_url)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        with self.assertNumQueries(1):
+            resp = self.client.get(self.dog_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], etag)
+
+    def testETagChangesWithUserDogs(self):
+        etag = self.client.get(self.dog_url)['ETag']
+        liked = self.get_dog_dict()['liked'].first()
+        UserDog.objects.filter(user=self.user, dog=liked).delete()
+        resp = self.client.get(self.dog_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 404)
+
+        self.client.post(reverse('userdog-batch'),
+                         [{'dog_id': liked.id, 'status': 'liked'}],
+                         format='json')
+        resp = self.client.get(self.dog_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['id'], liked.id)
+
+    def testETagDependsOnUrl(self):
+        other_url = reverse('dogview_minus',
+                            kwargs={'pk': -1, 'liked_status': 'disliked'})
+        self.assertNotEqual(self.client.get(self.dog_url)['ETag'],
+                            self.client.get(other_url)['ETag'])
+
+    def testUserPrefConditional(self):
+        url = reverse('userpref')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        with self.assertNumQueries(1):
+            resp = self.client.get(
+                url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp.status_code, 304)
+
+        etag = self.client.get(url)['ETag']
+        self.client.put(url, {'gender': 'f', 'size': 's', 'age': 'b'})
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['gender'], 'f')
+
+    def testDeferredBumpsOnce(self):
+        key = versions.userdogs_key(self.user.id)
+        versions.bump(key)
+        with self.assertNumQueries(1):
+            with versions.deferred():
+                versions.bump(key)
+                versions.bump(key)
+        self.assertEqual(versions.get_versions([key])[key][0], 2)
+
+
+@skipUnless(images.pillow_available(), 'Pillow is not installed')
+class ImageDerivativesTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        derived_dir = os.path.join(source_dir, 'derived')
+        for name, value in (
+                ('SOURCE_DIR', source_dir),
+                ('DERIVED_DIR', derived_dir),
+                ('MANIFEST', os.path.join(derived_dir, 'manifest.json')),
+                ('manifest_cache', images.ManifestCache(interval=0))):
+            patcher = mock.patch.object(images, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in ('1.jpg', '2.jpg'):
+            shutil.copy(os.path.join(images.STATIC_DIR, 'images', 'dogs',
+                                     name),
+                        source_dir)
+
+    def testBuildIsIncremental(self):
+        processed, encoded = images.build_derivatives(
+            ['1.jpg', '2.jpg', 'missing.jpg', '../1.jpg'], workers=2)
+        self.assertEqual((processed, encoded), (2, 2 * len(images.VARIANTS)))
+        self.assertEqual(images.build_derivatives(['1.jpg', '2.jpg']),
+                         (2, 0))
+
+        # A changed photo gets new derivatives
+        shutil.copy(os.path.join(images.SOURCE_DIR, '2.jpg'),
+                    os.path.join(images.SOURCE_DIR, '1.jpg'))
+        self.assertEqual(images.build_derivatives(['1.jpg'], workers=1),
+                         (1, 0))
+        manifest = images.load_manifest()
+        self.assertEqual(manifest['1.jpg'], manifest['2.jpg'])
+
+    def testDerivativesAreMuchSmaller(self):
+        images.build_derivatives(['1.jpg'], workers=1)
+        entry = images.load_manifest()['1.jpg']
+        original = os.path.getsize(os.path.join(images.SOURCE_DIR, '1.jpg'))
+        card = os.path.getsize(os.path.join(images.DERIVED_DIR,
+                                            entry['card']))
+        self.assertLess(card * 10, original)
+
+    def testSerializerExposesUrls(self):
+        dog = Dog.objects.first()
+        self.assertIsNone(DogSerializer(dog).data['image_urls'])
+        dog.image_filename = '1.jpg'
+        dog.save()
+        images.build_for_dogs([dog.id])
+        urls = DogSerializer(dog).data['image_urls']
+        self.assertEqual(set(urls), set(images.VARIANTS))
+        self.assertTrue(urls['card'].startswith('/static/images/dogs/'))
+        self.assertTrue(urls['thumb_webp'].endswith('.webp'))
+
+    @override_settings(PUGORUGH_IMAGE_DERIVATIVES_ON_IMPORT=True)
+    def testImportBuildsDerivatives(self):
+        records = [{'name': 'rex', 'image_filename': '2.jpg',
+                    'gender': 'm', 'size': 's'},
+                   {'name': 'max', 'image_filename': '1.jpg',
+                    'gender': 'm', 'size': 's'}]
+        with mock.patch.object(images, 'build_derivatives',
+                               wraps=images.build_derivatives) as build:
+            importer.import_dogs(records, chunk_size=1, key='name')
+        # once for the whole import
+        build.assert_called_once_with({'1.jpg', '2.jpg'})
+        self.assertIn('2.jpg', images.load_manifest())
+
+        # only a photo that changed is built again
+        stats = importer.import_dogs(
+            [dict(records[0], breed='pug'),
+             dict(records[1], image_filename='2.jpg')], key='name')
+        self.assertEqual(stats.new_images, {'2.jpg'})
+        stats = importer.import_dogs([dict(records[0], breed='boxer')],
+                                     key='name')
+        self.assertEqual(stats.new_images, set())
+
+
+class StaticAssetTestCase(PugOrBaseTestCase):
+    """collectstatic output and how /static/ serves it"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.static_root = tempfile.mkdtemp()
+        cls.static_settings = override_settings(STATIC_ROOT=cls.static_root)
+        cls.static_settings.enable()
+        super().setUpClass()
+        call_command('collectstatic', interactive=False, verbosity=0,
+                     ignore_patterns=['images', 'admin',
+                                      'rest_framework'])
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.static_settings.disable()
+        shutil.rmtree(cls.static_root)
+
+    def hashed_name(self, name):
+        manifest_path = os.path.join(self.static_root, 'staticfiles.json')
+        with open(manifest_path) as manifest:
+            return json.load(manifest)['paths'][name]
+
+    def get_asset(self, name, accept_encoding=''):
+        return self.client.get('/static/' + name,
+                               HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def testIndexReferencesHashedNames(self):
+        response = self.client.get('/')
+        for name in ('js/app.js', 'css/global.css', 'lib/jquery.min.js'):
+            self.assertContains(response,
+                                '/static/' + self.hashed_name(name))
+
+    def testCollectWritesCompressedVariants(self):
+        hashed = os.path.join(self.static_root, self.hashed_name('js/app.js'))
+        with open(hashed, 'rb') as file:
+            original = file.read()
+        with gzip.open(hashed + '.gz') as file:
+            self.assertEqual(file.read(), original)
+        self.assertEqual(os.path.exists(hashed + '.br'),
+                         storage.brotli is not None)
+        # variants are only kept when they are smaller
+        for root, _, files in os.walk(self.static_root):
+            for name in files:
+                if name.endswith('.gz'):
+                    path = os.path.join(root, name)
+                    self.assertLess(os.path.getsize(path),
+                                    os.path.getsize(path[:-3]))
+
+    def testHashedAssetIsImmutableAndCompressed(self):
+        name = self.hashed_name('js/app.js')
+        response = self.get_asset(name, 'gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertTrue(response['Content-Type'].endswith('javascript'))
+        body = gzip.decompress(b''.join(response.streaming_content))
+        with open(os.path.join(self.static_root, name), 'rb') as file:
+            self.assertEqual(body, file.read())
+
+    @skipUnless(storage.brotli is not None, 'brotli is not installed')
+    def testBrotliIsPreferred(self):
+        response = self.get_asset(self.hashed_name('js/app.js'),
+                                  'gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        response = self.get_asset(self.hashed_name('js/app.js'),
+                                  'gzip, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def testIdentityWithoutAcceptEncoding(self):
+        response = self.get_asset(self.hashed_name('css/global.css'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Type'], 'text/css')
+
+    def testUnhashedNameIsRevalidated(self):
+        response = self.get_asset('js/app.js', 'gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=300', response['Cache-Control'])
+        not_modified = self.client.get(
+            '/static/js/app.js',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def testUncollectedFilesFallBackToFinders(self):
+        response = self.get_asset('images/dogs/1.jpg', 'gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+    def testMissingOrEscapingPathsAre404(self):
+        self.assertEqual(self.get_asset('js/missing.js').status_code, 404)
+        self.assertEqual(self.get_asset('../settings.py').status_code, 404)
+        self.assertEqual(self.get_asset('/etc/passwd').status_code, 404)
+
+
+@override_settings(PUGORUGH_QUERY_BUDGET_STRICT=True)
+class QueryBudgetTestCase(PugOrBaseTestCase):
+    """Every endpoint stays within PUGORUGH_QUERY_BUDGETS with cold
+    caches; an N+1 regression raises QueryBudgetExceeded
+    """
+
+    def setUp(self):
+        super().setUp()
+        Dog.objects.bulk_create(
+            Dog(name=make_random_name(5), image_filename='budget.jpg',
+                breed='whuffie', age=random.randrange(100),
+                gender=random.choice(dog_genders),
+                size=random.choice(dog_sizes))
+            for _ in range(30))
+        self.dog_ids = list(Dog.objects.order_by('id')
+                            .values_list('id', flat=True))
+        UserDog.objects.bulk_create(
+            UserDog(user=self.user, dog_id=dog_id, status='l')
+            for dog_id in self.dog_ids[2:20])
+        # no signal, so the first PUT also creates the version row
+        UserPref.objects.bulk_create([UserPref(
+            user=self.user, age='b,y,a,s', gender='m,f', size='s,m,l,xl')])
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+        metrics.registry.clear()
+
+    def cold(self):
+        authentication.token_cache.clear()
+        candidates.invalidate_all()
+        models.userpref_cache.clear()
+
+    def testEndpointsStayWithinBudget(self):
+        dog_id = self.dog_ids[-1]
+        requests = [
+            ('get', '/api/dog/-1/undecided/next/', None),
+            ('get', '/api/dog/{}/liked/next/'.format(self.dog_ids[0]),
+             None),
+            ('get', '/api/dog/-1/undecided/next/page/', None),
+            ('get', '/api/dog/-1/liked/next/page/?limit=20', None),
+            ('get', '/api/dog/popular/?limit=20', None),
+            ('get', '/api/dog/count/?size=s,m', None),
+            ('get', '/api/dog/search/?q=whu&limit=2', None),
+            ('get', '/api/dog/export/', None),
+            ('post', '/api/dog/{}/liked/swipe/'.format(self.dog_ids[25]),
+             None),
+            ('get', '/api/user/dogs/liked/?limit=20', None),
+            ('get', '/api/user/dogs/undecided/', None),
+            ('put', '/api/dog/{}/liked/'.format(dog_id), None),
+            ('put', '/api/dog/{}/undecided/'.format(dog_id), None),
+            ('post', '/api/userdog/batch/',
+             [{'dog_id': dog_id, 'status': 'liked'},
+              {'dog_id': self.dog_ids[3], 'status': 'disliked'}]),
+            ('put', '/api/user/preferences/',
+             {'age': 'b,y', 'gender': 'm,f', 'size': 's,m'}),
+            ('get', '/api/user/preferences/', None),
+            ('put', '/api/user/preferences/',
+             {'age': 'b,y,a,s', 'gender': 'm,f', 'size': 's,m'}),
+            ('get', '/api/metrics/', None),
+        ]
+        for method, path, data in requests:
+            self.cold()
+            response = getattr(self.client, method)(path, data,
+                                                    format='json')
+            self.assertLess(response.status_code, 400, path)
+
+        self.client.credentials()
+        self.client.post('/api/user/',
+                         {'username': 'inu', 'password': 'inu'})
+        response = self.client.post('/api/user/login/',
+                                    {'username': 'inu', 'password': 'inu'})
+        self.cold()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + response.data['token'])
+        self.client.post('/api/user/logout/')
+        endpoints = {item['endpoint'] for item in
+                     metrics.registry.snapshot()['db_queries']}
+        self.assertLessEqual(
+            {'dogview', 'dogview_minus', 'dogview-page', 'dog-popular',
+             'dog-count', 'dog-search', 'dog-export', 'dog-swipe',
+             'userdog-list',
+             'userdogview', 'userdog-batch', 'userpref', 'register-user',
+             'login-user', 'logout-user', 'metrics'},
+            endpoints)
+
+    def testNPlusOneIsCaught(self):
+        # one query per dog, as if the serializer fetched each status
+        def fetch_statuses(serializer, row):
+            list(UserDog.objects.filter(dog=serializer.column(row, 'id')))
+            return None
+
+        # the mappers hold on to the method they were compiled with
+        serializers.compile_row_mappers.cache_clear()
+        self.addCleanup(serializers.compile_row_mappers.cache_clear)
+        with mock.patch.object(serializers.DogRowSerializer,
+                               'get_image_urls', fetch_statuses):
+            with self.assertRaises(metrics.QueryBudgetExceeded):
+                self.client.get('/api/user/dogs/liked/')
+
+    def testMethodSpecificBudget(self):
+        with override_settings(PUGORUGH_QUERY_BUDGETS={'userpref': 100,
+                                                       'userpref:GET': 0}):
+            with self.assertRaises(metrics.QueryBudgetExceeded):
+                self.client.get('/api/user/preferences/')
+
+    @override_settings(PUGORUGH_QUERY_BUDGET_STRICT=False,
+                       PUGORUGH_QUERY_BUDGETS={'dogview_minus': 0})
+    def testNonStrictOnlyLogs(self):
+        with self.assertLogs('pugorugh.metrics', 'WARNING') as logs:
+            response = self.client.get('/api/dog/-1/undecided/next/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('GET dogview_minus ran', logs.output[0])
+
+
+class MetricsTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+        metrics.registry.clear()
+
+    def testHistogramBucketsAreCumulative(self):
+        histogram = metrics.Histogram((1, 5, 10))
+        for value in (0, 1, 3, 7, 50):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(),
+                         [(1, 2), (5, 3), (10, 4), ('+Inf', 5)])
+        self.assertEqual((histogram.count, histogram.sum), (5, 61))
+
+    def testRequestsAreRecordedPerEndpoint(self):
+        self.client.get('/api/dog/-1/undecided/next/page/')
+        self.client.get('/api/dog/-1/undecided/next/page/')
+        self.client.get('/api/user/preferences/')
+        snapshot = metrics.registry.snapshot()
+        page = [item for item in snapshot['request_duration_seconds']
+                if item['endpoint'] == 'dogview-page']
+        self.assertEqual(len(page), 1)
+        self.assertEqual(page[0]['count'], 2)
+        self.assertEqual(page[0]['method'], 'GET')
+        serializer = {item['endpoint']: item for item in
+                      snapshot['serializer_duration_seconds']}
+        self.assertGreater(serializer['dogview-page']['sum'], 0)
+        sizes = {item['endpoint']: item for item in
+                 snapshot['response_size_bytes']}
+        self.assertGreater(sizes['dogview-page']['sum'], 100)
+        queries = {item['endpoint']: item for item in snapshot['db_queries']}
+        self.assertGreaterEqual(queries['userpref']['sum'], 1)
+
+    def testPrometheusExposition(self):
+        self.client.get('/api/dog/-1/undecided/next/')
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        text = response.content.decode()
+        self.assertIn('# TYPE pugorugh_request_duration_seconds histogram',
+                      text)
+        self.assertIn('pugorugh_db_queries_bucket{endpoint="dogview_minus",'
+                      'method="GET",le="+Inf"} 1', text)
+        self.assertIn('pugorugh_cache_hits_total{cache="token"}', text)
+        self.assertIn('pugorugh_cache_size{cache="candidate_queue"} 1', text)
+
+        response = self.client.get('/api/metrics/?format=json')
+        self.assertIn('dogview_minus',
+                      {item['endpoint'] for item in
+                       response.json()['histograms']['db_queries']})
+
+    def testMetricsAreStaffOnly(self):
+        user = User.objects.create_user(username='inu', password='inu')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+
+
+class BenchmarkTestCase(PugOrBaseTestCase):
+    """The load generator itself, on a tiny catalog"""
+
+    def testPercentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertEqual(benchmark.percentile([7], 0.95), 7)
+        self.assertIsNone(benchmark.percentile([], 0.5))
+
+    def testSeedIsReproducible(self):
+        usernames = benchmark.seed(dogs=40, users=4, history=5, seed=1)
+        self.assertEqual(len(usernames), 4)
+        self.assertEqual(Dog.objects.count(), 43)
+        self.assertEqual(UserDog.objects.filter(
+            user__username__in=usernames).count(), 20)
+        for pref in UserPref.objects.filter(user__username__in=usernames):
+            self.assertTrue(UserPrefSerializer(
+                data={'age': pref.age, 'gender': pref.gender,
+                      'size': pref.size}).is_valid())
+        ages = list(Dog.objects.order_by('id').values_list('age', flat=True))
+        Dog.objects.filter(name__startswith='dog').delete()
+        benchmark.seed_dogs(40, random.Random(1))
+        self.assertEqual(
+            list(Dog.objects.order_by('id').values_list('age', flat=True)),
+            ages)
+
+    def testRunDrivesTheSwipeLoop(self):
+        usernames = benchmark.seed(dogs=300, users=3, history=5)
+        result = benchmark.run(benchmark.ClientTransport(), usernames,
+                               new_users=1, sessions=2, swipes=3)
+        self.assertEqual(result['sessions'], 3)
+        self.assertEqual(result['errors'], 0)
+        endpoints = result['endpoints']
+        self.assertEqual(
+            set(endpoints),
+            {'register-user', 'login-user', 'userpref', 'dogview_minus',
+             'dogview', 'userdogview'})
+        self.assertEqual(endpoints['userdogview']['requests'], 9)
+        for stats in endpoints.values():
+            self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+            self.assertLessEqual(stats['p95_ms'], stats['p99_ms'])
+            self.assertIn('db_queries_mean', stats)
+        self.assertEqual(UserDog.objects.filter(
+            user__username='load0-0').count(), 3)
+
+    def testRunWithSwipeEndpoint(self):
+        usernames = benchmark.seed(dogs=300, users=2, history=5)
+        result = benchmark.run(benchmark.ClientTransport(), usernames,
+                               sessions=2, swipes=3, combined=True)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['endpoints']['dog-swipe']['requests'], 6)
+        self.assertNotIn('userdogview', result['endpoints'])
+
+
+@skipUnless(ranking.numpy_available(), 'NumPy is not installed')
+class RankingTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_dir)
+        self.model_path = os.path.join(self.model_dir, 'rankings.npz')
+        patcher = mock.patch.object(ranking, 'model_cache',
+                                    ranking.ModelCache(interval=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = override_settings(
+            PUGORUGH_RANKING=True, PUGORUGH_RANKING_MODEL=self.model_path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        def make_dogs(breed, size, count):
+            Dog.objects.bulk_create(
+                Dog(name=breed, image_filename='x.jpg', breed=breed,
+                    age=30, gender='m', size=size)
+                for _ in range(count))
+            return list(Dog.objects.filter(breed=breed).order_by('id')
+                        .values_list('id', flat=True))
+
+        # corgis get the lower ids, so id order would show them first
+        self.corgis = make_dogs('corgi', 'l', 5)
+        self.pugs = make_dogs('pug', 's', 4)
+        for name, liked in (('a', self.pugs[:3]), ('b', self.pugs[:3]),
+                            ('c', self.corgis[:2])):
+            user = User.objects.create_user(username=name, password=name)
+            UserDog.objects.bulk_create(
+                UserDog(user=user, dog_id=dog_id, status='l')
+                for dog_id in liked)
+        self.fan = User.objects.create_user(username='fan', password='fan')
+        UserDog.objects.bulk_create([
+            UserDog(user=self.fan, dog_id=self.pugs[0], status='l'),
+            UserDog(user=self.fan, dog_id=self.corgis[0], status='d')])
+        self.client.force_authenticate(user=self.fan)
+
+    def build(self, **kwargs):
+        ranking.build_model(**kwargs).save(self.model_path)
+
+    def testModelKeepsTopNeighbours(self):
+        model = ranking.build_model(neighbours=2)
+        self.assertEqual(len(model.indptr), len(model.dog_ids) + 1)
+        self.assertTrue((model.weights <= 1.0001).all())
+        row = model.index_of([self.pugs[0]])[0]
+        neighbours = model.dog_ids[
+            model.indices[model.indptr[row]:model.indptr[row + 1]]]
+        self.assertEqual(sorted(neighbours), sorted(self.pugs[1:3]))
+        # pugs 1 and 2 were liked together by everyone who liked either
+        row = model.index_of([self.pugs[1]])[0]
+        self.assertEqual(model.dog_ids[model.indices[model.indptr[row]]],
+                         self.pugs[2])
+        self.assertAlmostEqual(float(model.weights[model.indptr[row]]), 1)
+        self.assertEqual(model.index_of([10 ** 9])[0], -1)
+
+        model.save(self.model_path)
+        loaded = ranking.RankingModel.load(self.model_path)
+        self.assertEqual(loaded.nbytes, model.nbytes)
+
+    def testRankFavoursSimilarDogs(self):
+        self.build()
+        candidate_ids = list(Dog.objects.exclude(userdog__user=self.fan)
+                             .order_by('id').values_list('id', flat=True))
+        ranked = ranking.rank(self.fan.id, candidate_ids)
+        self.assertEqual(sorted(ranked), candidate_ids)
+        self.assertEqual(ranked[:2], self.pugs[1:3])
+        self.assertLess(ranked.index(self.pugs[3]),
+                        min(ranked.index(dog_id)
+                            for dog_id in self.corgis[1:]))
+
+    def testColdStartKeepsIdOrder(self):
+        self.build()
+        newcomer = User.objects.create_user(username='new', password='new')
+        self.assertIsNone(ranking.rank(newcomer.id, self.pugs))
+        queue = candidates.get_queue(newcomer)
+        self.assertIsInstance(queue, candidates.CandidateQueue)
+        self.assertEqual(queue.dog_ids, sorted(queue.dog_ids))
+
+    def testWithoutModelOrSettingKeepsIdOrder(self):
+        self.assertIsNone(ranking.rank(self.fan.id, self.pugs))
+        self.build()
+        with override_settings(PUGORUGH_RANKING=False):
+            self.assertIsNone(ranking.rank(self.fan.id, self.pugs))
+            response = self.client.get('/api/dog/-1/undecided/next/')
+        self.assertNotIn(response.data['id'], self.pugs)
+
+    def testDogViewWalksTheRanking(self):
+        self.build()
+        first = self.client.get('/api/dog/-1/undecided/next/').data['id']
+        self.assertEqual(first, self.pugs[1])
+        self.client.put('/api/dog/{}/liked/'.format(first))
+        second = self.client.get(
+            '/api/dog/{}/undecided/next/'.format(first)).data['id']
+        self.assertEqual(second, self.pugs[2])
+
+        ranked = candidates.get_queue(self.fan).ids_after(-1, 100)
+        page = self.client.get('/api/dog/-1/undecided/next/page/?limit=3')
+        self.assertEqual([dog['id'] for dog in page.data['results']],
+                         ranked[:3])
+        page = self.client.get('/api/dog/-1/undecided/next/page/?limit=3'
+                               '&cursor=' + page.data['next'])
+        self.assertEqual([dog['id'] for dog in page.data['results']],
+                         ranked[3:6])
+
+    def testQueueIsReRanked(self):
+        self.build()
+        queue = candidates.get_queue(self.fan)
+        self.assertIsInstance(queue, candidates.RankedQueue)
+        with override_settings(PUGORUGH_RANKING_REFRESH=2):
+            self.client.put('/api/dog/{}/liked/'.format(self.pugs[1]))
+            self.assertIs(candidates.get_queue(self.fan), queue)
+            self.client.put('/api/dog/{}/liked/'.format(self.pugs[2]))
+            self.assertIsNot(candidates.get_queue(self.fan), queue)
+
+        # a new model is picked up without any invalidation
+        queue = candidates.get_queue(self.fan)
+        os.utime(self.model_path, (1, 1))
+        self.assertIsNot(candidates.get_queue(self.fan), queue)
+
+    def testRankedQueue(self):
+        queue = candidates.RankedQueue([7, 3, 9, 1])
+        self.assertEqual(queue.next_after(-1), 7)
+        self.assertEqual(queue.next_after(3), 9)
+        queue.discard(9)
+        self.assertEqual(queue.ids_after(7, 5), [3, 1])
+        self.assertNotIn(9, queue)
+        self.assertEqual(len(queue), 3)
+        self.assertIsNone(queue.next_after(1))
+
+    def testScoringLatency(self):
+        # 100k dogs with 20 neighbours each, 200 rated, 50k candidates
+        rng = numpy.random.default_rng(0)
+        count, neighbours = 100000, 20
+        model = ranking.RankingModel(
+            dog_ids=numpy.arange(1, count + 1),
+            size_code=1 << rng.integers(0, 5, count).astype(numpy.uint8),
+            age_bucket=1 << rng.integers(0, 4, count).astype(numpy.uint8),
+            gender_code=1 << rng.integers(0, 3, count).astype(numpy.uint8),
+            breed_code=rng.integers(0, 300, count).astype(numpy.int32),
+            indptr=numpy.arange(0, count * neighbours + 1, neighbours),
+            indices=rng.integers(0, count, count * neighbours).astype(
+                numpy.int32),
+            weights=rng.random(count * neighbours).astype(numpy.float32))
+        rated = rng.choice(count, 200, replace=False) + 1
+        candidate_ids = numpy.setdiff1d(
+            rng.choice(count, 50000, replace=False) + 1, rated)
+        started = time.perf_counter()
+        scores = model.score(rated[:60], rated[60:], candidate_ids)
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(len(scores), len(candidate_ids))
+
+        queue = candidates.RankedQueue(candidate_ids.tolist())
+        started = time.perf_counter()
+        for dog_id in candidate_ids[:1000]:
+            queue.next_after(int(dog_id))
+        self.assertLess(time.perf_counter() - started, 0.05)
+
+
+class PopularityCountersTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.user)
+        self.liked, self.disliked, self.undecided = Dog.objects.order_by('id')
+        # the base rows were bulk created, behind the counters' back
+        self.assertEqual(counters.reconcile(), 2)
+
+    def counts(self, dog):
+        dog.refresh_from_db()
+        return dog.like_count, dog.dislike_count
+
+    def put(self, dog, liked_status):
+        response = self.client.put(reverse('userdogview', kwargs={
+            'pk': dog.id, 'liked_status': liked_status}))
+        self.assertEqual(response.status_code, 201)
+
+    def testPutMaintainsCounters(self):
+        self.assertEqual(self.counts(self.liked), (1, 0))
+        self.assertEqual(self.counts(self.disliked), (0, 1))
+        self.put(self.undecided, 'liked')
+        self.put(self.undecided, 'liked')
+        self.assertEqual(self.counts(self.undecided), (1, 0))
+        self.put(self.undecided, 'disliked')
+        self.assertEqual(self.counts(self.undecided), (0, 1))
+        self.put(self.undecided, 'undecided')
+        self.put(self.undecided, 'undecided')
+        self.assertEqual(self.counts(self.undecided), (0, 0))
+        self.assertFalse(counters.drifted().exists())
+
+    def testBatchMaintainsCounters(self):
+        other = User.objects.create_user(username='inu', password='inu')
+        swipes.record_swipes(other, [(self.liked.id, 'l'),
+                                     (self.undecided.id, 'd')])
+        self.client.post(reverse('userdog-batch'), [
+            {'dog_id': self.liked.id, 'status': 'disliked'},
+            {'dog_id': self.disliked.id, 'status': 'undecided'},
+            {'dog_id': self.undecided.id, 'status': 'liked'},
+        ], format='json')
+        self.assertEqual(self.counts(self.liked), (1, 1))
+        self.assertEqual(self.counts(self.disliked), (0, 0))
+        self.assertEqual(self.counts(self.undecided), (1, 1))
+        self.assertFalse(counters.drifted().exists())
+
+    def testReconcileFixesDrift(self):
+        Dog.objects.filter(id=self.undecided.id).update(like_count=7)
+        out = io.StringIO()
+        call_command('reconcile_counts', '--dry-run', stdout=out)
+        self.assertIn('1 dogs', out.getvalue())
+        self.assertEqual(self.counts(self.undecided), (7, 0))
+        call_command('reconcile_counts', stdout=out)
+        self.assertEqual(self.counts(self.undecided), (0, 0))
+        self.assertEqual(counters.reconcile(), 0)
+
+    def testPopularDogs(self):
+        for name in ('a', 'b'):
+            user = User.objects.create_user(username=name, password=name)
+            swipes.record_swipes(user, [(self.undecided.id, 'l'),
+                                        (self.liked.id, 'd')])
+        response = self.client.get(reverse('dog-popular'), {'limit': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(dog['id'], dog['like_count'], dog['dislike_count'])
+             for dog in response.data],
+            [(self.undecided.id, 2, 0), (self.liked.id, 1, 2)])
+        response = self.client.get(reverse('dog-popular'))
+        self.assertEqual(len(response.data), 3)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite')
+    def testPopularDogsPlan(self):
+        sql, params = (Dog.objects.order_by('-like_count', 'id')[:10]
+                       .query.sql_with_params())
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertEqual(plan, ['SCAN pugorugh_dog USING INDEX '
+                                'dog_like_count_id_idx'])
+
+
+class DogSwipeViewTestCase(PugOrBaseTestCase):
+    """The one round trip swipe; inside the test transaction the write
+    and the fetch run in turn
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.user)
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg', gender='m', size='s')
+            for i in range(2))
+        self.dog_ids = list(Dog.objects.order_by('id')
+                            .values_list('id', flat=True))
+
+    def swipe(self, dog_id, liked_status):
+        return self.client.post(reverse('dog-swipe', kwargs={
+            'pk': dog_id, 'liked_status': liked_status}))
+
+    def testSwipeRecordsAndReturnsNext(self):
+        response = self.swipe(self.dog_ids[2], 'liked')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['next']['id'], self.dog_ids[3])
+        self.assertEqual(UserDog.objects.get(
+            user=self.user, dog_id=self.dog_ids[2]).status, 'l')
+        self.assertEqual(Dog.objects.get(id=self.dog_ids[2]).like_count, 1)
+        self.assertNotIn(self.dog_ids[2], candidates.get_queue(self.user))
+
+        response = self.swipe(self.dog_ids[4], 'disliked')
+        self.assertIsNone(response.data['next'])
+
+    def testSwipeUnknownDog(self):
+        response = self.swipe(999999, 'liked')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(UserDog.objects.count(), 2)
+
+
+class ASGIHandlerTestCase(APITransactionTestCase):
+    """Requests through asgi.ASGIHandler run in pool threads with their
+    own connections, so the data has to be committed
+    """
+
+    def setUp(self):
+        authentication.token_cache.clear()
+        candidates.invalidate_all()
+        models.userpref_cache.clear()
+        self.user = User.objects.create_user(username='wanchan',
+                                             password='wanchan')
+        self.token = Token.objects.create(user=self.user)
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg', gender='m', size='s')
+            for i in range(3))
+        self.dog_ids = list(Dog.objects.order_by('id')
+                            .values_list('id', flat=True))
+        self.handler = asgi.ASGIHandler(get_wsgi_application())
+
+    async def call(self, method, path, body=b'', query=b''):
+        messages = [{'type': 'http.request', 'body': body[:5],
+                     'more_body': True},
+                    {'type': 'http.request', 'body': body[5:]}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query, 'root_path': '',
+                 'headers': [
+                     (b'authorization', b'Token ' + self.token.key.encode()),
+                     (b'content-type', b'application/json')],
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 1)}
+        await self.handler(scope, receive, send)
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertFalse(sent[-1].get('more_body', False))
+        return (sent[0]['status'], dict(sent[0]['headers']),
+                b''.join(message['body'] for message in sent[1:]))
+
+    def testRequestRunsInThePool(self):
+        status, headers, body = asyncio.run(
+            self.call('GET', '/api/dog/-1/undecided/next/'))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(json.loads(body.decode())['id'], self.dog_ids[0])
+
+    def testConcurrentRequests(self):
+        async def many():
+            return await asyncio.gather(*[
+                self.call('GET', '/api/dog/{}/undecided/next/'.format(pk))
+                for pk in [-1] + self.dog_ids[:2]])
+        responses = asyncio.run(many())
+        self.assertEqual([json.loads(body.decode())['id']
+                          for status, headers, body in responses],
+                         self.dog_ids)
+
+    def testRequestBodyAndQueryString(self):
+        body = json.dumps([{'dog_id': self.dog_ids[0],
+                            'status': 'liked'}]).encode()
+        status, headers, content = asyncio.run(
+            self.call('POST', '/api/userdog/batch/', body))
+        self.assertEqual(status, 200)
+        self.assertEqual(UserDog.objects.get(user=self.user).status, 'l')
+        status, headers, content = asyncio.run(
+            self.call('GET', '/api/dog/popular/', query=b'limit=1'))
+        self.assertEqual(json.loads(content.decode())[0]['id'],
+                         self.dog_ids[0])
+
+    def testStreamingResponse(self):
+        status, headers, body = asyncio.run(
+            self.call('GET', '/static/css/global.css'))
+        self.assertEqual(status, 200)
+        with open(finders.find('css/global.css'), 'rb') as file:
+            self.assertEqual(body, file.read())
+
+    def testLifespan(self):
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(self.handler({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+
+    def testSwipeOverlapsWriteAndFetch(self):
+        self.client.force_authenticate(user=self.user)
+        with mock.patch.object(pool.task_pool, 'submit',
+                               wraps=pool.task_pool.submit) as submit:
+            response = self.client.post(reverse('dog-swipe', kwargs={
+                'pk': self.dog_ids[0], 'liked_status': 'liked'}))
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual(response.data['next']['id'], self.dog_ids[1])
+        self.assertEqual(Dog.objects.get(id=self.dog_ids[0]).like_count, 1)
+
+    def testTaskPoolQueriesCount(self):
+        self.client.force_authenticate(user=self.user)
+        Dog.objects.create(name='3', image_filename='x.jpg', gender='m',
+                           size='s')
+        next_dog = DogSwipeView.next_dog
+
+        def next_dog_and_query(dog_id, context):
+            Dog.objects.count()
+            return next_dog(dog_id, context)
+
+        self.client.post(reverse('dog-swipe', kwargs={
+            'pk': self.dog_ids[0], 'liked_status': 'liked'}))
+        counted = []
+        for dog_id, fetch in ((self.dog_ids[1], next_dog),
+                              (self.dog_ids[2], next_dog_and_query)):
+            with mock.patch.object(DogSwipeView, 'next_dog',
+                                   staticmethod(fetch)), \
+                    mock.patch.object(metrics, 'check_query_budget') as \
+                    check:
+                self.client.post(reverse('dog-swipe', kwargs={
+                    'pk': dog_id, 'liked_status': 'liked'}))
+            counted.append(check.call_args[0][2])
+        self.assertEqual(counted[1], counted[0] + 1)
+
+
+class CrossProcessQueueTestCase(APITransactionTestCase):
+    """Candidate queues notice writes made by another process, here a
+    second connection writing without this process's signals
+    """
+
+    def setUp(self):
+        authentication.token_cache.clear()
+        candidates.invalidate_all()
+        catalog.clear()
+        models.userpref_cache.clear()
+        self.user = User.objects.create_user(username='wanchan',
+                                             password='wanchan')
+        self.client.force_authenticate(self.user)
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg', gender='m', size='s')
+            for i in range(3))
+        self.dog_ids = list(Dog.objects.order_by('id')
+                            .values_list('id', flat=True))
+        other = ConnectionHandler(
+            {'default': dict(connection.settings_dict)})['default']
+        self.addCleanup(other.close)
+        self.other = other
+
+    def other_process(self, sql, params, *keys):
+        """Write and bump version counters as another worker would"""
+        with self.other.cursor() as cursor:
+            cursor.execute(sql, params)
+            for key in keys:
+                cursor.execute('UPDATE pugorugh_version SET value = value + 1 '
+                               'WHERE key = %s', [key])
+                if not cursor.rowcount:
+                    cursor.execute('INSERT INTO pugorugh_version '
+                                   '(key, value, modified) '
+                                   'VALUES (%s, 1, CURRENT_TIMESTAMP)',
+                                   [key])
+
+    def next_dog(self):
+        response = self.client.get('/api/dog/-1/undecided/next/')
+        return response.data['id'] if response.status_code == 200 else None
+
+    def testQueueFollowsOtherProcesses(self):
+        self.assertEqual(self.next_dog(), self.dog_ids[0])
+        self.other_process(
+            'INSERT INTO pugorugh_userdog (user_id, dog_id, status) '
+            'VALUES (%s, %s, %s)', [self.user.id, self.dog_ids[0], 'l'],
+            versions.userdogs_key(self.user.id))
+        self.assertEqual(self.next_dog(), self.dog_ids[1])
+
+        # e.g. import_dogs or an admin deleting dogs
+        self.other_process('DELETE FROM pugorugh_dog WHERE id = %s',
+                           [self.dog_ids[1]], versions.CATALOG)
+        self.assertEqual(self.next_dog(), self.dog_ids[2])
+
+        # this process's own writes keep the queue instead of rebuilding
+        queue = candidates.get_queue(self.user)
+        UserDog.objects.create(user=self.user, dog_id=self.dog_ids[2],
+                               status='d')
+        self.assertIsNone(self.next_dog())
+        self.assertIs(candidates.get_queue(self.user), queue)
+
+
+class CatalogSnapshotTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(7)
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg',
+                age=rng.choice([None, rng.randrange(400)]),
+                gender=rng.choice(models.dog_genders + ['']),
+                size=rng.choice(models.dog_sizes + ['']))
+            for i in range(80))
+        self.preferences = [{}]
+        for i in range(20):
+            self.preferences.append(UserPref(
+                gender=','.join(rng.sample(models.userpref_genders,
+                                           rng.randrange(3))),
+                size=','.join(rng.sample(models.userpref_sizes,
+                                         rng.randrange(5))),
+                age=','.join(rng.sample(models.userpref_ages,
+                                        rng.randrange(5)))).dog_lookups())
+
+    def assertMatchesORM(self):
+        snapshot = catalog.CatalogSnapshot.load()
+        self.assertEqual(len(snapshot), Dog.objects.count())
+        decided = [self.user.userdog_set.first().dog_id]
+        for lookups in self.preferences:
+            expected = list(Dog.objects.filter(**lookups).order_by('id')
+                            .values_list('id', flat=True))
+            self.assertEqual(list(snapshot.matching_ids(lookups)),
+                             expected)
+            self.assertEqual(snapshot.undecided_ids(lookups, decided),
+                             [dog_id for dog_id in expected
+                              if dog_id not in decided])
+            for dog_id in expected[:3]:
+                self.assertTrue(snapshot.matches(lookups, dog_id))
+            self.assertFalse(snapshot.matches(lookups, 0))
+
+    @skipUnless(catalog.numpy_available(), 'needs NumPy')
+    def testMatchesTheORMWithNumPy(self):
+        self.assertMatchesORM()
+
+    def testMatchesTheORMWithArrays(self):
+        with mock.patch.object(catalog, 'np', None):
+            self.assertMatchesORM()
+
+    def testReloadsAfterCatalogWrites(self):
+        snapshot = catalog.get_snapshot()
+        self.assertIs(catalog.get_snapshot(), snapshot)
+        dog = Dog.objects.create(name='new', image_filename='x.jpg')
+        reloaded = catalog.get_snapshot()
+        self.assertIsNot(reloaded, snapshot)
+        self.assertEqual(reloaded.dog_ids[-1], dog.id)
+
+    def testCandidateQueueFromSnapshot(self):
+        UserPref.objects.create(user=self.user, gender='m,f', size='s,m',
+                                age='')
+        expected = list(Dog.objects.for_userpref(self.user)
+                        .undecided_by(self.user).order_by('id')
+                        .values_list('id', flat=True))
+        with override_settings(PUGORUGH_CATALOG_SNAPSHOT=True):
+            self.assertEqual(candidates.get_queue(self.user).dog_ids,
+                             expected)
+            UserDog.objects.filter(user=self.user).delete()
+            expected = list(Dog.objects.for_userpref(self.user)
+                            .order_by('id').values_list('id', flat=True))
+            self.assertEqual(candidates.get_queue(self.user).dog_ids,
+                             expected)
+            liked = self.user.userdog_set.create(dog_id=expected[0],
+                                                 status='l')
+            self.client.credentials(
+                HTTP_AUTHORIZATION='Token ' + self.token.key)
+            response = self.client.get('/api/dog/-1/undecided/next/')
+            self.assertEqual(response.data['id'], expected[1])
+            liked.delete()
+            response = self.client.get('/api/dog/-1/undecided/next/')
+            self.assertEqual(response.data['id'], expected[0])
+
+
+class RowSerializerTestCase(PugOrBaseTestCase):
+    """Row serializers must render exactly the JSON of the
+    ModelSerializers they stand in for
+    """
+
+    def setUp(self):
+        super().setUp()
+        Dog.objects.bulk_create([
+            Dog(name='Ünïcode "dog"', image_filename='1.jpg', age=None,
+                gender='', size=''),
+            Dog(name='', image_filename='2.jpg', breed='Pug', age=0,
+                gender='f', size='xl'),
+        ])
+        Dog.objects.filter(name='').update(like_count=3, dislike_count=-1)
+        manifest = {'1.jpg': {'card': 'ab/1-card.jpg',
+                              'thumb_webp': 'ab/1-thumb.webp'}}
+        patcher = mock.patch.object(images.manifest_cache, 'get',
+                                    return_value=manifest)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertSameJSON(self, expected, actual):
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(expected), renderer.render(actual))
+
+    def testDogRows(self):
+        dogs = Dog.objects.order_by('id')
+        rows = dogs.values(*serializers.DogRowSerializer.columns())
+        self.assertSameJSON(DogSerializer(dogs, many=True).data,
+                            serializers.DogRowSerializer(rows,
+                                                         many=True).data)
+        self.assertSameJSON(DogSerializer(dogs.last()).data,
+                            serializers.DogRowSerializer(rows.last()).data)
+
+    def testPopularDogRows(self):
+        dogs = Dog.objects.order_by('-like_count', 'id')
+        rows = dogs.values(*serializers.PopularDogRowSerializer.columns())
+        self.assertSameJSON(
+            serializers.PopularDogSerializer(dogs, many=True).data,
+            serializers.PopularDogRowSerializer(rows, many=True).data)
+
+    def testUserDogRows(self):
+        userdogs = UserDog.objects.filter(user=self.user).order_by('dog_id')
+        rows = userdogs.values(*serializers.UserDogRowSerializer.columns())
+        self.assertSameJSON(
+            DogSerializer([userdog.dog for userdog in userdogs],
+                          many=True).data,
+            serializers.UserDogRowSerializer(rows, many=True).data)
+
+    def testOnlyFlatFieldsCompile(self):
+        class StatusRowSerializer(serializers.RowSerializer):
+            model_serializer = DogSerializer
+
+            def get_image_urls(self, row):
+                return None
+
+        with self.assertRaises(ImproperlyConfigured):
+            StatusRowSerializer.columns()
+
+    def testSerializerCosts(self):
+        costs = benchmark.serializer_costs(repeat=1)
+        self.assertTrue(costs['identical'])
+        self.assertEqual(costs['dogs'], 5)
+        self.assertEqual(set(costs['row']),
+                         {'fetch_us', 'serialize_us', 'render_us'})
+
+
+class MatchCountTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(3)
+        for i in range(40):
+            Dog.objects.create(
+                name=str(i), image_filename='x.jpg',
+                age=rng.choice([None, rng.randrange(400)]),
+                gender=rng.choice(models.dog_genders),
+                size=rng.choice(models.dog_sizes))
+        # the base test case bulk creates dogs, which skips the signals
+        matchcounts.rebuild()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def assertCountsMatch(self):
+        rng = random.Random(5)
+        for i in range(20):
+            lookups = UserPref(**benchmark.random_prefs(rng)).dog_lookups()
+            self.assertEqual(matchcounts.count(lookups),
+                             Dog.objects.filter(**lookups).count())
+        self.assertEqual(matchcounts.count({}), Dog.objects.count())
+
+    def testCountsFollowDogWrites(self):
+        self.assertCountsMatch()
+        dog = Dog.objects.order_by('id').last()
+        dog.gender = 'f' if dog.gender == 'm' else 'm'
+        dog.age = 3 if (dog.age or 0) > 6 else 30
+        dog.save()
+        Dog(id=dog.id, name='replaced', image_filename='x.jpg',
+            gender='u', size='xl', age=100).save()
+        Dog.objects.order_by('id').first().delete()
+        Dog.objects.filter(id__in=Dog.objects.order_by('id')
+                           .values_list('id', flat=True)[:5]).delete()
+        with transaction.atomic():
+            Dog.objects.create(name='new', image_filename='x.jpg',
+                               gender='m', size='s', age=2)
+        self.assertCountsMatch()
+
+    def testImportAppliesDeltas(self):
+        first = Dog.objects.order_by('id').first()
+        records = [{'name': 'moved', 'image_filename': first.image_filename,
+                    'gender': 'u', 'size': 'xl', 'age': 200}]
+        records.extend({'name': 'new{}'.format(i),
+                        'image_filename': 'new{}.jpg'.format(i),
+                        'gender': 'f', 'size': 'm', 'age': i}
+                       for i in range(5))
+        with mock.patch.object(matchcounts, 'rebuild') as rebuild:
+            importer.import_dogs(records, chunk_size=2,
+                                 key='image_filename')
+        rebuild.assert_not_called()
+        self.assertCountsMatch()
+
+    def testCatalogChangedRebuilds(self):
+        Dog.objects.bulk_create([Dog(name='bulk', image_filename='x.jpg',
+                                     gender='m', size='s', age=2)])
+        signals.catalog_changed.send(sender=Dog, dog_ids=[])
+        self.assertCountsMatch()
+
+    def testPostMigrateWritesOnlyWhenStale(self):
+        signals.encode_dog_attributes(sender=None, using='default')
+        with CaptureQueriesContext(connection) as queries:
+            signals.encode_dog_attributes(sender=None, using='default')
+        self.assertEqual([query['sql'] for query in queries
+                          if query['sql'].startswith(
+                              ('INSERT', 'UPDATE', 'DELETE'))], [])
+
+        dog = Dog.objects.order_by('id').first()
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE pugorugh_dog SET gender_code = 0, '
+                           'age_bucket = 0 WHERE id = %s', [dog.id])
+            cursor.execute('DELETE FROM pugorugh_dogcount')
+        self.assertEqual(list(Dog.objects.stale_codes()), [dog])
+        signals.encode_dog_attributes(sender=None, using='default')
+        self.assertFalse(Dog.objects.stale_codes().exists())
+        self.assertCountsMatch()
+
+    def testCountEndpoint(self):
+        response = self.client.get('/api/dog/count/')
+        self.assertEqual(response.data, {'count': Dog.objects.count()})
+        UserPref.objects.create(user=self.user, gender='m', size='s,m,l',
+                                age='')
+        saved = UserPref.objects.get(user=self.user).dog_lookups()
+        response = self.client.get('/api/dog/count/')
+        self.assertEqual(response.data['count'],
+                         Dog.objects.filter(**saved).count())
+        response = self.client.get('/api/dog/count/',
+                                   {'gender': 'm,f', 'age': 'b'})
+        self.assertEqual(response.data['count'], Dog.objects.filter(
+            gender__in=['m', 'f'], size__in=['s', 'm', 'l'],
+            age__lte=6).count())
+        response = self.client.get('/api/dog/count/', {'gender': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+
+class DogSearchTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, breed, gender in [('Biscuit', 'Labrador Retriever', 'm'),
+                                    ('Labby', 'Pug', 'f'),
+                                    ('Zoë', 'Labrador', 'f'),
+                                    ('Rex', 'Golden Retriever', 'm')]:
+            Dog.objects.create(name=name, breed=breed, gender=gender,
+                               size='m', age=30, image_filename='x.jpg')
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def names(self, text, queryset=None):
+        queryset = Dog.objects.all() if queryset is None else queryset
+        return sorted(search.filter_dogs(queryset, text)
+                      .values_list('name', flat=True))
+
+    def testPrefixMatching(self):
+        self.assertEqual(self.names('lab'), ['Biscuit', 'Labby', 'Zoë'])
+        self.assertEqual(self.names('Lab ret'), ['Biscuit'])
+        self.assertEqual(self.names('retriever'), ['Biscuit', 'Rex'])
+        self.assertEqual(self.names('zoe'), ['Zoë'])
+        self.assertEqual(self.names('"and" or NEAR('), [])
+        self.assertEqual(self.names(' ?! '), [])
+
+    @skipUnless(search.supported(), 'needs SQLite with FTS5')
+    def testIndexFollowsDogWrites(self):
+        rex = Dog.objects.get(name='Rex')
+        rex.breed = 'Poodle'
+        rex.save()
+        Dog.objects.get(name='Labby').delete()
+        self.assertEqual(self.names('ret'), ['Biscuit'])
+        self.assertEqual(self.names('poo'), ['Rex'])
+        self.assertEqual(self.names('labby'), [])
+
+        # bulk writes are indexed through catalog_changed
+        importer.import_dogs([{'name': 'Spot', 'breed': 'Pointer',
+                               'image_filename': 'spot.jpg', 'age': 5,
+                               'gender': 'm', 'size': 's'}])
+        self.assertEqual(self.names('poi'), ['Spot'])
+        self.assertEqual(self.names('whuffie'), [])
+        self.assertEqual(search.rebuild(), Dog.objects.count())
+        self.assertEqual(len(self.names('whuffie')), 3)
+
+    @skipUnless(search.supported(), 'needs SQLite with FTS5')
+    def testSearchUsesTheIndex(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.names('lab')
+        self.assertIn(search.TABLE, queries.captured_queries[0]['sql'])
+        self.assertNotIn('LIKE', queries.captured_queries[0]['sql'])
+
+    def testSearchEndpoint(self):
+        response = self.client.get('/api/dog/search/',
+                                   {'q': 'lab', 'limit': 2})
+        self.assertEqual([dog['name'] for dog in response.data['results']],
+                         ['Biscuit', 'Labby'])
+        self.assertEqual(set(response.data['results'][0]),
+                         set(DogSerializer.Meta.fields) - {'status'})
+        response = self.client.get('/api/dog/search/', {
+            'q': 'lab', 'limit': 2, 'cursor': response.data['next']})
+        self.assertEqual([dog['name'] for dog in response.data['results']],
+                         ['Zoë'])
+        self.assertIsNone(response.data['next'])
+
+        # combined with the saved preferences, or the ones given
+        UserPref.objects.create(user=self.user, gender='f', size='m', age='')
+        response = self.client.get('/api/dog/search/', {'q': 'lab'})
+        self.assertEqual([dog['name'] for dog in response.data['results']],
+                         ['Labby', 'Zoë'])
+        response = self.client.get('/api/dog/search/',
+                                   {'q': 'lab', 'gender': 'm'})
+        self.assertEqual([dog['name'] for dog in response.data['results']],
+                         ['Biscuit'])
+
+        for params in ({}, {'q': '  '}, {'q': 'lab', 'size': 'huge'}):
+            response = self.client.get('/api/dog/search/', params)
+            self.assertEqual(response.status_code, 400)
+
+
+class DogExportTestCase(PugOrBaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def export(self, **params):
+        response = self.client.get('/api/dog/export/', params,
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = gzip.decompress(b''.join(response.streaming_content))
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        return lines, response['X-Next-Since']
+
+    def testFullExport(self):
+        lines, since = self.export()
+        self.assertEqual([line['id'] for line in lines],
+                         list(Dog.objects.order_by('id')
+                              .values_list('id', flat=True)))
+        self.assertEqual(set(lines[0]),
+                         set(DogSerializer.Meta.fields) - {'status'}
+                         | {'updated_at'})
+        dog = Dog.objects.get(id=lines[0]['id'])
+        self.assertEqual(
+            {key: value for key, value in lines[0].items()
+             if key != 'updated_at'},
+            json.loads(JSONRenderer().render(DogSerializer(dog).data)))
+
+        response = self.client.get('/api/dog/export/',
+                                   HTTP_ACCEPT_ENCODING='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(len(b''.join(response.streaming_content)
+                             .splitlines()), len(lines))
+
+    def testChangesSince(self):
+        dogs = list(Dog.objects.order_by('id'))
+        lines, since = self.export()
+        self.assertEqual(self.export(since=since)[0], [])
+
+        dogs[0].name = 'renamed'
+        dogs[0].save()
+        deleted_id = dogs[1].id
+        dogs[1].delete()
+        new_dog = Dog.objects.create(name='new', image_filename='new.jpg',
+                                     gender='m', size='s', age=3)
+        importer.import_dogs([{'name': 'imported',
+                               'image_filename': dogs[2].image_filename,
+                               'gender': 'f', 'size': 'l', 'age': 40}],
+                             key='image_filename')
+        lines, next_since = self.export(since=since)
+        # in the order the writes happened
+        self.assertEqual([(line['id'], line.get('name')) for line in lines],
+                         [(dogs[0].id, 'renamed'),
+                          (deleted_id, None),
+                          (new_dog.id, 'new'),
+                          (dogs[2].id, 'imported')])
+        self.assertTrue(lines[1]['deleted'])
+        self.assertGreater(int(next_since), int(since))
+        self.assertEqual(self.export(since=next_since)[0], [])
+
+        response = self.client.get('/api/dog/export/', {'since': 'soon'})
+        self.assertEqual(response.status_code, 400)
+
+    def testReusedIdEndsUpPresent(self):
+        _, since = self.export()
+        dog = Dog.objects.order_by('id').last()
+        dog_id = dog.id
+        dog.delete()
+        # SQLite hands the largest id out again
+        Dog.objects.create(id=dog_id, name='reused', image_filename='r.jpg',
+                           gender='m', size='s', age=3)
+        lines, _ = self.export(since=since)
+        self.assertEqual([(line['id'], line.get('deleted'), line.get('name'))
+                          for line in lines],
+                         [(dog_id, True, None), (dog_id, None, 'reused')])
+
+    def testWritesNumberedInTheirTransaction(self):
+        dog = Dog.objects.order_by('id').first()
+        dog.save()
+        first = Dog.objects.get(id=dog.id).change_seq
+        with transaction.atomic():
+            dog.save()
+            numbered = Dog.objects.get(id=dog.id).change_seq
+            self.assertEqual(export.last_change(), numbered)
+        self.assertEqual(numbered, first + 1)
+
+    def testGzipStreamIsBuffered(self):
+        rng = random.Random(0)
+        chunks = [b'%016x' % rng.getrandbits(64) for i in range(5000)]
+        compressed = list(export.gzip_stream(iter(chunks), buffer_size=4096))
+        self.assertGreater(len(compressed), 1)
+        self.assertTrue(all(len(chunk) >= 4096
+                            for chunk in compressed[:-1]))
+        self.assertEqual(gzip.decompress(b''.join(compressed)),
+                         b''.join(chunks))
+        self.assertEqual(b''.join(export.batched(iter(chunks), 4096)),
+                         b''.join(chunks))
+
+
+class SQLiteContentionTestCase(APITransactionTestCase):
+    """Tuned SQLite connections and coalesced swipes from threads with
+    their own connections
+    """
+
+    def setUp(self):
+        candidates.invalidate_all()
+        self.users = [User.objects.create_user(username='user{}'.format(i))
+                      for i in range(4)]
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg', gender='m', size='s')
+            for i in range(10))
+        self.dog_ids = list(Dog.objects.order_by('id')
+                            .values_list('id', flat=True))
+
+    def tuned_connection(self, **options):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database = dict(settings.PUGORUGH_SQLITE_TUNED_DATABASE,
+                        NAME=os.path.join(directory, 'tuned.sqlite3'))
+        database['OPTIONS'] = dict(database['OPTIONS'], **options)
+        tuned = ConnectionHandler({'default': database})['default']
+        self.addCleanup(tuned.close)
+        return tuned
+
+    def testTunedBackendSetsPragmas(self):
+        tuned = self.tuned_connection()
+        with tuned.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -16000)
+
+    def testTunedBackendTakesTheWriteLockUpFront(self):
+        tuned = self.tuned_connection()
+        tuned.ensure_connection()
+        tuned._start_transaction_under_autocommit()
+        other = sqlite3.connect(tuned.settings_dict['NAME'], timeout=0)
+        self.addCleanup(other.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'locked'):
+            other.execute('BEGIN IMMEDIATE')
+        tuned.connection.rollback()
+        other.execute('BEGIN IMMEDIATE')
+
+    def testUnknownTransactionMode(self):
+        tuned = self.tuned_connection(transaction_mode='LATER')
+        tuned.ensure_connection()
+        with self.assertRaises(ValueError):
+            tuned._start_transaction_under_autocommit()
+
+    def testCoalescerWritesConcurrentSwipesTogether(self):
+        coalescer = swipes.WriteCoalescer(wait=5, max_batch=4)
+        results = {}
+
+        def swipe(user):
+            try:
+                results[user.id] = coalescer.submit(
+                    user.id, self.dog_ids[0], 'l')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=swipe, args=(user,))
+                   for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(coalescer.flushes, 1)
+        self.assertEqual(set(results.values()), {swipes.CREATED})
+        self.assertEqual(UserDog.objects.filter(
+            dog_id=self.dog_ids[0], status='l').count(), 4)
+        self.assertEqual(Dog.objects.get(id=self.dog_ids[0]).like_count, 4)
+
+    def testCoalescerReportsSupersededDecisions(self):
+        user_id = self.users[0].id
+        batch = [swipes.PendingDecision(user_id, self.dog_ids[0], 'l'),
+                 swipes.PendingDecision(user_id, self.dog_ids[0], 'd')]
+        swipes.WriteCoalescer().flush(batch)
+        self.assertEqual([item.result for item in batch],
+                         [swipes.SUPERSEDED, swipes.CREATED])
+        self.assertEqual(UserDog.objects.get(user_id=user_id).status, 'd')
+
+    def testCoalescerHandsOutErrors(self):
+        coalescer = swipes.WriteCoalescer(wait=0)
+        self.assertEqual(coalescer.submit(self.users[0].id, 0, 'l'),
+                         swipes.NOT_FOUND)
+        with self.assertRaises(IntegrityError):
+            coalescer.submit(0, self.dog_ids[0], 'l')
+        self.assertFalse(UserDog.objects.exists())
+
+    def testContentionWorkload(self):
+        # the in-memory test database locks whole tables, so one thread
+        result = contention.workload([self.users[0].id], self.dog_ids,
+                                     swipes=5)
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(len(result['latencies']), 5)
+        self.assertEqual(UserDog.objects.count(), 5)
+        self.assertFalse(counters.drifted().exists())
+
+
+@override_settings(PUGORUGH_READ_REPLICAS=['replica'])
+class ReplicaRouterTestCase(APITransactionTestCase):
+    """The replica alias is a second test database, filled from the
+    primary by routers.sync_replicas
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        authentication.token_cache.clear()
+        candidates.invalidate_all()
+        models.userpref_cache.clear()
+        self.user = User.objects.create_user(username='wanchan',
+                                             password='wanchan')
+        self.token = Token.objects.create(user=self.user)
+        Dog.objects.bulk_create(
+            Dog(name=str(i), image_filename='x.jpg', gender='m', size='s')
+            for i in range(3))
+        self.dog_ids = list(Dog.objects.using('default').order_by('id')
+                            .values_list('id', flat=True))
+
+    def next_dog_id(self):
+        candidates.invalidate_all()
+        response = self.client.get('/api/dog/-1/undecided/next/',
+                                   HTTP_AUTHORIZATION='Token ' +
+                                   self.token.key)
+        return response.data['id'] if response.status_code == 200 else None
+
+    def testCatalogReadsGoToReplicas(self):
+        self.assertEqual(Dog.objects.all().db, 'replica')
+        self.assertEqual(UserPref.objects.all().db, 'replica')
+        self.assertEqual(UserDog.objects.all().db, 'default')
+        self.assertFalse(Dog.objects.exists())
+        self.assertEqual(routers.sync_replicas(), ['replica'])
+        self.assertEqual(Dog.objects.count(), 3)
+        Dog.objects.create(name='new', image_filename='x.jpg')
+        self.assertEqual(Dog.objects.count(), 3)
+        self.assertEqual(Dog.objects.using('default').count(), 4)
+
+    def testReplicaRowsRelateToThePrimary(self):
+        routers.sync_replicas()
+        dog = Dog.objects.get(id=self.dog_ids[0])
+        UserDog.objects.create(user=self.user, dog=dog, status='l')
+        dog.name = 'renamed'
+        dog.save()
+        self.assertEqual(Dog.objects.using('default')
+                         .get(id=dog.id).name, 'renamed')
+
+    def testTransactionsReadFromThePrimary(self):
+        with transaction.atomic():
+            self.assertEqual(Dog.objects.count(), 3)
+
+    def testReadYourWritesAfterSwipe(self):
+        routers.sync_replicas()
+        response = self.client.put(
+            '/api/dog/{}/liked/'.format(self.dog_ids[0]),
+            HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(self.next_dog_id(), self.dog_ids[1])
+        # without the pin, the lagging replica still offers the dog
+        self.client.cookies.clear()
+        self.assertEqual(self.next_dog_id(), self.dog_ids[0])
+        routers.sync_replicas()
+        self.assertEqual(self.next_dog_id(), self.dog_ids[1])
+
+    def testSafeRequestsDoNotPin(self):
+        routers.sync_replicas()
+        self.next_dog_id()
+        self.assertNotIn(routers.PIN_COOKIE, self.client.cookies)
+
+    def testPoolTasksKeepThePin(self):
+        with routers.routing(pinned=True):
+            future = pool.task_pool.submit(lambda: Dog.objects.all().db)
+            self.assertEqual(future.result(), 'default')
+        future = pool.task_pool.submit(lambda: Dog.objects.all().db)
+        self.assertEqual(future.result(), 'replica')
@@ -1,3 +1,6 @@
+import re
+
+from django.conf import settings
 from django.conf.urls import url
 from django.views.generic import TemplateView
 from django.views.generic.base import RedirectView
@@ -5,11 +8,15 @@ from django.views.generic.base import RedirectView
 from rest_framework.urlpatterns import format_suffix_patterns
 from rest_framework.authtoken.views import obtain_auth_token
 
-from .views import DogView, UserDogView, UserPreferenceView, UserRegisterView
+from .views import DogCountView, DogExportView, DogPageView, \
+    DogSearchView, DogSwipeView, DogView, MetricsView, PopularDogView, \
+    UserDogBatchView, UserDogListView, UserDogView, UserLogoutView, \
+    UserPreferenceView, UserRegisterView, static_asset
 
 # API endpoints
 urlpatterns = format_suffix_patterns([
     url(r'^api/user/login/$', obtain_auth_token, name='login-user'),
+    url(r'^api/user/logout/$', UserLogoutView.as_view(), name='logout-user'),
     url(r'^api/user/$', UserRegisterView.as_view(), name='register-user'),
     url(r'^favicon\.ico$',
         RedirectView.as_view(
@@ -17,6 +24,44 @@ urlpatterns = format_suffix_patterns([
             permanent=True
         )),
     url(r'^$', TemplateView.as_view(template_name='index.html')),
+    url(r'^{}(?P<path>.+)$'.format(
+        re.escape(settings.STATIC_URL.lstrip('/'))),
+        static_asset,
+        name='static-asset'),
+
+    url(r'^api/user/dogs/(?P<liked_status>liked|disliked|undecided)/$',
+        UserDogListView.as_view(),
+        name='userdog-list'),
+
+    url(r'^api/userdog/batch/$',
+        UserDogBatchView.as_view(),
+        name='userdog-batch'),
+
+    url(r'^api/dog/popular/$',
+        PopularDogView.as_view(),
+        name='dog-popular'),
+
+    url(r'^api/dog/count/$',
+        DogCountView.as_view(),
+        name='dog-count'),
+
+    url(r'^api/dog/search/$',
+        DogSearchView.as_view(),
+        name='dog-search'),
+
+    url(r'^api/dog/export/$',
+        DogExportView.as_view(),
+        name='dog-export'),
+
+    url(r'^api/dog/(?P<pk>-1|\d+)/(?P<liked_status>liked|disliked|undecided)'
+        r'/next/page/$',
+        DogPageView.as_view(),
+        name='dogview-page'),
+
+    url(r'^api/dog/(?P<pk>\d+)/(?P<liked_status>liked|disliked|undecided)'
+        r'/swipe/$',
+        DogSwipeView.as_view(),
+        name='dog-swipe'),
 
     url(r'^api/dog/(?P<pk>\d+)/(?P<liked_status>.+)/next/',
         DogView.as_view(),
@@ -30,6 +75,8 @@ urlpatterns = format_suffix_patterns([
         UserDogView.as_view(),
         name='userdogview'),
 
+    url(r'^api/metrics/$', MetricsView.as_view(), name='metrics'),
+
     url(r'^api/user/preferences/',
         UserPreferenceView.as_view(),
         name='userpref'),
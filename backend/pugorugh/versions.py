@@ -0,0 +1,101 @@
+"""Version counters used to answer conditional requests cheaply
+
+Each counter names a slice of data a response depends on: the whole dog
+catalog, the ranking model, one user's preferences or one user's
+liked/disliked dogs. Writes
+bump the counter (see signals.py), so comparing counters tells whether a
+cached response is still current without loading the data itself.
+
+Each process also counts the bumps it applied itself, so in-process
+caches it keeps up to date write by write (see candidates.py) can tell
+those from writes made by other processes.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import threading
+
+from django.db.models import F
+from django.utils import timezone
+
+from . import models
+
+CATALOG = 'catalog'
+# bumped by build_rankings, queues may be ordered differently
+RANKING = 'ranking'
+
+_state = threading.local()
+# bumps applied by this process, per key
+_local = Counter()
+_local_lock = threading.Lock()
+
+
+def userpref_key(user_id):
+    return 'userpref:{}'.format(user_id)
+
+
+def userdogs_key(user_id):
+    return 'userdogs:{}'.format(user_id)
+
+
+@contextmanager
+def deferred():
+    """Collect bumps made inside the block and apply each key once at
+    the end, e.g. around bulk writes that fire a signal per row
+    """
+    if getattr(_state, 'pending', None) is not None:
+        # nested, the outermost block applies the bumps
+        yield
+        return
+    _state.pending = set()
+    try:
+        yield
+        pending = _state.pending
+    finally:
+        _state.pending = None
+    bump(*pending)
+
+
+def bump(*keys):
+    """Increment the counters for keys, creating missing ones
+    :param keys: version keys
+    """
+    if not keys:
+        return
+    pending = getattr(_state, 'pending', None)
+    if pending is not None:
+        pending.update(keys)
+        return
+    updated = models.Version.objects.filter(key__in=keys).update(
+        value=F('value') + 1, modified=timezone.now())
+    if updated < len(set(keys)):
+        existing = set(models.Version.objects
+                       .filter(key__in=keys)
+                       .values_list('key', flat=True))
+        models.Version.objects.bulk_create(
+            [models.Version(key=key, value=1)
+             for key in set(keys) - existing],
+            ignore_conflicts=True)
+    with _local_lock:
+        _local.update(set(keys))
+
+
+def local_bumps(keys):
+    """Bumps this process applied to keys since it started
+    :param keys: version keys
+    :return: dict of key -> int
+    """
+    with _local_lock:
+        return {key: _local[key] for key in keys}
+
+
+def get_versions(keys):
+    """Current counters for keys in a single query
+    :param keys: version keys
+    :return: dict of key -> (value, modified), (0, None) when missing
+    """
+    versions = {key: (0, None) for key in keys}
+    versions.update(
+        (key, (value, modified)) for key, value, modified in
+        models.Version.objects.filter(key__in=keys).values_list(
+            'key', 'value', 'modified'))
+    return versions
@@ -1,17 +1,44 @@
-from functools import reduce
-import operator
+import hashlib
+import mimetypes
+import os
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import connection
+from django.http import FileResponse, HttpResponseNotModified, \
+    StreamingHttpResponse
 from django.shortcuts import get_object_or_404, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.utils.http import http_date
+from django.views.decorators.http import condition, require_safe
+from django.views.static import was_modified_since
 from rest_framework import permissions, status
-from rest_framework.generics import CreateAPIView, RetrieveUpdateAPIView
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import CreateAPIView, ListAPIView, \
+    RetrieveUpdateAPIView
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from rest_framework.views import APIView
 
+from . import authentication
+from . import candidates
+from . import export
+from . import matchcounts
+from . import metrics
 from . import models
+from . import pagination
+from . import pool
+from . import search
 from . import serializers
+from . import storage
+from . import swipes
+from . import versions
 
 valid_liked_statuses = {'liked': 'l', 'disliked': 'd', 'undecided': None}
 
@@ -37,21 +64,67 @@ def reverse_liked(value):
             return key
 
 
-def map_age_to_q(ages):
-    """Builds a Q query for dog age based on db values string like 'a,s,y'
+def request_versions(request, keys):
+    """versions.get_versions for keys, fetched once per request so the
+    ETag and Last-Modified functions share a single query
+    :param request: Request
+    :param keys: version keys
+    :return: dict of key -> (value, modified)
+    """
+    cached = getattr(request, '_pugorugh_versions', None)
+    if cached is None:
+        cached = request._pugorugh_versions = {}
+    missing = [key for key in keys if key not in cached]
+    if missing:
+        cached.update(versions.get_versions(missing))
+    return cached
+
 
-    :param ages: Comma-delimited string with possible values [b,y,a,s]
-    :return: Q query object for filtering dog ages
+def userpref_version(request):
+    """The user's versions.userpref_key counter, for
+    UserPref.cached_dog_lookups
+    :param request: Request
+    :return: int
     """
-    ages = ages.split(',')
-    age_range_map = {'b': [0, 6], 'y': [7, 23], 'a': [24, 70], 's': [71, 360]}
-    age_ranges = [age_range_map[x] for x in ages]
-    q_list = []
-    for age_range in age_ranges:
-        q_list.append(reduce(operator.and_,
-                             [Q(age__gte=age_range[0]),
-                              Q(age__lte=age_range[1])]))
-    return reduce(operator.or_, q_list)
+    key = versions.userpref_key(request.user.pk)
+    return request_versions(request, [key])[key][0]
+
+
+def versioned_condition(get_keys):
+    """condition() decorator for a GET handler whose response only
+    depends on the user, the URL and the versions named by get_keys
+    :param get_keys: function of request -> list of version keys
+    :return: method decorator
+    """
+    def etag(request, *args, **kwargs):
+        keys = get_keys(request)
+        values = request_versions(request, keys)
+        parts = [request.user.pk,
+                 request.accepted_renderer.format,
+                 request.get_full_path()]
+        parts.extend(values[key][0] for key in keys)
+        return hashlib.md5(
+            '|'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        keys = get_keys(request)
+        dates = [modified for value, modified in
+                 request_versions(request, keys).values() if modified]
+        return max(dates) if dates else None
+
+    return method_decorator(condition(etag_func=etag,
+                                      last_modified_func=last_modified))
+
+
+def dog_version_keys(request):
+    return [versions.CATALOG,
+            versions.RANKING,
+            versions.userpref_key(request.user.pk),
+            versions.userdogs_key(request.user.pk)]
+
+
+def userpref_version_keys(request):
+    return [versions.userpref_key(request.user.pk)]
 
 
 class UserRegisterView(CreateAPIView):
@@ -60,28 +133,26 @@ class UserRegisterView(CreateAPIView):
     serializer_class = serializers.UserSerializer
 
 
-class DogView(RetrieveUpdateAPIView):
+class UserLogoutView(APIView):
     permission_classes = (permissions.IsAuthenticated,)
-    queryset = models.Dog.objects.all()
-    serializer_class = serializers.DogSerializer
+
+    def post(self, request, *args, **kwargs):
+        # Deleting the token also evicts it from the authentication
+        # cache, see CachedTokenAuthentication for other processes
+        if request.auth is not None:
+            request.auth.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class DogQueryMixin:
+    """Dogs matching the user's preferences and the liked_status kwarg"""
 
     def get_queryset(self):
-        queryset = models.Dog.objects.all()
         liked_status = is_liked(self.kwargs['liked_status'])
-        try:
-            # Check if there are userprefs
-            userpref = models.UserPref.objects.get(
-                user=self.request.user)
-            queryset = queryset.filter(
-                gender__in=userpref.gender.split(','),
-                size__in=userpref.size.split(',')
-            )
-            if userpref.age:
-                ages = userpref.age
-                queryset = queryset.filter(map_age_to_q(ages))
-        except ObjectDoesNotExist:
-            # Pass if no userprefs
-            pass
+        # the versions the undecided queue and ETags need, in one query
+        request_versions(self.request, dog_version_keys(self.request))
+        queryset = models.Dog.objects.for_userpref(
+            self.request.user, userpref_version(self.request))
         if liked_status is not None:
             # Filter according to status if exists
             queryset = queryset.filter(
@@ -89,18 +160,234 @@ class DogView(RetrieveUpdateAPIView):
                 userdog__user=self.request.user)
         else:
             # Just get the ones with no status
-            queryset = queryset.filter().exclude(
-                userdog__user=self.request.user)
+            queryset = queryset.undecided_by(self.request.user)
         return queryset
 
+
+class DogView(DogQueryMixin, RetrieveUpdateAPIView):
+    permission_classes = (permissions.IsAuthenticated,)
+    queryset = models.Dog.objects.all()
+    serializer_class = serializers.DogSerializer
+
+    @versioned_condition(dog_version_keys)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_next_dog(self):
+        """Queryset whose first row is the dog after pk"""
+        pk = int(self.kwargs.get('pk'))
+        if is_liked(self.kwargs['liked_status']) is None:
+            # Undecided dogs come from the user's precomputed queue
+            queue = candidates.get_queue(
+                self.request.user,
+                request_versions(self.request,
+                                 dog_version_keys(self.request)))
+            dog_id = queue.next_after(pk)
+            if dog_id is None:
+                raise Http404('No dogs matching query')
+            return models.Dog.objects.filter(id=dog_id)
+        return self.get_queryset().filter(id__gt=pk).order_by('id')
+
     def get_object(self):
-        pk = self.kwargs.get('pk')
-        queryset = self.get_queryset()
-        if pk != '-1':
-            queryset = queryset.filter(id__gt=pk)
-        if len(queryset) == 0:
+        dog = self.get_next_dog().first()
+        if dog is None:
+            raise Http404('No dogs matching query')
+        return dog
+
+    def retrieve(self, request, *args, **kwargs):
+        # read-only, so serialize a .values() row instead of a Dog
+        row = (self.get_next_dog()
+               .values(*serializers.DogRowSerializer.columns())
+               .first())
+        if row is None:
             raise Http404('No dogs matching query')
-        return queryset.first()
+        serializer = serializers.DogRowSerializer(
+            row, context=self.get_serializer_context())
+        return Response(serializer.data)
+
+
+class DogPageView(DogQueryMixin, ListAPIView):
+    """The next ?limit= dogs after pk, with a cursor to continue from,
+    so clients can buffer upcoming dogs instead of fetching one per swipe
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = serializers.DogRowSerializer
+    pagination_class = pagination.KeysetPagination
+
+    def paginate_queryset(self, queryset):
+        pk = int(self.kwargs.get('pk'))
+        columns = serializers.DogRowSerializer.columns()
+        if is_liked(self.kwargs['liked_status']) is not None:
+            return self.paginator.paginate_queryset(
+                queryset.values(*columns), self.request, view=self,
+                after=pk)
+        # Undecided dogs: slice the candidate queue, then one id__in query
+        paginator = self.paginator
+        paginator.page_size_used = paginator.get_page_size(self.request)
+        after = paginator.get_after(self.request, pk)
+        dog_ids = candidates.get_queue(
+            self.request.user,
+            request_versions(self.request, dog_version_keys(self.request)),
+        ).ids_after(after, paginator.page_size_used + 1)
+        # keep the queue's order, which is not the id order when ranked
+        dogs = {row['id']: row for row in models.Dog.objects
+                .filter(id__in=dog_ids).values(*columns)}
+        rows = [dogs[dog_id] for dog_id in dog_ids if dog_id in dogs]
+        return paginator.paginate_rows(rows)
+
+
+class UserDogListView(ListAPIView):
+    """The user's liked, disliked or undecided dogs, a keyset-paginated
+    page at a time, optionally filtered by ?breed= and ?size=
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = pagination.KeysetPagination
+    filter_fields = ('breed', 'size')
+
+    def get_serializer_class(self):
+        if is_liked(self.kwargs['liked_status']) is None:
+            return serializers.DogRowSerializer
+        return serializers.UserDogRowSerializer
+
+    def get_queryset(self):
+        liked_status = is_liked(self.kwargs['liked_status'])
+        filters = {field: self.request.query_params[field]
+                   for field in self.filter_fields
+                   if field in self.request.query_params}
+        columns = self.get_serializer_class().columns()
+        if liked_status is None:
+            self.paginator.key = 'id'
+            return models.Dog.objects.undecided_by(
+                self.request.user).filter(**filters).values(*columns)
+        # Seek along the (user, status, dog) index of UserDog
+        self.paginator.key = 'dog_id'
+        return models.UserDog.objects.filter(
+            user=self.request.user,
+            status=liked_status,
+            **{'dog__' + field: value for field, value in filters.items()}
+        ).values('dog_id', *columns)
+
+
+class PopularDogView(ListAPIView):
+    """The ?limit= most liked dogs, read from the like_count index"""
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = serializers.PopularDogRowSerializer
+    pagination_class = None
+    default_limit = 10
+    max_limit = 100
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.query_params['limit'])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def get_queryset(self):
+        columns = serializers.PopularDogRowSerializer.columns()
+        return models.Dog.objects.order_by('-like_count', 'id').values(
+            *columns)[:self.get_limit()]
+
+
+class PreferenceLookupsMixin:
+    """UserPref.dog_lookups() of the user, where ?gender=, ?size= and
+    ?age= stand in for the saved preference of the same name, e.g. the
+    boxes ticked but not saved yet
+    """
+    # preference -> its key in UserPref.dog_lookups()
+    lookup_names = {'gender': 'gender_code__in', 'size': 'size_code__in',
+                    'age': 'age_bucket__in'}
+
+    def get_preference_lookups(self):
+        """Raise ValidationError for an invalid preference param
+        :return: dict of Dog lookups
+        """
+        given = {name: self.request.query_params[name]
+                 for name in self.lookup_names
+                 if name in self.request.query_params}
+        serializer = serializers.UserPrefSerializer(data=given, partial=True)
+        serializer.is_valid(raise_exception=True)
+        lookups = dict(models.UserPref.cached_dog_lookups(
+            self.request.user, userpref_version(self.request)))
+        overrides = models.UserPref(**serializer.validated_data).dog_lookups()
+        for name in given:
+            lookup = self.lookup_names[name]
+            lookups.pop(lookup, None)
+            if lookup in overrides:
+                lookups[lookup] = overrides[lookup]
+        return lookups
+
+
+class DogCountView(PreferenceLookupsMixin, APIView):
+    """Number of dogs matching the user's preferences, read from the
+    DogCount table, so the preferences screen can show it live
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        lookups = self.get_preference_lookups()
+        return Response({'count': matchcounts.count(lookups)})
+
+
+class DogSearchView(PreferenceLookupsMixin, ListAPIView):
+    """Dogs matching the user's preferences whose name or breed match
+    every word of ?q= as a prefix, in id order a keyset-paginated page
+    at a time
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    serializer_class = serializers.DogRowSerializer
+    pagination_class = pagination.KeysetPagination
+
+    def get_queryset(self):
+        text = self.request.query_params.get('q', '')
+        if not search.terms(text):
+            raise ValidationError({'q': ['Enter a word to search for.']})
+        dogs = models.Dog.objects.filter(**self.get_preference_lookups())
+        # seek on the index's copy of the id, see search.filter_dogs
+        self.paginator.key = 'search_id'
+        return search.filter_dogs(dogs, text).values(
+            'search_id', *serializers.DogRowSerializer.columns())
+
+
+class DogExportView(APIView):
+    """The whole catalog, or with ?since= the dogs changed and deleted
+    since then, streamed as NDJSON, gzipped when the client accepts it
+
+    X-Next-Since is the since to pass for the changes after this export.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_since(self):
+        """?since= as a change number, see export.py
+        :return: int or None, raise ValidationError when malformed
+        """
+        value = self.request.query_params.get('since')
+        if value is None:
+            return None
+        if not value.isdigit():
+            raise ValidationError(
+                {'since': ['Enter the X-Next-Since of an earlier export.']})
+        return int(value)
+
+    def get(self, request, *args, **kwargs):
+        since = self.get_since()
+        # read before the rows, so the next export repeats rather than
+        # misses the writes committed while this one runs
+        next_since = export.last_change()
+        lines = export.ndjson_lines(since, context={'request': request})
+        accepted = accepted_encodings(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if 'gzip' in accepted:
+            response = StreamingHttpResponse(
+                export.gzip_stream(lines),
+                content_type='application/x-ndjson')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(
+                export.batched(lines), content_type='application/x-ndjson')
+        patch_vary_headers(response, ['Accept-Encoding'])
+        response['X-Next-Since'] = str(next_since)
+        return response
 
 
 class UserDogView(RetrieveUpdateAPIView):
@@ -110,22 +397,11 @@ class UserDogView(RetrieveUpdateAPIView):
 
     def put(self, request, *args, **kwargs):
         dog = models.Dog.objects.get(id=self.kwargs['pk'])
-        if self.kwargs['liked_status'] == 'undecided':
-            try:
-                models.UserDog.objects.filter(dog=dog,
-                                              user=self.request.user
-                                              ).delete()
-            except Exception:
-                raise Http404
-        else:
-            try:
-                models.UserDog.objects.update_or_create(
-                    user=self.request.user,
-                    dog=dog,
-                    defaults={'status': is_liked(self.kwargs['liked_status'])}
-                )
-            except Exception:
-                raise Http404
+        try:
+            swipes.record_decision(self.request.user, dog.id,
+                                   is_liked(self.kwargs['liked_status']))
+        except Exception:
+            raise Http404
         url = reverse('dogview',
                       kwargs={
                           'pk': self.kwargs['pk'],
@@ -134,12 +410,105 @@ class UserDogView(RetrieveUpdateAPIView):
         return Response(data=url, status=status.HTTP_201_CREATED)
 
 
+class DogSwipeView(APIView):
+    """Record a decision on dog pk and return the next undecided dog, so
+    a swipe takes one round trip
+
+    The next dog's row is fetched in pool.task_pool while the decision
+    is written. Inside a transaction, e.g. with ATOMIC_REQUESTS, another
+    connection could not see its state, so both run in turn instead.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        pk = int(self.kwargs['pk'])
+        liked_status = is_liked(self.kwargs['liked_status'])
+        if not models.Dog.objects.filter(id=pk).exists():
+            raise Http404('No dogs matching query')
+        # the queue is read before the write, which only ever drops pk
+        next_id = candidates.get_queue(
+            request.user, request_versions(request, dog_version_keys(request)),
+        ).next_after(pk)
+        context = self.get_serializer_context()
+        if connection.in_atomic_block:
+            swipes.record_swipe(request.user, pk, liked_status)
+            data = self.next_dog(next_id, context)
+        else:
+            future = pool.task_pool.submit(self.next_dog, next_id, context)
+            try:
+                swipes.record_decision(request.user, pk, liked_status)
+            finally:
+                data = future.result()
+        return Response({'next': data}, status=status.HTTP_200_OK)
+
+    def get_serializer_context(self):
+        return {'request': self.request, 'format': self.format_kwarg,
+                'view': self}
+
+    @staticmethod
+    def next_dog(dog_id, context):
+        """Serialized dog, None when there is none
+        :param dog_id: Dog id or None
+        :param context: serializer context
+        """
+        row = None
+        if dog_id is not None:
+            row = (models.Dog.objects.filter(id=dog_id)
+                   .values(*serializers.DogRowSerializer.columns())
+                   .first())
+        if row is None:
+            return None
+        return serializers.DogRowSerializer(row, context=context).data
+
+
+class UserDogBatchView(APIView):
+    """Record a list of {dog_id, status} decisions in one request"""
+    permission_classes = (permissions.IsAuthenticated,)
+    max_decisions = getattr(settings, 'PUGORUGH_SWIPE_BATCH_SIZE', 500)
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of decisions.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > self.max_decisions:
+            return Response(
+                {'detail': 'At most {} decisions per request.'.format(
+                    self.max_decisions)},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        items = [serializers.SwipeSerializer(data=item)
+                 for item in request.data]
+        valid = [item for item in items if item.is_valid()]
+        results = swipes.record_swipes(
+            request.user,
+            [(item.validated_data['dog_id'],
+              is_liked(item.validated_data['status']))
+             for item in valid])
+        # the item that decided each dog, the last one for repeated dogs
+        last = {item.validated_data['dog_id']: item for item in valid}
+
+        data = []
+        for item in items:
+            if item.errors:
+                data.append({'result': 'invalid', 'errors': item.errors})
+            elif last[item.validated_data['dog_id']] is not item:
+                data.append(dict(item.data, result=swipes.SUPERSEDED))
+            else:
+                data.append(dict(item.data,
+                                 result=results[item.data['dog_id']]))
+        return Response(data=data, status=status.HTTP_200_OK)
+
+
 class UserPreferenceView(RetrieveUpdateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     user = get_user_model()
     queryset = models.UserPref.objects.all()
     serializer_class = serializers.UserPrefSerializer
 
+    @versioned_condition(userpref_version_keys)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_object(self):
         queryset = self.get_queryset()
         obj = get_object_or_404(queryset, user=self.request.user)
@@ -152,3 +521,96 @@ class UserPreferenceView(RetrieveUpdateAPIView):
         else:
             return Http404('Could not save preferences')
         return HttpResponse('/')
+
+
+class MetricsView(APIView):
+    """This process's request histograms and cache counters, as
+    Prometheus text or, with ?format=json, as JSON; staff only
+    """
+    permission_classes = (permissions.IsAdminUser,)
+    renderer_classes = (metrics.PrometheusRenderer, JSONRenderer)
+
+    def get(self, request, *args, **kwargs):
+        return Response({
+            'histograms': metrics.registry.snapshot(),
+            'caches': {'token': authentication.token_cache.stats(),
+                       'userpref': models.userpref_cache.stats(),
+                       'candidate_queue': candidates.stats()},
+        })
+
+
+def accepted_encodings(header):
+    """Content codings from an Accept-Encoding header, minus q=0 ones
+    :param header: Accept-Encoding value
+    :return: set of lower-case codings
+    """
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def find_static_file(name):
+    """Absolute path of a static file, from STATIC_ROOT once collected
+    and from the app static directories before that
+    :param name: path relative to STATIC_URL
+    :return: tuple of (path, collected) or (None, False)
+    """
+    if settings.STATIC_ROOT:
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except SuspiciousFileOperation:
+            return None, False
+        if os.path.isfile(path):
+            return path, True
+    path = finders.find(name)
+    if path is not None and os.path.isfile(path):
+        return path, False
+    return None, False
+
+
+@require_safe
+def static_asset(request, path):
+    """Serve a static file, precompressed when the client accepts it
+
+    Fingerprinted names are cached for a year as immutable, others for
+    PUGORUGH_STATIC_MAX_AGE seconds.
+    """
+    name = path.replace('\\', '/')
+    full_path, collected = find_static_file(name)
+    if full_path is None:
+        raise Http404
+    stat = os.stat(full_path)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+        return HttpResponseNotModified()
+
+    content_type, encoding = mimetypes.guess_type(name)
+    if encoding is None and collected:
+        accepted = accepted_encodings(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        for coding, suffix in storage.available_encodings():
+            if coding in accepted and os.path.isfile(full_path + suffix):
+                full_path += suffix
+                encoding = coding
+                break
+    response = FileResponse(open(full_path, 'rb'),
+                            content_type=content_type or
+                            'application/octet-stream')
+    response['Content-Length'] = os.path.getsize(full_path)
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if encoding is not None:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    if collected and staticfiles_storage.is_hashed(name):
+        patch_cache_control(response, public=True, max_age=31536000,
+                            immutable=True)
+    else:
+        patch_cache_control(
+            response, public=True,
+            max_age=getattr(settings, 'PUGORUGH_STATIC_MAX_AGE', 300))
+    return response